@@ -0,0 +1,111 @@
+#answer_cache.py 語義答案快取：新問題與已回答的問題足夠相似時直接返回先前的答案，知識庫版本變化後自動失效。
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers by question embedding.
+    A lookup returns the answer of the most similar cached question if its cosine similarity
+    is at least similarity_threshold and it was answered against the same knowledge-base version.
+    The cached version only moves forward (on lookup or advance_version); requests that still carry
+    an older version during a hot reload miss the cache and do not store their answers.
+    """
+
+    def __init__(self, embed_query, similarity_threshold=0.97, max_entries=512, ttl_seconds=24 * 3600):
+        self.embed_query = embed_query
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # question -> (unit vector, answer, created_at)
+        self._matrix = None  # 向量矩陣按需重建，每次查找只做一次矩陣乘法
+        self._matrix_keys = []
+        self._kb_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, question):
+        vector = np.asarray(self.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _is_older(self, kb_version):
+        return self._kb_version is not None and (kb_version is None or kb_version < self._kb_version)
+
+    def _advance_version(self, kb_version):
+        # 知識庫更新後，所有舊答案都可能引用過時的內容。版本只往前走：
+        # 熱重載期間仍帶著舊版本的請求不能把快取清空、退回舊版本
+        if kb_version == self._kb_version or self._is_older(kb_version):
+            return
+        if self._entries:
+            print(f"Knowledge base version changed ({self._kb_version} -> {kb_version}). Clearing {len(self._entries)} cached answers.")
+        self._entries.clear()
+        self._matrix = None
+        self._kb_version = kb_version
+
+    def advance_version(self, kb_version):
+        """
+        Moves the cache to a newer knowledge-base version (after a reload), dropping the older answers.
+        """
+        with self._lock:
+            self._advance_version(kb_version)
+
+    def _expire(self, now):
+        expired = [key for key, (_, _, created_at) in self._entries.items() if now - created_at > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, question, kb_version):
+        """
+        Returns a cached answer for a sufficiently similar question, or None.
+        """
+        vector = self._embed(question)
+        now = time.time()
+        with self._lock:
+            self._advance_version(kb_version)
+            if kb_version != self._kb_version:
+                self.misses += 1
+                return None  # 舊版本的請求：快取裡的答案屬於較新的知識庫
+            self._expire(now)
+            if self._entries:
+                if self._matrix is None:
+                    self._matrix_keys = list(self._entries.keys())
+                    self._matrix = np.stack([self._entries[key][0] for key in self._matrix_keys])
+                similarities = self._matrix @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    key = self._matrix_keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][1]
+            self.misses += 1
+            return None
+
+    def store(self, question, answer, kb_version):
+        vector = self._embed(question)
+        with self._lock:
+            # 只存當前版本的答案：熱重載之前開始的請求帶著舊版本，它的答案直接丟掉
+            if kb_version != self._kb_version:
+                return
+            self._entries[question] = (vector, answer, time.time())
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "kb_version": self._kb_version,
+            }
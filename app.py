@@ -1,7 +1,19 @@
-from flask import Flask, render_template, request, jsonify
-from utils import generate_answer
+import json
+import time
+
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from utils import generate_answer, stream_answer, batch_answers, parse_batch_request, parse_scope, session_store, should_save_exchange, invalid_body_message
+from main import get_cache_stats, get_scopes
+from ingest_service import uploads_enabled, is_authorized, save_upload, max_upload_bytes, max_upload_request_bytes
+from metrics import start_trace, finish_trace, new_trace_id, render_metrics, content_type as metrics_content_type
 
 app = Flask(__name__)
+# 超過上傳上限的請求在讀取內容之前就被拒絕（413），而不是先整個緩衝進記憶體
+app.config['MAX_CONTENT_LENGTH'] = max_upload_request_bytes
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({"error": f"The file is larger than {max_upload_bytes // (1024 * 1024)} MB."}), 413
 
 @app.route('/')
 def index():
@@ -9,20 +21,149 @@ def index():
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    data = request.json
-    message = data.get('message')
-    chat_history = data.get('chat_history', [])
+    """
+    Answers one message. The conversation is kept server-side: clients send 'session_id'
+    (returned by the first call) instead of the whole chat history.
+    An optional 'scope' ({"vendor", "model", "document_id", "section"}) restricts retrieval to some manuals.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": invalid_body_message}), 400
+    scope, error_message = parse_scope(data.get('scope'))
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    # 每個請求一個 trace id（可由客戶端的 X-Request-ID 指定），各階段耗時都記在它下面
+    trace = start_trace("chat", request.headers.get('X-Request-ID'))
+    message = data.get('message') or ''
+    # 舊的客戶端仍可能送 chat_history，只用來建立新 session
+    session = session_store.get_or_create(data.get('session_id'), data.get('chat_history'))
     
     # Generate AI response using the existing generate_answer function
-    ai_response = generate_answer(message, chat_history)
+    ai_response = generate_answer(message, session, scope)
     
-    # Update chat history
-    chat_history.append({"role": "user", "content": message})
-    chat_history.append({"role": "assistant", "content": ai_response})
+    # Update the server-side conversation（失敗的回合不存，免得錯誤訊息被當成助手的回答送回模型）
+    if should_save_exchange(message, ai_response, failed=trace["error"]):
+        session_store.append_exchange(session, message, ai_response)
+    finish_trace(trace, session_id=session.session_id)
     
-    return jsonify({
-        "chat_history": chat_history
+    response = jsonify({
+        "session_id": session.session_id,
+        "response": ai_response
     })
+    response.headers['X-Trace-Id'] = trace["trace_id"]
+    return response
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Server-Sent Events version of /chat: sends 'token' events as the answer is generated,
+    then a 'done' event with the session ID, the full answer and the time to first token.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": invalid_body_message}), 400
+    scope, error_message = parse_scope(data.get('scope'))
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    message = data.get('message') or ''
+    session = session_store.get_or_create(data.get('session_id'), data.get('chat_history'))
+    trace_id = request.headers.get('X-Request-ID') or new_trace_id()
+
+    def generate():
+        # 回應是在 view 返回之後才逐步產生的，所以 trace 在生成器裡開始
+        trace = start_trace("chat_stream", trace_id)
+        started = time.perf_counter()
+        first_token_ms = None
+        answer_parts = []
+        for piece in stream_answer(message, session, scope):
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - started) * 1000
+            answer_parts.append(piece)
+            yield sse_event("token", {"text": piece})
+        answer = "".join(answer_parts)
+        if should_save_exchange(message, answer, failed=trace["error"]):
+            session_store.append_exchange(session, message, answer)
+        ttft_ms = round(first_token_ms, 1) if first_token_ms is not None else None
+        finish_trace(trace, session_id=session.session_id, ttft_ms=ttft_ms)
+        yield sse_event("done", {
+            "session_id": session.session_id,
+            "answer": answer,
+            "ttft_ms": ttft_ms,
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "trace_id": trace_id
+        })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Trace-Id': trace_id}  # 避免反向代理緩衝整個回應
+    )
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """
+    Answers a list of independent questions: {"questions": [...], "max_concurrency": 8, "scope": {...}}.
+    Streams one JSON object per line (JSONL) as each answer completes, in completion order;
+    'index' gives the position of the question in the request.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": invalid_body_message}), 400
+    questions, max_concurrency, scope, error_message = parse_batch_request(data)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    trace_id = request.headers.get('X-Request-ID') or new_trace_id()
+
+    def generate():
+        trace = start_trace("chat_batch", trace_id)
+        for result in batch_answers(questions, max_concurrency, scope):
+            yield json.dumps(result) + "\n"
+        finish_trace(trace, questions=len(questions))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Trace-Id': trace_id}
+    )
+
+@app.route('/scopes', methods=['GET'])
+def scopes():
+    """
+    The manuals that /chat can be scoped to, with their vendor, model and title.
+    """
+    return jsonify({"documents": get_scopes()})
+
+@app.route('/manuals', methods=['POST'])
+def upload_manual():
+    """
+    Receives a PDF manual (multipart field 'file') for the ingest service (ingest_service.py).
+    """
+    if not uploads_enabled():
+        return jsonify({"error": "Uploads are disabled. Set INGEST_API_TOKEN to enable them."}), 403
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"error": "Send the PDF in a multipart field named 'file'."}), 400
+    try:
+        result = save_upload(upload.filename, upload.read())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result), 202 if result["status"] == "queued" else 200
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(get_cache_stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics of this worker: per-stage latency, LLM tokens, cache hit rates and errors.
+    """
+    return Response(render_metrics(), content_type=metrics_content_type)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
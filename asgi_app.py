@@ -0,0 +1,278 @@
+#asgi_app.py 非同步（ASGI）服務模式：同一個 worker 可以同時處理多個等待 LLM 的對話。
+# 啟動: uvicorn asgi_app:app --host 0.0.0.0 --port 7860
+import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+
+from utils import agenerate_answer, astream_answer, abatch_answers, parse_batch_request, parse_scope, session_store, should_save_exchange, invalid_body_message
+from main import get_cache_stats, get_scopes, preload
+from ingest_service import uploads_enabled, is_authorized, save_upload, max_upload_bytes, max_upload_request_bytes
+from metrics import start_trace, finish_trace, new_trace_id, render_metrics, content_type as metrics_content_type
+
+# 每個 worker 同時進行中的對話上限；超過時直接回 429，而不是讓請求無限排隊
+max_concurrent_chats = int(os.getenv("MAX_CONCURRENT_CHATS", "64"))
+
+
+class ChatSlots:
+    """
+    Non-waiting per-worker limit on concurrent chats: acquire() takes a slot at once or returns None.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+
+    def acquire(self):
+        # 檢查和佔用之間沒有 await，事件循環中不會有其他請求插進來
+        if self.in_use >= self.limit:
+            return None
+        self.in_use += 1
+        return ChatSlot(self)
+
+
+class ChatSlot:
+    """
+    One taken slot; release() may be called more than once (generator finally and response background).
+    """
+
+    def __init__(self, slots):
+        self._slots = slots
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._slots.in_use -= 1
+
+
+chat_slots = ChatSlots(max_concurrent_chats)
+
+
+def too_busy():
+    return JSONResponse(
+        {"error": "Server is busy, please retry shortly."},
+        status_code=429,
+        headers={"Retry-After": "1"}
+    )
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+async def read_json_object(request):
+    """
+    Returns the JSON object in the request body, or None if the body is not valid JSON or not an object.
+    """
+    try:
+        data = await request.json()
+    except ValueError:  # 包括 JSONDecodeError 和 UnicodeDecodeError
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def invalid_body():
+    return JSONResponse({"error": invalid_body_message}, status_code=400)
+
+
+async def index(request):
+    return FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "index.html"))
+
+
+async def chat(request):
+    # 在讀取請求內容之前就佔用名額，之後的 await 期間其他請求看得到這個名額已被佔用
+    slot = chat_slots.acquire()
+    if slot is None:
+        return too_busy()
+    try:
+        data = await read_json_object(request)
+        if data is None:
+            return invalid_body()
+        scope, error_message = parse_scope(data.get('scope'))
+        if error_message:
+            return JSONResponse({"error": error_message}, status_code=400)
+        trace = start_trace("chat", request.headers.get('x-request-id'))
+        message = data.get('message') or ''
+        # 對話存在 SQLite（SESSION_DB）時讀寫會碰磁碟，放到執行緒裡，不阻塞事件循環
+        session = await asyncio.to_thread(session_store.get_or_create, data.get('session_id'), data.get('chat_history'))
+        ai_response = await agenerate_answer(message, session, scope)
+    finally:
+        slot.release()
+
+    if should_save_exchange(message, ai_response, failed=trace["error"]):
+        await asyncio.to_thread(session_store.append_exchange, session, message, ai_response)
+    finish_trace(trace, session_id=session.session_id)
+    return JSONResponse({"session_id": session.session_id, "response": ai_response}, headers={"X-Trace-Id": trace["trace_id"]})
+
+
+async def chat_stream(request):
+    slot = chat_slots.acquire()
+    if slot is None:
+        return too_busy()
+    response = None
+    try:
+        response = await start_chat_stream(request, slot)
+        return response
+    finally:
+        # 沒有交給串流（參數錯誤或讀取請求失敗）時立即釋放名額
+        if not isinstance(response, StreamingResponse):
+            slot.release()
+
+
+async def start_chat_stream(request, slot):
+    data = await read_json_object(request)
+    if data is None:
+        return invalid_body()
+    scope, error_message = parse_scope(data.get('scope'))
+    if error_message:
+        return JSONResponse({"error": error_message}, status_code=400)
+    message = data.get('message') or ''
+    session = await asyncio.to_thread(session_store.get_or_create, data.get('session_id'), data.get('chat_history'))
+    trace_id = request.headers.get('x-request-id') or new_trace_id()
+
+    async def generate():
+        # 整個串流期間都佔用名額，串流結束（或客戶端斷開）時釋放
+        try:
+            trace = start_trace("chat_stream", trace_id)
+            started = time.perf_counter()
+            first_token_ms = None
+            answer_parts = []
+            async for piece in astream_answer(message, session, scope):
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - started) * 1000
+                answer_parts.append(piece)
+                yield sse_event("token", {"text": piece})
+            answer = "".join(answer_parts)
+            if should_save_exchange(message, answer, failed=trace["error"]):
+                await asyncio.to_thread(session_store.append_exchange, session, message, answer)
+            ttft_ms = round(first_token_ms, 1) if first_token_ms is not None else None
+            finish_trace(trace, session_id=session.session_id, ttft_ms=ttft_ms)
+            yield sse_event("done", {
+                "session_id": session.session_id,
+                "answer": answer,
+                "ttft_ms": ttft_ms,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1),
+                "trace_id": trace_id
+            })
+        finally:
+            slot.release()
+
+    # background 也釋放名額：回應在產生器開始之前就中斷時，finally 不會執行
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Trace-Id": trace_id},
+        background=BackgroundTask(slot.release)
+    )
+
+
+async def chat_batch(request):
+    slot = chat_slots.acquire()
+    if slot is None:
+        return too_busy()
+    response = None
+    try:
+        response = await start_chat_batch(request, slot)
+        return response
+    finally:
+        if not isinstance(response, StreamingResponse):
+            slot.release()
+
+
+async def start_chat_batch(request, slot):
+    data = await read_json_object(request)
+    if data is None:
+        return invalid_body()
+    questions, max_concurrency, scope, error_message = parse_batch_request(data)
+    if error_message:
+        return JSONResponse({"error": error_message}, status_code=400)
+    trace_id = request.headers.get('x-request-id') or new_trace_id()
+
+    async def generate():
+        # 一個批次佔用一個名額；批次內的並行度由 max_concurrency 控制
+        try:
+            trace = start_trace("chat_batch", trace_id)
+            async for result in abatch_answers(questions, max_concurrency, scope):
+                yield json.dumps(result) + "\n"
+            finish_trace(trace, questions=len(questions))
+        finally:
+            slot.release()
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Trace-Id": trace_id},
+        background=BackgroundTask(slot.release)
+    )
+
+
+async def scopes(request):
+    # 讀 SQLite 很快，但仍放到執行緒裡，不阻塞事件循環
+    return JSONResponse({"documents": await asyncio.to_thread(get_scopes)})
+
+
+def upload_too_large():
+    return JSONResponse({"error": f"The file is larger than {max_upload_bytes // (1024 * 1024)} MB."}, status_code=413)
+
+
+async def upload_manual(request):
+    # 上傳的 PDF 放進 input/，由 ingest_service.py 導入
+    if not uploads_enabled():
+        return JSONResponse({"error": "Uploads are disabled. Set INGEST_API_TOKEN to enable them."}, status_code=403)
+    if not is_authorized(request.headers.get("authorization")):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    # 先看 Content-Length，太大的上傳不讀取內容；沒有 Content-Length（chunked）時由下面的有界讀取把關
+    try:
+        content_length = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        return JSONResponse({"error": "Invalid Content-Length."}, status_code=400)
+    if content_length > max_upload_request_bytes:
+        return upload_too_large()
+    # multipart 解析把檔案寫進暫存檔（超過 1 MB 即落盤），不會整個留在記憶體
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None or not hasattr(upload, "read"):
+        return JSONResponse({"error": "Send the PDF in a multipart field named 'file'."}, status_code=400)
+    data = await upload.read(max_upload_bytes + 1)
+    if len(data) > max_upload_bytes:
+        return upload_too_large()
+    try:
+        result = await asyncio.to_thread(save_upload, upload.filename, data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(result, status_code=202 if result["status"] == "queued" else 200)
+
+
+async def stats(request):
+    return JSONResponse(get_cache_stats())
+
+
+async def metrics(request):
+    return Response(render_metrics(), media_type=metrics_content_type)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # RAG_PRELOAD=1：worker 啟動時就建立 RAG 鏈，而不是讓第一個請求等待
+    if os.getenv("RAG_PRELOAD", "1") == "1":
+        await asyncio.to_thread(preload)
+    yield
+
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/', index),
+    Route('/chat', chat, methods=['POST']),
+    Route('/chat/stream', chat_stream, methods=['POST']),
+    Route('/chat/batch', chat_batch, methods=['POST']),
+    Route('/scopes', scopes, methods=['GET']),
+    Route('/manuals', upload_manual, methods=['POST']),
+    Route('/stats', stats, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+])
@@ -0,0 +1,232 @@
+#backends.py 可插拔的嵌入與生成後端：遠端 Together AI，或完全在本機執行（適用於離線的實驗室網路）。
+# EMBEDDINGS_BACKEND = together | local | stub
+# LLM_BACKEND        = together | huggingface | ollama | stub
+# VECTOR_BACKEND     = chroma | numpy（向量存儲，見 vector_index.py）
+# stub 是確定性的離線替身（不需要網路或模型），供 benchmark 和測試使用
+# langchain_together 的客戶端讀取 TOGETHER_API_BASE；負載測試時指向 mock_together.py（見 load_test.py）
+import os
+import re
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+load_dotenv()
+
+embeddings_backend = os.getenv("EMBEDDINGS_BACKEND", "together").lower()
+llm_backend = os.getenv("LLM_BACKEND", "together").lower()
+vector_backend = os.getenv("VECTOR_BACKEND", "chroma").lower()
+
+default_embeddings_models = {
+    "together": "togethercomputer/m2-bert-80M-32k-retrieval",
+    "local": "sentence-transformers/all-MiniLM-L6-v2",
+    "stub": "stub-hashing-384",
+}
+default_llm_models = {
+    "together": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
+    "huggingface": "meta-llama/Llama-3.2-1B-Instruct",
+    "ollama": "llama3.1:8b",
+    "stub": "stub-canned",
+}
+
+
+def get_embeddings_model_name(backend=None):
+    backend = backend or embeddings_backend
+    return os.getenv("EMBEDDINGS_MODEL") or default_embeddings_models[backend]
+
+
+def get_llm_model_name(backend=None):
+    backend = backend or llm_backend
+    return os.getenv("LLM_MODEL") or default_llm_models[backend]
+
+
+def get_collection_name(base_name, backend=None, model_name=None):
+    """
+    Vectors from different embedding models cannot share a collection, so every model
+    other than the original Together one gets its own collection.
+    """
+    backend = backend or embeddings_backend
+    model_name = model_name or get_embeddings_model_name(backend)
+    if backend == "together" and model_name == default_embeddings_models["together"]:
+        return base_name
+    # 可讀的前綴加上完整模型名稱的短雜湊：截斷後相同前綴的不同模型不會共用集合，名稱也總是以字母或數字結尾
+    # （舊版 ChromaDB 的集合名稱最長 63 個字符）
+    digest = hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:8]
+    prefix = f"{base_name}__{re.sub(r'[^a-zA-Z0-9]+', '_', model_name).lower()}"[:63 - len(digest) - 1].rstrip('_')
+    return f"{prefix}_{digest}"
+
+
+def backend_modules(embeddings=None, llm=None):
+    """
+    The provider modules the configured backends import when their clients are created (for preloading).
+    """
+    embeddings = embeddings or embeddings_backend
+    llm = llm or llm_backend
+    modules = {
+        "together": ["langchain_together"],
+        "local": ["torch", "transformers"],
+    }.get(embeddings, [])
+    modules += {
+        "together": ["langchain_together"],
+        "ollama": ["langchain_community.chat_models.ollama"],
+        "huggingface": ["torch", "transformers", "langchain_community.llms.huggingface_pipeline"],
+        "stub": ["langchain_core.language_models.fake_chat_models"],
+    }.get(llm, [])
+    return list(dict.fromkeys(modules))
+
+
+def together_api_key():
+    api_key = os.getenv("TOGETHER_API_KEY")
+    if not api_key:
+        raise ValueError("TOGETHER_API_KEY environment variable not set. Please set it in your .env file, or use a local backend.")
+    return api_key
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Sentence embeddings computed on the local CPU with a Hugging Face transformer.
+    Texts are tokenized and encoded in batches, and batches run on a small thread pool
+    (PyTorch releases the GIL inside its kernels).
+    """
+
+    def __init__(self, model_name=default_embeddings_models["local"], batch_size=32, max_workers=None,
+                 max_length=512, pooling="mean", normalize=True):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 1) // 2))
+        self.max_length = max_length
+        self.pooling = pooling
+        self.normalize = normalize
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is not None:
+                return
+            import torch
+            from transformers import AutoTokenizer, AutoModel
+            # 每個執行緒各自用一部分 CPU 核心，避免執行緒間的 intra-op 並行互相爭搶
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.max_workers))
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self._model = AutoModel.from_pretrained(self.model_name)
+            self._model.eval()
+            print(f"Local embedding model '{self.model_name}' loaded ({self.max_workers} worker threads).")
+
+    def _embed_batch(self, texts):
+        import torch
+        encoded = self._tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+        with torch.inference_mode():
+            hidden = self._model(**encoded).last_hidden_state
+        if self.pooling == "cls":
+            vectors = hidden[:, 0]
+        else:
+            mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            vectors = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        if self.normalize:
+            vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+        return vectors.tolist()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        self._load()
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return [vector for batch_vectors in executor.map(self._embed_batch, batches) for vector in batch_vectors]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class StubEmbeddings(Embeddings):
+    """
+    Deterministic offline embeddings: a signed, hashed bag of words, L2-normalized.
+    Texts sharing words get similar vectors, so retrieval benchmarks give meaningful (lexical-level)
+    results without a network or a model. latency_seconds simulates a remote call per request.
+    """
+
+    _WORD = re.compile(r'\w+')
+
+    def __init__(self, dimensions=384, latency_seconds=0.0):
+        self.dimensions = dimensions
+        self.latency_seconds = latency_seconds
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimensions
+        for word in self._WORD.findall(text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+            vector[digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+        norm = sum(value * value for value in vector) ** 0.5
+        return [value / norm for value in vector] if norm else vector
+
+    def embed_documents(self, texts):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def create_embeddings(backend=None, model_name=None):
+    """
+    Returns the LangChain Embeddings for the configured backend.
+    """
+    backend = backend or embeddings_backend
+    model_name = model_name or get_embeddings_model_name(backend)
+    if backend == "together":
+        from langchain_together import TogetherEmbeddings
+        return TogetherEmbeddings(model=model_name, api_key=together_api_key())
+    if backend == "local":
+        return LocalEmbeddings(
+            model_name=model_name,
+            batch_size=int(os.getenv("LOCAL_EMBEDDINGS_BATCH_SIZE", "32")),
+            max_workers=int(os.getenv("LOCAL_EMBEDDINGS_WORKERS", "0")) or None
+        )
+    if backend == "stub":
+        return StubEmbeddings(latency_seconds=float(os.getenv("STUB_LATENCY", "0")))
+    raise ValueError(f"Unknown EMBEDDINGS_BACKEND '{backend}'. Use 'together', 'local' or 'stub'.")
+
+
+def create_llm(backend=None, model_name=None, temperature=0.3):
+    """
+    Returns the LangChain chat model / LLM for the configured backend.
+    """
+    backend = backend or llm_backend
+    model_name = model_name or get_llm_model_name(backend)
+    if backend == "together":
+        from langchain_together import ChatTogether
+        # stream_usage：串流時也回報 token 用量（供 /metrics 統計）
+        return ChatTogether(model=model_name, temperature=temperature, api_key=together_api_key(), stream_usage=True)
+    if backend == "ollama":
+        # 本機的 Ollama 服務（llama.cpp），例如 `ollama serve` + `ollama pull llama3.1:8b`
+        from langchain_community.chat_models import ChatOllama
+        return ChatOllama(model=model_name, temperature=temperature, base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"))
+    if backend == "huggingface":
+        # 直接在本進程中用 transformers 生成（CPU 上建議用小模型）
+        from langchain_community.llms import HuggingFacePipeline
+        return HuggingFacePipeline.from_model_id(
+            model_id=model_name,
+            task="text-generation",
+            pipeline_kwargs={
+                "max_new_tokens": int(os.getenv("LOCAL_LLM_MAX_NEW_TOKENS", "512")),
+                "temperature": temperature,
+                "do_sample": temperature > 0,
+                "return_full_text": False,
+            }
+        )
+    if backend == "stub":
+        # 固定的回答，逐字串流；只用來量測 RAG 流程本身的開銷
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        return FakeListChatModel(
+            responses=[os.getenv("STUB_LLM_RESPONSE", "This is a stub answer from the offline test backend.")],
+            sleep=float(os.getenv("STUB_LATENCY", "0")) or None
+        )
+    raise ValueError(f"Unknown LLM_BACKEND '{backend}'. Use 'together', 'huggingface', 'ollama' or 'stub'.")
@@ -0,0 +1,99 @@
+#batch_questions.py 批量問答的命令列工具（LIMS 整合、夜間 QA 任務）：讀入問題列表，以 JSONL 輸出答案（按完成順序）。
+# 問題檔案：每行一個問題的純文字檔，或每行 {"question": "..."} 的 JSONL；"-" 表示標準輸入。
+# 用法:
+#   在本進程中執行:   python batch_questions.py questions.txt --max-concurrency 8 > answers.jsonl
+#   送到運行中的服務: python batch_questions.py questions.jsonl --url http://localhost:7860 -o answers.jsonl
+import sys
+import json
+import time
+import argparse
+import urllib.request
+
+
+def read_questions(path):
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        questions = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                questions.append(json.loads(line)["question"])
+            else:
+                questions.append(line)
+        return questions
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def answers_in_process(questions, max_concurrency, scope):
+    from utils import batch_answers
+    return batch_answers(questions, max_concurrency, scope)
+
+
+def answers_from_server(questions, max_concurrency, scope, url, chunk_size):
+    """
+    Posts the questions to /chat/batch, chunk_size at a time (the server limits the batch size),
+    and yields the streamed results with 'index' relative to the whole list.
+    """
+    endpoint = url.rstrip("/") + "/chat/batch"
+    for offset in range(0, len(questions), chunk_size):
+        body = json.dumps({"questions": questions[offset:offset + chunk_size], "max_concurrency": max_concurrency,
+                           "scope": scope}).encode("utf-8")
+        request = urllib.request.Request(endpoint, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request) as response:
+            for line in response:
+                if line.strip():
+                    result = json.loads(line)
+                    result["index"] += offset
+                    yield result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a list of questions with the RAG chain and write JSONL results.")
+    parser.add_argument("questions", help="text file (one question per line) or JSONL with a 'question' field; '-' for stdin")
+    parser.add_argument("-o", "--output", help="output JSONL file (default: stdout)")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="concurrent LLM calls (default: BATCH_MAX_CONCURRENCY)")
+    parser.add_argument("--url", help="base URL of a running app (e.g. http://localhost:7860); default runs in this process")
+    parser.add_argument("--scope", help='restrict retrieval to some manuals, e.g. \'{"vendor": "Agilent", "model": "1260 Infinity II"}\'')
+    parser.add_argument("--chunk-size", type=int, default=500, help="questions per request when using --url")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions)
+    if not questions:
+        raise SystemExit("No questions found.")
+    scope = None
+    if args.scope:
+        from utils import parse_scope
+        scope, error_message = parse_scope(json.loads(args.scope))
+        if error_message:
+            raise SystemExit(error_message)
+
+    started = time.perf_counter()
+    if args.url:
+        results = answers_from_server(questions, args.max_concurrency, scope, args.url, args.chunk_size)
+    else:
+        results = answers_in_process(questions, args.max_concurrency, scope)
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    answered = failed = 0
+    try:
+        for result in results:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            if "error" in result:
+                failed += 1
+            else:
+                answered += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"{answered} answered, {failed} failed in {elapsed:.1f}s ({len(questions) / elapsed:.2f} questions/s).", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#bench_normalizer.py 比較 text_normalizer 與舊的正則鏈的速度，並在大量隨機頁面上驗證輸出一致（黃金輸入見 test_normalizer.py）。
+# 用法: python bench_normalizer.py [--pages 200] [--repeat 5] [--fuzz 20000]
+import sys
+import time
+import random
+import argparse
+
+from text_normalizer import normalize_text, normalize_pages
+from test_normalizer import GOLDEN_CASES, legacy_normalize, random_page
+
+
+def check_golden(rng, fuzz_cases):
+    failures = 0
+    cases = GOLDEN_CASES + [random_page(rng) for _ in range(fuzz_cases)]
+    for case in cases:
+        expected = legacy_normalize(case)
+        actual = normalize_text(case)
+        if expected != actual:
+            failures += 1
+            if failures <= 5:
+                print(f"MISMATCH for {case[:80]!r}...\n  legacy:     {expected[:120]!r}\n  normalizer: {actual[:120]!r}")
+    print(f"Golden check: {len(cases) - failures}/{len(cases)} inputs identical to the legacy chain.")
+    return failures == 0
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Golden-output check and micro-benchmark for text_normalizer.")
+    parser.add_argument("--pages", type=int, default=200, help="Synthetic pages per benchmark document.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fuzz", type=int, default=2000, help="Random pages to compare against the legacy chain.")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    ok = check_golden(rng, args.fuzz)
+
+    pages = [random_page(rng) + "\n" for _ in range(args.pages)]
+    document = "".join(pages)
+    size_mb = len(document) / 1e6
+
+    legacy_time = best_of(args.repeat, lambda: legacy_normalize(document))
+    fused_time = best_of(args.repeat, lambda: normalize_text(document))
+    streamed_time = best_of(args.repeat, lambda: list(normalize_pages(pages)))
+
+    print(f"Document: {args.pages} pages, {size_mb:.2f} MB")
+    print(f"  legacy chain (whole document): {legacy_time * 1000:8.1f} ms")
+    print(f"  normalize_text (whole document): {fused_time * 1000:6.1f} ms  ({legacy_time / fused_time:.2f}x)")
+    print(f"  normalize_pages (per page):    {streamed_time * 1000:8.1f} ms  ({legacy_time / streamed_time:.2f}x)")
+
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,59 @@
+#bench_startup.py 量測服務啟動的各階段耗時：導入 main/utils/app、預先導入的各模組、以及 RAG 鏈各元件的初始化。
+# 每一輪都在全新的子進程中執行（冷啟動），報告各階段的中位數。
+# 用法: python bench_startup.py [--runs 5] [--entry app] [--no-init]
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# 在子進程中執行：記錄導入入口模組的時間，再 preload 並初始化，最後把 main.startup_timings 以 JSON 印出
+CHILD_SCRIPT = """
+import sys, json, time, io, contextlib
+started = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    __import__({entry!r})
+    import main
+    entry_ms = (time.perf_counter() - started) * 1000
+    main.preload_modules()
+    ready = main.initialize() if {initialize!r} else None
+timings = {{"import {entry}": round(entry_ms, 1)}}
+timings.update(main.startup_timings)
+timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+print(json.dumps({{"timings": timings, "ready": ready, "error": main.get_init_error()}}))
+"""
+
+
+def run_once(entry, initialize):
+    script = CHILD_SCRIPT.format(entry=entry, initialize=initialize)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "child process failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage startup cost of the RAG service.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--entry", default="app", help="module a worker imports first (app, asgi_app, utils or main)")
+    parser.add_argument("--no-init", action="store_true", help="only measure imports, do not build the chain")
+    args = parser.parse_args()
+
+    samples = {}
+    last = None
+    for run in range(args.runs):
+        last = run_once(args.entry, not args.no_init)
+        for stage, ms in last["timings"].items():
+            samples.setdefault(stage, []).append(ms)
+        print(f"run {run + 1}/{args.runs}: total {last['timings']['total']:.0f} ms")
+
+    # 順序即實際執行順序；已被前面階段導入過的模組，其耗時接近 0
+    print(f"\n{'stage':<48}{'median ms':>12}{'max ms':>10}")
+    for stage, values in samples.items():
+        print(f"{stage:<48}{statistics.median(values):>12.1f}{max(values):>10.1f}")
+    if last["ready"] is False:
+        print(f"\nNote: the chain could not be initialized ({last['error']}); init stages after the failure are missing.")
+
+
+if __name__ == "__main__":
+    main()
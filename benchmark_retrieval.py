@@ -0,0 +1,366 @@
+#benchmark_retrieval.py 離線的檢索評估與效能基準：recall@k、MRR、延遲 p50/p95、QPS，以及（可選）建庫吞吐量。
+# 標註集為 JSONL，每行一個問題：
+#   {"question": "...", "expected_text": ["答案所在段落中的一句話", ...]}
+#   {"question": "...", "expected_chunks": [{"document": "manual.pdf", "chunk_index": 12}, ...]}
+# expected_text 不依賴分塊方式，比較不同 chunk_size / chunk_overlap 時應使用它。
+#
+# 用法:
+#   評估現有知識庫:      python benchmark_retrieval.py --labels eval.jsonl
+#   用指定分塊重新建庫:  python benchmark_retrieval.py --labels eval.jsonl --pdfs input --chunker recursive --chunk-size 800 --chunk-overlap 150
+#   比較結構化分塊:      python benchmark_retrieval.py --labels eval.jsonl --pdfs input --chunker structured --chunk-max-tokens 300
+#   完全離線:            EMBEDDINGS_BACKEND=stub LLM_BACKEND=stub python benchmark_retrieval.py --pdfs input --synthetic 200 --generate
+import os
+import re
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# 評估時不使用（也不寫入）磁碟上的查詢嵌入快取，也不使用答案快取
+os.environ.setdefault("QUERY_EMBEDDING_CACHE_DB", "")
+os.environ.setdefault("ANSWER_CACHE_ENABLED", "0")
+
+import main
+from kb_store import KnowledgeBaseStore, read_chunks
+from lexical_index import LexicalIndex
+from index_files import index_exists
+from reranker import reranker_backend
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(text):
+    return _WHITESPACE.sub(' ', text).strip().lower()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# --- Knowledge Base Build (ingest throughput) ---
+def build_knowledge_base(pdf_dir, work_dir, chunk_size, chunk_overlap, workers, batch_size, embedding_workers,
+                         chunker=None, max_tokens=None, min_tokens=None):
+    """
+    Ingests the PDFs into a fresh SQLite store, ChromaDB collection and BM25 index under work_dir,
+    with the same functions as setup_knowledge_base.py. Returns throughput numbers per stage.
+    """
+    from pypdf import PdfReader
+    from setup_knowledge_base import process_pdf, generate_embeddings, load_chunks_to_vector_db, get_token_counter
+    from backends import get_collection_name, get_embeddings_model_name
+
+    pdf_paths = sorted(os.path.join(pdf_dir, name) for name in os.listdir(pdf_dir) if name.lower().endswith('.pdf'))
+    if not pdf_paths:
+        raise SystemExit(f"No PDF files found in '{pdf_dir}'.")
+    pages = sum(len(PdfReader(path).pages) for path in pdf_paths)
+
+    db_path = os.path.join(work_dir, "processed_documents.db")
+    vector_dir = os.path.join(work_dir, "vector_db_numpy" if main.vector_backend == "numpy" else "vector_db_chroma")
+    lexical_dir = os.path.join(work_dir, "lexical_index")
+    stats = {"pdfs": len(pdf_paths), "pages": pages}
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        count = len(pdf_paths)
+        results = list(executor.map(process_pdf, pdf_paths, [chunk_size] * count, [chunk_overlap] * count,
+                                    [chunker] * count, [max_tokens] * count, [min_tokens] * count))
+    stats["process_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with KnowledgeBaseStore(db_path) as store:
+        store.ensure_schema()
+        for path, (processed_text, chunks, metadata) in zip(pdf_paths, results):
+            if processed_text:
+                store.save_document(os.path.basename(path), "PDF", processed_text, "benchmark", chunks, metadata)
+        chunks_data = store.get_chunks_for_embedding()
+    stats["store_seconds"] = time.perf_counter() - started
+    stats["chunks"] = len(chunks_data)
+    # 每個 chunk 的 token 數決定嵌入成本和 prompt 大小；recursive 分塊沒有預先計算，這裡補算
+    token_counter = get_token_counter()
+    chunk_tokens = [item['token_count'] if item['token_count'] is not None else token_counter.count(item['text']) for item in chunks_data]
+    stats["chunk_tokens_total"] = sum(chunk_tokens)
+    stats["chunk_tokens_mean"] = statistics.mean(chunk_tokens) if chunk_tokens else 0.0
+
+    started = time.perf_counter()
+    vectors = generate_embeddings([item['text'] for item in chunks_data], batch_size=batch_size, max_workers=embedding_workers)
+    stats["embed_seconds"] = time.perf_counter() - started
+    for item, vector in zip(chunks_data, vectors):
+        item['embedding'] = vector
+
+    started = time.perf_counter()
+    load_chunks_to_vector_db([item for item in chunks_data if item['embedding'] is not None], db_path=vector_dir,
+                             collection_name=get_collection_name(main.collection_name),
+                             embeddings_model_name=get_embeddings_model_name(), vector_backend=main.vector_backend)
+    stats["vector_load_seconds"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    LexicalIndex.build(chunks_data).save(lexical_dir)
+    stats["lexical_index_seconds"] = time.perf_counter() - started
+
+    stats["pages_per_second"] = pages / stats["process_seconds"] if stats["process_seconds"] else 0.0
+    stats["chunks_per_second_processing"] = len(chunks_data) / stats["process_seconds"] if stats["process_seconds"] else 0.0
+    stats["chunks_per_second_embedding"] = len(chunks_data) / stats["embed_seconds"] if stats["embed_seconds"] else 0.0
+    stats["total_seconds"] = sum(stats[key] for key in ("process_seconds", "store_seconds", "embed_seconds", "vector_load_seconds", "lexical_index_seconds"))
+    return db_path, vector_dir, lexical_dir, stats
+
+
+# --- Labels ---
+def load_labels(path):
+    labels = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            label = json.loads(line)
+            if not label.get("expected_text") and not label.get("expected_chunks"):
+                raise SystemExit(f"{path}:{line_number}: needs 'expected_text' or 'expected_chunks'.")
+            labels.append(label)
+    return labels
+
+
+def synthetic_labels(db_path, count, seed=0, span_words=12):
+    """
+    Known-item questions: a span of words taken from a random chunk, expected back via expected_text.
+    Useful for regression checks when no hand-labeled set is available.
+    """
+    with KnowledgeBaseStore(db_path) as store:
+        chunks = store.get_chunks_for_embedding()
+    rng = random.Random(seed)
+    labels = []
+    for chunk in rng.sample(chunks, min(count, len(chunks))):
+        words = chunk['text'].split()
+        if len(words) < span_words:
+            continue
+        start = rng.randint(0, len(words) - span_words)
+        span = " ".join(words[start:start + span_words])
+        labels.append({"question": span, "expected_text": [span]})
+    return labels
+
+
+def document_names(db_path):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return {row[0]: row[1] for row in conn.execute("SELECT id, original_filename FROM documents")}
+    finally:
+        conn.close()
+
+
+def relevance(docs, label, names):
+    """
+    Returns (rank of the first relevant document or None, recall) for the retrieved docs.
+    """
+    found = set()
+    first_rank = None
+    expected_text = [normalize(text) for text in label.get("expected_text", [])]
+    expected_chunks = [(chunk["document"], chunk["chunk_index"]) for chunk in label.get("expected_chunks", [])]
+    for rank, doc in enumerate(docs, 1):
+        content = normalize(doc.page_content)
+        key = (names.get(doc.metadata.get('source_document_id')), doc.metadata.get('chunk_index'))
+        hits = {("text", i) for i, text in enumerate(expected_text) if text in content}
+        hits |= {("chunk", i) for i, chunk in enumerate(expected_chunks) if chunk == key}
+        if hits and first_rank is None:
+            first_rank = rank
+        found |= hits
+    return first_rank, len(found) / (len(expected_text) + len(expected_chunks))
+
+
+# --- Retrieval ---
+def make_retrieve(mode):
+    """
+    Returns a function query -> ranked documents for 'dense', 'lexical' or 'hybrid' retrieval.
+    """
+    if mode == "lexical":
+        from langchain_core.documents import Document
+
+        def retrieve_lexical(query):
+            hits = main._state["lexical_index"].search(query, k=main.retrieval_k)
+            chunks = read_chunks(main.db_path, [chunk_id for chunk_id, _ in hits])
+            return [Document(page_content=chunks[chunk_id]['text'],
+                             metadata={"source_document_id": chunks[chunk_id]['source_document_id'], "chunk_index": chunks[chunk_id]['chunk_index']})
+                    for chunk_id, _ in hits if chunk_id in chunks]
+        return retrieve_lexical
+    return main.retrieve_documents
+
+
+def run_queries(fn, questions, concurrency):
+    """
+    Runs fn over the questions. Returns (results in order, per-query latencies in ms, wall-clock seconds).
+    """
+    def timed_call(question):
+        started = time.perf_counter()
+        result = fn(question)
+        return result, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(timed_call, questions))
+    else:
+        outcomes = [timed_call(question) for question in questions]
+    wall_seconds = time.perf_counter() - started
+    return [result for result, _ in outcomes], [ms for _, ms in outcomes], wall_seconds
+
+
+def latency_summary(latencies, wall_seconds):
+    return {
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "mean_ms": round(statistics.mean(latencies), 2) if latencies else 0.0,
+        "qps": round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+    }
+
+
+def evaluate(labels, mode, ks, concurrency, names):
+    retrieve = make_retrieve(mode)
+    questions = [label["question"] for label in labels]
+    retrieve(questions[0])  # 預熱（載入模型、打開連接），不計入結果
+    results, latencies, wall_seconds = run_queries(retrieve, questions, concurrency)
+
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks = []
+    for docs, label in zip(results, labels):
+        first_rank, _ = relevance(docs, label, names)
+        reciprocal_ranks.append(1.0 / first_rank if first_rank else 0.0)
+        for k in ks:
+            recalls[k].append(relevance(docs[:k], label, names)[1])
+
+    report = {"mode": mode, "questions": len(labels)}
+    report.update({f"recall@{k}": round(statistics.mean(values), 4) for k, values in recalls.items()})
+    report["mrr"] = round(statistics.mean(reciprocal_ranks), 4)
+    report.update(latency_summary(latencies, wall_seconds))
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline retrieval quality and latency benchmark.")
+    parser.add_argument("--labels", help="JSONL file of labeled questions")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate N known-item questions from the chunks instead of (or in addition to) --labels")
+    parser.add_argument("--pdfs", help="build a fresh knowledge base from this PDF directory (in a temporary directory) and time the ingest")
+    parser.add_argument("--chunker", choices=("structured", "recursive"), default=None, help="chunker for --pdfs (default: CHUNKER)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="characters per chunk (recursive chunker)")
+    parser.add_argument("--chunk-overlap", type=int, default=100, help="overlapping characters (recursive chunker)")
+    parser.add_argument("--chunk-max-tokens", type=int, default=None, help="tokens per chunk (structured chunker, default: CHUNK_MAX_TOKENS)")
+    parser.add_argument("--chunk-min-tokens", type=int, default=None, help="smallest section kept as its own chunk (structured chunker, default: CHUNK_MIN_TOKENS)")
+    parser.add_argument("--ingest-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--embedding-batch-size", type=int, default=64)
+    parser.add_argument("--embedding-workers", type=int, default=4)
+    parser.add_argument("--k", default="1,3,5,10", help="comma-separated cutoffs for recall@k")
+    parser.add_argument("--modes", default="dense,lexical,hybrid,rerank", help="comma-separated retrieval modes to compare "
+                        "(rerank = hybrid + the RERANKER cross-encoder, skipped when RERANKER is not set)")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel queries when measuring QPS")
+    parser.add_argument("--generate", action="store_true", help="also time the full RAG chain (retrieval + LLM) per question")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args()
+
+    if not args.labels and not args.synthetic:
+        parser.error("give --labels and/or --synthetic N")
+    ks = sorted({int(k) for k in args.k.split(",")})
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    report = {"config": {
+        "embeddings_backend": os.getenv("EMBEDDINGS_BACKEND", "together"),
+        "llm_backend": os.getenv("LLM_BACKEND", "together"),
+        "vector_backend": main.vector_backend,
+        "chunker": (args.chunker or os.getenv("CHUNKER", "structured")) if args.pdfs else None,
+        "chunk_size": args.chunk_size if args.pdfs else None,
+        "chunk_overlap": args.chunk_overlap if args.pdfs else None,
+        "chunk_max_tokens": (args.chunk_max_tokens or int(os.getenv("CHUNK_MAX_TOKENS", "300"))) if args.pdfs else None,
+        "hybrid_candidates": main.hybrid_candidates,
+        "reranker": reranker_backend,
+        "rerank_candidates": main.rerank_candidates if reranker_backend != "none" else None,
+        "concurrency": args.concurrency,
+    }}
+
+    work_dir = None
+    if args.pdfs:
+        work_dir = tempfile.TemporaryDirectory(prefix="rag_benchmark_")
+        print(f"--- Building knowledge base from '{args.pdfs}' (chunker={report['config']['chunker']}, chunk_size={args.chunk_size}, "
+              f"chunk_overlap={args.chunk_overlap}, chunk_max_tokens={args.chunk_max_tokens}) ---")
+        main.db_path, vector_dir, main.lexical_index_dir, report["ingest"] = build_knowledge_base(
+            args.pdfs, work_dir.name, args.chunk_size, args.chunk_overlap,
+            args.ingest_workers, args.embedding_batch_size, args.embedding_workers,
+            args.chunker, args.chunk_max_tokens, args.chunk_min_tokens
+        )
+        if main.vector_backend == "numpy":
+            main.vector_index_dir = vector_dir
+        else:
+            main.vector_db_dir = vector_dir
+
+    labels = load_labels(args.labels) if args.labels else []
+    if args.synthetic:
+        labels += synthetic_labels(main.db_path, args.synthetic, seed=args.seed)
+    if not labels:
+        raise SystemExit("No questions to evaluate.")
+
+    # 只建立檢索部分；LLM 只在 --generate 時才需要
+    main.retrieval_k = max(ks)
+    main.hybrid_candidates = max(main.hybrid_candidates, max(ks))
+    retriever_embeddings, retriever, vector_index = main.build_dense_retrieval()
+    lexical_index = LexicalIndex.load(main.lexical_index_dir) if index_exists(main.lexical_index_dir) else None
+    reranker = main.build_reranker()
+    main._state.update(retriever=retriever, retriever_embeddings=retriever_embeddings, vector_index=vector_index, lexical_index=lexical_index)
+    names = document_names(main.db_path)
+
+    report["retrieval"] = []
+    for mode in modes:
+        if mode in ("lexical", "hybrid", "rerank") and lexical_index is None:
+            print(f"Skipping '{mode}': no lexical index in '{main.lexical_index_dir}'.")
+            continue
+        if mode == "rerank" and reranker is None:
+            print("Skipping 'rerank': set RERANKER to 'local' or 'stub' to evaluate it.")
+            continue
+        main._state["lexical_index"] = None if mode == "dense" else lexical_index
+        main._state["reranker"] = reranker if mode == "rerank" else None
+        main._state["dense_k"] = max(ks) if mode == "dense" else main.get_dense_k(lexical_index)
+        report["retrieval"].append(evaluate(labels, mode, ks, args.concurrency, names))
+    main._state["lexical_index"] = lexical_index
+    main._state["reranker"] = reranker
+
+    if args.generate:
+        main.retrieval_k = int(os.getenv("RETRIEVAL_K", "5"))
+        rag_chain = main.get_rag_chain()
+        if rag_chain is None:
+            print(f"Skipping --generate: the RAG chain could not be built ({main.get_init_error()}).")
+        else:
+            questions = [label["question"] for label in labels]
+            rag_chain.invoke(questions[0])
+            _, latencies, wall_seconds = run_queries(rag_chain.invoke, questions, args.concurrency)
+            report["generation"] = latency_summary(latencies, wall_seconds)
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.json_path}")
+    if work_dir is not None:
+        work_dir.cleanup()
+
+
+def print_report(report):
+    print("\n=== Configuration ===")
+    for key, value in report["config"].items():
+        print(f"{key:<32}{value}")
+    if "ingest" in report:
+        print("\n=== Ingest throughput ===")
+        for key, value in report["ingest"].items():
+            print(f"{key:<32}{value:.2f}" if isinstance(value, float) else f"{key:<32}{value}")
+    if report.get("retrieval"):
+        print("\n=== Retrieval ===")
+        columns = [key for key in report["retrieval"][0] if key != "mode"]
+        print(f"{'mode':<10}" + "".join(f"{column:>12}" for column in columns))
+        for row in report["retrieval"]:
+            print(f"{row['mode']:<10}" + "".join(f"{row[column]:>12}" for column in columns))
+    if "generation" in report:
+        print("\n=== Full RAG chain ===")
+        for key, value in report["generation"].items():
+            print(f"{key:<32}{value}")
+
+
+if __name__ == "__main__":
+    main_cli()
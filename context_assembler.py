@@ -0,0 +1,175 @@
+#context_assembler.py 按 token 預算組裝送給 LLM 的 context：合併相鄰 chunk、去掉重疊/近似重複的內容，再按檢索排名填滿預算。
+import os
+import re
+import threading
+
+# 與 main.py 的 LLM（Llama 3.1）對應的 tokenizer。meta-llama 的倉庫需要 HF 權限，預設改用不需權限的副本（tokenizer 相同）；
+# 無法下載（例如離線）時退回按字符估算
+default_tokenizer_name = os.getenv("CONTEXT_TOKENIZER", "unsloth/Meta-Llama-3.1-8B-Instruct")
+
+_WORD = re.compile(r'\w+')
+
+
+class TokenCounter:
+    """
+    Counts tokens with the model's tokenizer (loaded lazily on first use, or up front with load()).
+    Falls back to an estimate of about 4 characters per token if the tokenizer cannot be loaded.
+    """
+
+    def __init__(self, tokenizer_name=default_tokenizer_name):
+        self.tokenizer_name = tokenizer_name
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                from tokenizers import Tokenizer
+                if os.path.isfile(self.tokenizer_name):
+                    self._tokenizer = Tokenizer.from_file(self.tokenizer_name)
+                else:
+                    self._tokenizer = Tokenizer.from_pretrained(self.tokenizer_name, token=os.getenv("HF_TOKEN"))
+                print(f"Tokenizer '{self.tokenizer_name}' loaded for context budgeting.")
+            except Exception as e:
+                self._tokenizer = None
+                print(f"Warning: Could not load tokenizer '{self.tokenizer_name}', estimating tokens from characters. Error: {e}")
+            self._loaded = True
+
+    def count(self, text):
+        if not self._loaded:
+            self.load()
+        if self._tokenizer is None:
+            return (len(text) + 3) // 4
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text, max_tokens):
+        """
+        Returns the longest prefix of text that fits in max_tokens, cut at a word boundary.
+        """
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        cut = text[:low]
+        return cut[:cut.rfind(' ')] if ' ' in cut else cut
+
+
+def merge_overlapping(first, second, max_overlap=300):
+    """
+    Joins two consecutive chunks, dropping the text the second one repeats from the end of the first.
+    """
+    for size in range(min(max_overlap, len(first), len(second)), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first} {second}"
+
+
+def shingles(text, size=5):
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(candidate, kept, threshold=0.8):
+    """
+    True if most of the candidate's word 5-grams already appear in one of the kept passages.
+    """
+    if not candidate:
+        return True
+    for passage in kept:
+        if len(candidate & passage) / len(candidate) >= threshold:
+            return True
+    return False
+
+
+class ContextAssembler:
+    """
+    Turns retrieved documents into the context string for the prompt:
+    merges chunks that are adjacent in the same manual (removing the chunk overlap),
+    drops near-duplicate passages, and adds passages in retrieval order until token_budget is used.
+    A chunk's token count is taken from its 'token_count' metadata (counted at ingest) unless it was merged.
+    """
+
+    def __init__(self, token_counter=None, token_budget=3000, separator="\n\n"):
+        self.token_counter = token_counter or TokenCounter()
+        self.token_budget = token_budget
+        self.separator = separator
+
+    def _passages(self, docs):
+        # 按檢索排名保留順序；同一文件中 chunk_index 相鄰的 chunk 合併成一段
+        passages = []  # [{'key', 'first_index', 'last_index', 'text', 'tokens'}]
+        for doc in docs:
+            if not hasattr(doc, 'page_content'):
+                continue
+            metadata = getattr(doc, 'metadata', None) or {}
+            source = metadata.get('source_document_id')
+            index = metadata.get('chunk_index')
+            merged = False
+            if source is not None and index is not None:
+                for passage in passages:
+                    if passage['key'] != source:
+                        continue
+                    if index == passage['last_index'] + 1:
+                        passage['text'] = merge_overlapping(passage['text'], doc.page_content)
+                        passage['last_index'] = index
+                        merged = True
+                    elif index == passage['first_index'] - 1:
+                        passage['text'] = merge_overlapping(doc.page_content, passage['text'])
+                        passage['first_index'] = index
+                        merged = True
+                    elif passage['first_index'] <= index <= passage['last_index']:
+                        merged = True  # 同一個 chunk 被重複檢索到
+                    if merged:
+                        passage['tokens'] = None  # 合併後的段落要重新計算
+                        break
+            if not merged:
+                passages.append({'key': source, 'first_index': index, 'last_index': index, 'text': doc.page_content,
+                                 'tokens': metadata.get('token_count')})
+        return [(passage['text'], passage['tokens']) for passage in passages]
+
+    def assemble(self, docs, token_budget=None):
+        budget = self.token_budget if token_budget is None else token_budget
+        separator_tokens = self.token_counter.count(self.separator)
+        kept_texts = []
+        kept_shingles = []
+        used_tokens = 0
+        for text, tokens in self._passages(docs):
+            text_shingles = shingles(text)
+            if is_near_duplicate(text_shingles, kept_shingles):
+                continue
+            cost = (tokens if tokens is not None else self.token_counter.count(text)) + (separator_tokens if kept_texts else 0)
+            if used_tokens + cost > budget:
+                remaining = budget - used_tokens - (separator_tokens if kept_texts else 0)
+                # 第一段就放不下時截斷它，避免 context 為空；其他情況跳過，讓後面較短的段落還有機會
+                if not kept_texts and remaining > 0:
+                    kept_texts.append(self.token_counter.truncate(text, remaining))
+                    used_tokens = budget
+                continue
+            kept_texts.append(text)
+            kept_shingles.append(text_shingles)
+            used_tokens += cost
+        return self.separator.join(kept_texts)
+
+
+def keep_recent_lines(text, max_tokens, token_counter):
+    """
+    Drops the oldest lines of a multi-line text (e.g. conversation history) until it fits in max_tokens.
+    """
+    lines = text.split("\n")
+    while len(lines) > 1 and token_counter.count("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    kept = "\n".join(lines)
+    return kept if token_counter.count(kept) <= max_tokens else token_counter.truncate(kept, max_tokens)
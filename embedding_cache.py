@@ -0,0 +1,166 @@
+#embedding_cache.py 為查詢嵌入加一層快取：記憶體 LRU/TTL，加上可選的 SQLite 磁碟層（gunicorn worker 重啟後仍然有效）。
+import re
+import time
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(text):
+    """
+    Normalizes a question so trivially different spellings share a cache entry.
+    """
+    return _WHITESPACE.sub(' ', text).strip().casefold()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model and caches query embeddings keyed on (model name, normalized text).
+    Document embeddings (used at ingest) are passed straight through.
+    """
+
+    def __init__(self, embeddings, model_name, max_entries=1024, ttl_seconds=24 * 3600, disk_cache_path=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_cache_path:
+            try:
+                self._disk = sqlite3.connect(disk_cache_path, timeout=5, check_same_thread=False)
+                self._disk.execute("PRAGMA journal_mode=WAL")
+                self._disk.execute("PRAGMA synchronous=NORMAL")
+                with self._disk:
+                    self._disk.execute('''
+                        CREATE TABLE IF NOT EXISTS query_embeddings (
+                            model_name TEXT NOT NULL,
+                            query TEXT NOT NULL,
+                            vector BLOB NOT NULL,
+                            created_at REAL NOT NULL,
+                            PRIMARY KEY (model_name, query)
+                        )
+                    ''')
+            except sqlite3.Error as e:
+                self._disk = None
+                print(f"Warning: Could not open query embedding cache '{disk_cache_path}', using memory only. Error: {e}")
+
+    def _get_memory(self, key, now):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        vector, created_at = entry
+        if now - created_at > self.ttl_seconds:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return vector
+
+    def _put_memory(self, key, vector, created_at):
+        self._memory[key] = (vector, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, query, now):
+        try:
+            row = self._disk.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE model_name = ? AND query = ?",
+                (self.model_name, query)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Warning: Query embedding cache read failed: {e}")
+            return None, None
+        if row is None or now - row[1] > self.ttl_seconds:
+            return None, None
+        return array('d', row[0]).tolist(), row[1]
+
+    def _put_disk(self, query, vector, created_at):
+        try:
+            with self._disk:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (model_name, query, vector, created_at) VALUES (?, ?, ?, ?)",
+                    (self.model_name, query, array('d', vector).tobytes(), created_at)
+                )
+        except sqlite3.Error as e:
+            print(f"Warning: Query embedding cache write failed: {e}")
+
+    def _lookup(self, query, now):
+        # 呼叫者需持有 self._lock
+        key = (self.model_name, query)
+        vector = self._get_memory(key, now)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        if self._disk is not None:
+            vector, created_at = self._get_disk(query, now)
+            if vector is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self._put_memory(key, vector, created_at)
+                return vector
+        self.misses += 1
+        return None
+
+    def _store(self, query, vector, now):
+        with self._lock:
+            self._put_memory((self.model_name, query), vector, now)
+            if self._disk is not None:
+                self._put_disk(query, vector, now)
+
+    def embed_query(self, text):
+        query = normalize_query(text)
+        now = time.time()
+        with self._lock:
+            vector = self._lookup(query, now)
+        if vector is not None:
+            return vector
+
+        # 遠端嵌入不持有鎖，避免同時到來的不同問題互相等待
+        vector = list(self.embeddings.embed_query(text))
+        self._store(query, vector, now)
+        return vector
+
+    def embed_queries(self, texts):
+        """
+        Embeds many questions, serving cached ones and embedding the rest in a single request.
+        (All configured backends embed queries and documents the same way, so embed_documents is used for the batch.)
+        """
+        queries = [normalize_query(text) for text in texts]
+        now = time.time()
+        with self._lock:
+            vectors = [self._lookup(query, now) for query in queries]
+        missing = {}  # 正規化後相同的問題只嵌入一次
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(queries[i], texts[i])
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            fresh = {query: list(vector) for query, vector in zip(missing, embedded)}
+            for query, vector in fresh.items():
+                self._store(query, vector, now)
+            vectors = [vector if vector is not None else fresh[query] for vector, query in zip(vectors, queries)]
+        return vectors
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._memory),
+            }
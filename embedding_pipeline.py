@@ -0,0 +1,179 @@
+#embedding_pipeline.py 負責分批、並行、可重試的嵌入生成，並支持斷點續傳。
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class EmbeddingCheckpoint:
+    """
+    Stores the vectors of finished batches in a JSON-lines file, keyed by a hash of the batch,
+    so an interrupted run can resume without re-embedding what it already paid for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._batches = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._batches[record["key"]] = record["vectors"]
+                    except (ValueError, KeyError):
+                        # 中斷時最後一行可能只寫了一半，忽略即可
+                        continue
+            print(f"Loaded {len(self._batches)} finished embedding batches from checkpoint '{path}'.")
+
+    def get(self, key):
+        return self._batches.get(key)
+
+    def save(self, key, vectors):
+        with self._lock:
+            self._batches[key] = vectors
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "vectors": vectors}) + "\n")
+
+    def clear(self):
+        with self._lock:
+            self._batches = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def batch_key(texts, model_name=""):
+    """
+    Returns a stable key for a batch of texts embedded with the given model.
+    """
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for text in texts:
+        digest.update(b"\x00")
+        digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def embed_batch_with_retry(texts, embed_fn, max_retries=3, backoff_seconds=1.0):
+    """
+    Embeds one batch, retrying with exponential backoff (plus jitter) on failure.
+    Raises the last error once all retries are used up.
+    """
+    attempt = 0
+    while True:
+        try:
+            vectors = embed_fn(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"Embedding model returned {len(vectors)} vectors for {len(texts)} texts.")
+            return [list(vector) for vector in vectors]
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_seconds * (2 ** attempt) * (1 + random.random() * 0.1)
+            print(f"Embedding batch failed ({e}). Retrying in {delay:.1f}s ({attempt + 1}/{max_retries})...")
+            time.sleep(delay)
+            attempt += 1
+
+
+def embed_in_batches(texts, embed_fn, batch_size=64, max_workers=4, max_retries=3,
+                     backoff_seconds=1.0, checkpoint_path=None, model_name=""):
+    """
+    Embeds texts in batches on a bounded thread pool.
+    embed_fn is any callable taking a list of strings and returning a list of vectors,
+    e.g. TogetherEmbeddings.embed_documents or a local stub model for offline benchmarks.
+    Returns a list aligned with texts; entries of batches that failed after all retries are None.
+    """
+    vectors = [None] * len(texts)
+    if not texts:
+        return vectors
+
+    checkpoint = EmbeddingCheckpoint(checkpoint_path) if checkpoint_path else None
+    pending = []
+    resumed = 0
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        key = batch_key(batch, model_name)
+        cached = checkpoint.get(key) if checkpoint else None
+        if cached is not None and len(cached) == len(batch):
+            vectors[start:start + len(batch)] = cached
+            resumed += 1
+        else:
+            pending.append((start, batch, key))
+    if resumed:
+        print(f"Resumed {resumed} embedding batches from checkpoint, {len(pending)} batches left.")
+
+    failed_batches = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(embed_batch_with_retry, batch, embed_fn, max_retries, backoff_seconds): (start, batch, key)
+            for start, batch, key in pending
+        }
+        for future in as_completed(futures):
+            start, batch, key = futures[future]
+            try:
+                batch_vectors = future.result()
+            except Exception as e:
+                failed_batches += 1
+                print(f"Error embedding batch starting at text {start} ({len(batch)} texts): {e}")
+                continue
+            vectors[start:start + len(batch)] = batch_vectors
+            if checkpoint:
+                checkpoint.save(key, batch_vectors)
+
+    if failed_batches:
+        print(f"Warning: {failed_batches} embedding batches failed after {max_retries} retries. Re-run to resume them.")
+    return vectors
+
+
+def stub_embed_documents(texts, dimensions=768, latency_seconds=0.0):
+    """
+    Deterministic local stand-in for a remote embedding model, for offline benchmarks.
+    """
+    if latency_seconds:
+        time.sleep(latency_seconds)
+    vectors = []
+    for text in texts:
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        rng = random.Random(seed)
+        vectors.append([rng.uniform(-1.0, 1.0) for _ in range(dimensions)])
+    return vectors
+
+
+# --- Offline benchmark (optional, for direct script run) ---
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmark the embedding pipeline against a local stub model.")
+    parser.add_argument("--texts", type=int, default=2000, help="Number of synthetic chunks to embed.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per embedding request.")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="Fraction of requests that fail transiently.")
+    args = parser.parse_args()
+
+    def flaky_stub(batch):
+        if random.random() < args.failure_rate:
+            time.sleep(args.latency)
+            raise ConnectionError("simulated transient failure")
+        return stub_embed_documents(batch, dimensions=64, latency_seconds=args.latency)
+
+    sample_texts = [f"HPLC troubleshooting chunk {i}: check pump seals and degasser." for i in range(args.texts)]
+    checkpoint_file = os.path.join(tempfile.mkdtemp(), "embedding_checkpoint.jsonl")
+
+    for label, workers in (("sequential", 1), ("parallel", args.workers)):
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        started = time.perf_counter()
+        result = embed_in_batches(sample_texts, flaky_stub, batch_size=args.batch_size, max_workers=workers,
+                                  backoff_seconds=0.05, checkpoint_path=checkpoint_file, model_name="stub")
+        elapsed = time.perf_counter() - started
+        done = sum(1 for vector in result if vector is not None)
+        print(f"{label:>10}: {done}/{len(sample_texts)} texts in {elapsed:.2f}s ({done / elapsed:.1f} texts/s, {workers} workers)")
+
+    started = time.perf_counter()
+    embed_in_batches(sample_texts, flaky_stub, batch_size=args.batch_size, max_workers=args.workers,
+                     checkpoint_path=checkpoint_file, model_name="stub")
+    print(f"   resumed: full run served from checkpoint in {time.perf_counter() - started:.2f}s")
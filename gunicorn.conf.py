@@ -0,0 +1,34 @@
+#gunicorn.conf.py gunicorn 設定：master 先導入重量級模組再 fork，每個 worker 建立好 RAG 鏈後才開始接請求。
+# 啟動: gunicorn -c gunicorn.conf.py app:app
+#   或: gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# 對話 session 預設存在 worker 的記憶體裡。多個 worker 時改存共用的 SQLite 檔（utils.py 讀 SESSION_DB），
+# 否則追問落到另一個 worker 時找不到 session，會悄悄開一個新的，對話上下文就丟了
+if workers > 1 and not os.getenv("SESSION_DB"):
+    os.environ["SESSION_DB"] = os.path.join("database", "sessions.db")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))  # SSE 串流會佔住一個執行緒直到回答結束
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))  # 也涵蓋 worker 啟動時的初始化（本地模型載入較慢時調大）
+
+# RAG_PRELOAD=1：langchain、chromadb、tokenizer 在 master 中載入一次，fork 出來的 worker 直接共用（copy-on-write）
+preload_app = os.getenv("RAG_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # 在 fork worker 之前執行；這裡只導入模組，不建立任何連接
+    if preload_app:
+        import main
+        main.preload_modules()
+        server.log.info("Preloaded modules in %.0f ms", sum(main.startup_timings.values()))
+
+
+def post_worker_init(worker):
+    # ChromaDB 和 HTTP 客戶端不能跨 fork 共用，所以在每個 worker 裡建立；失敗時第一個請求會重試
+    if preload_app:
+        import main
+        if main.initialize():
+            worker.log.info("RAG chain ready in %.0f ms", main.startup_timings.get("initialize", 0))
+        else:
+            worker.log.warning("RAG chain initialization failed, will retry on request: %s", main.get_init_error())
@@ -0,0 +1,46 @@
+#index_files.py 索引目錄的原子發佈（BM25 與 NumPy 向量索引共用）。
+# 每次保存寫入一個新的 gen-* 子目錄，寫完後以 os.replace 更新 CURRENT 指標，
+# 所以服務中的 worker 在導入進行時重新載入，看到的永遠是一整組完整的檔案。
+import os
+import time
+import shutil
+
+current_pointer = "CURRENT"
+generation_prefix = "gen-"
+
+
+def new_generation_dir(index_dir):
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, f"{generation_prefix}{time.time_ns()}-{os.getpid()}")
+    os.makedirs(path)
+    return path
+
+
+def publish_generation(index_dir, generation_dir, keep=2):
+    """
+    Points CURRENT at generation_dir and deletes all but the newest `keep` generations.
+    The previous generation is kept because a worker may have just read the old pointer and still be opening its files
+    (files it has already memory-mapped stay readable after deletion).
+    """
+    pointer_tmp = os.path.join(index_dir, f"{current_pointer}.tmp-{os.getpid()}")
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(generation_dir))
+    os.replace(pointer_tmp, os.path.join(index_dir, current_pointer))
+    generations = sorted(name for name in os.listdir(index_dir) if name.startswith(generation_prefix))
+    for name in generations[:-keep]:
+        shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def current_generation_dir(index_dir):
+    """
+    The directory holding the published index files; index_dir itself for indexes saved before generations existed.
+    """
+    try:
+        with open(os.path.join(index_dir, current_pointer), "r", encoding="utf-8") as f:
+            return os.path.join(index_dir, f.read().strip())
+    except FileNotFoundError:
+        return index_dir
+
+
+def index_exists(index_dir):
+    return os.path.exists(os.path.join(current_generation_dir(index_dir), "meta.json"))
@@ -0,0 +1,169 @@
+#ingest_service.py 背景導入服務：監看 input/ 目錄，只處理新增或內容改變的 PDF（以內容雜湊判斷，見 setup_knowledge_base.ingest_knowledge_base），
+# 完成後發佈新的知識庫版本；服務中的 worker 在下一次檢索時於背景重新載入索引（main.maybe_reload_retrieval），不需要重新啟動。
+# 導入在獨立的低優先權進程中執行，不佔用 app 的 worker，聊天請求不會被阻塞。
+# 用法:
+#   持續監看:       python ingest_service.py --interval 10
+#   處理一次後結束: python ingest_service.py --once
+# app 的 POST /manuals（設定 INGEST_API_TOKEN 後啟用）以 save_upload 把上傳的 PDF 放進 input/，由本服務接手導入。
+import os
+import re
+import sys
+import hmac
+import time
+import hashlib
+import argparse
+
+from kb_store import read_document_hashes
+
+input_directory = os.getenv("INGEST_INPUT_DIR", "input")
+db_path = os.path.join("database", "processed_documents.db")
+overrides_filename = "manuals.json"  # 與 manual_metadata.overrides_filename 相同；這裡不匯入它，保持 app 的匯入輕量
+max_upload_bytes = int(float(os.getenv("MAX_UPLOAD_MB", "200")) * 1024 * 1024)
+max_upload_request_bytes = max_upload_bytes + 1024 * 1024  # multipart 的欄位和邊界另外預留 1 MB
+_UNSAFE_FILENAME = re.compile(r'[^\w.\- ()]+')
+
+
+def scan(directory):
+    """
+    Returns {filename: (size, mtime_ns)} of the PDFs (and the manual metadata overrides) in directory.
+    """
+    signatures = {}
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return signatures
+    for entry in entries:
+        if entry.is_file() and (entry.name.lower().endswith(".pdf") or entry.name == overrides_filename):
+            stat = entry.stat()
+            signatures[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return signatures
+
+
+class FolderWatcher:
+    """
+    Polls a directory and reports the files whose size or modification time changed since they were last ingested.
+    A file is only reported once it looks the same in two scans in a row, so a manual that is still being copied
+    is not ingested half-written. Content hashes are left to the ingest, which skips files whose content it already has.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.previous = {}
+        self.ingested = {}
+
+    def poll(self):
+        current = scan(self.directory)
+        changed = sorted(name for name, signature in current.items()
+                         if self.previous.get(name) == signature and self.ingested.get(name) != signature)
+        self.previous = current
+        return changed
+
+    def mark_ingested(self, names):
+        for name in names:
+            if name in self.previous:
+                self.ingested[name] = self.previous[name]
+
+
+def ingest(directory, filenames=None):
+    """
+    Ingests the given PDFs of directory (all of them if filenames is None). Returns the ingest summary.
+    """
+    # 延遲匯入：langchain、chromadb 等只在真的有檔案要處理時才載入
+    from setup_knowledge_base import ingest_knowledge_base
+    started = time.perf_counter()
+    summary = ingest_knowledge_base(directory, pdf_filenames=filenames)
+    print(f"Ingest finished in {time.perf_counter() - started:.1f}s: {summary}")
+    return summary
+
+
+def watch(directory, interval):
+    print(f"Watching '{directory}' for new or changed PDF manuals every {interval:g}s.")
+    watcher = FolderWatcher(directory)
+    while True:
+        changed = watcher.poll()
+        if changed:
+            print(f"Detected new or changed files: {', '.join(changed)}")
+            # manuals.json 改變時要把覆寫套用到所有手冊
+            filenames = None if overrides_filename in changed else [name for name in changed if name != overrides_filename]
+            try:
+                ingest(directory, filenames)
+                watcher.mark_ingested(changed)
+            except Exception as e:
+                print(f"Error ingesting {', '.join(changed)} (will retry): {e}")
+        time.sleep(interval)
+
+
+def lower_priority():
+    # 導入（PDF 解析、本地嵌入）是 CPU 密集的，讓同一台機器上的 app worker 優先
+    try:
+        os.nice(int(os.getenv("INGEST_NICE", "10")))
+    except (AttributeError, OSError):
+        pass
+
+
+# --- Uploads ---
+def uploads_enabled():
+    return bool(os.getenv("INGEST_API_TOKEN"))
+
+
+def is_authorized(authorization_header):
+    """
+    Checks an 'Authorization: Bearer <token>' header against INGEST_API_TOKEN.
+    """
+    token = os.getenv("INGEST_API_TOKEN")
+    if not token or not authorization_header or not authorization_header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(authorization_header[len("Bearer "):].strip().encode(), token.encode())
+
+
+def safe_filename(filename):
+    name = _UNSAFE_FILENAME.sub("_", os.path.basename((filename or "").replace("\\", "/"))).strip(" .")
+    if not name.lower().endswith(".pdf") or name.lower() == ".pdf":
+        raise ValueError("Only PDF manuals (*.pdf) can be uploaded.")
+    return name
+
+
+def save_upload(filename, data, directory=input_directory):
+    """
+    Validates an uploaded PDF and places it in the watched directory for the ingest service.
+    Returns {'filename', 'sha256', 'status'}: 'queued', or 'duplicate' if a manual with the same content is already
+    in the knowledge base (then nothing is written). Raises ValueError for invalid uploads.
+    """
+    name = safe_filename(filename)
+    if len(data) > max_upload_bytes:
+        raise ValueError(f"The file is larger than {max_upload_bytes // (1024 * 1024)} MB.")
+    if not data.startswith(b"%PDF-"):
+        raise ValueError("The file is not a PDF.")
+    content_hash = hashlib.sha256(data).hexdigest()
+    existing = read_document_hashes(db_path).get(content_hash)
+    if existing is not None:
+        return {"filename": existing, "sha256": content_hash, "status": "duplicate"}
+    os.makedirs(directory, exist_ok=True)
+    # 先寫到臨時檔名（不是 .pdf，監看時會略過）再改名，監看服務不會讀到寫了一半的檔案
+    tmp_path = os.path.join(directory, f".{name}.upload-{os.getpid()}")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(directory, name))
+    print(f"Uploaded manual saved as '{os.path.join(directory, name)}' ({len(data)} bytes, sha256 {content_hash[:12]}).")
+    return {"filename": name, "sha256": content_hash, "status": "queued"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a folder and ingest new or changed PDF manuals into the knowledge base.")
+    parser.add_argument("--input", default=input_directory, help="directory to watch (default: INGEST_INPUT_DIR or 'input')")
+    parser.add_argument("--interval", type=float, default=float(os.getenv("INGEST_POLL_SECONDS", "10")), help="seconds between scans")
+    parser.add_argument("--once", action="store_true", help="ingest the directory once and exit")
+    args = parser.parse_args()
+
+    lower_priority()
+    if args.once:
+        ingest(args.input)
+        return
+    try:
+        watch(args.input, args.interval)
+    except KeyboardInterrupt:
+        print("Ingest service stopped.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+#kb_store.py 封裝知識庫的 SQLite 存取：單一連接、WAL 模式、每個文件一個事務、批量寫入。
+import sqlite3
+import hashlib
+import datetime
+
+# 後來加入的欄位：舊的資料庫在 ensure_schema 時以 ALTER TABLE 補上（值為 NULL）
+added_columns = {
+    "documents": (("title", "TEXT"), ("vendor", "TEXT"), ("model", "TEXT"), ("page_count", "INTEGER"), ("content_hash", "TEXT")),
+    "chunks": (("page_number", "INTEGER"), ("section", "TEXT"), ("page_end", "INTEGER"), ("token_count", "INTEGER")),
+}
+
+
+class KnowledgeBaseStore:
+    """
+    Owns a single SQLite connection to the processed documents database.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        # WAL 讓讀取（例如正在服務的 app）不會被寫入阻塞；NORMAL 在 WAL 下仍然安全且少很多 fsync
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+        self.conn.execute("PRAGMA foreign_keys=ON")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def ensure_schema(self):
+        """
+        Create the knowledge base tables if they do not exist yet.
+        """
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    original_filename TEXT NOT NULL UNIQUE, -- Add UNIQUE constraint
+                    source_type TEXT,
+                    processed_text TEXT NOT NULL,
+                    processed_date TEXT,
+                    title TEXT,
+                    vendor TEXT,
+                    model TEXT,
+                    page_count INTEGER,
+                    content_hash TEXT -- PDF 檔案的 SHA-256，用於判斷手冊是新的、改過的還是重複的
+                )
+            ''')
+            # UNIQUE(document_id, chunk_index) 的自動索引以 document_id 開頭，已經涵蓋按文件查詢 chunks
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_id INTEGER NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    chunk_content TEXT NOT NULL,
+                    chunk_length INTEGER,
+                    created_at TEXT,
+                    page_number INTEGER, -- 塊開始的頁碼（從 1 開始）
+                    section TEXT, -- PDF 目錄中的章節，例如 "Troubleshooting > Pump"
+                    page_end INTEGER, -- 塊結束的頁碼
+                    token_count INTEGER, -- 以 tokenizer 計算的 token 數（舊的字元分塊為 NULL）
+                    UNIQUE(document_id, chunk_index), -- Ensure chunks are unique per document
+                    FOREIGN KEY (document_id) REFERENCES documents(id)
+                )
+            ''')
+            self._add_missing_columns()
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_vendor_model ON documents(vendor, model)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash)")
+            # 知識庫版本：每次有新 chunks 寫入向量庫就加一，服務端據此讓快取失效
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS kb_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+        print(f"SQLite tables 'documents', 'chunks' and 'kb_meta' ensured in {self.db_path}")
+
+    def _add_missing_columns(self):
+        for table, columns in added_columns.items():
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            for name, column_type in columns:
+                if name not in existing:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+                    print(f"Added column '{name}' to SQLite table '{table}'.")
+
+    def get_document_id(self, original_filename):
+        row = self.conn.execute("SELECT id FROM documents WHERE original_filename = ?", (original_filename,)).fetchone()
+        return row[0] if row else None
+
+    def get_document_hash(self, document_id):
+        row = self.conn.execute("SELECT content_hash FROM documents WHERE id = ?", (document_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_document_hash(self, document_id, content_hash):
+        with self.conn:
+            self.conn.execute("UPDATE documents SET content_hash = ? WHERE id = ?", (content_hash, document_id))
+
+    def find_document_by_hash(self, content_hash):
+        """
+        The filename of a stored document with this content, or None.
+        """
+        row = self.conn.execute("SELECT original_filename FROM documents WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def get_chunk_ids(self, document_id):
+        return [row[0] for row in self.conn.execute("SELECT id FROM chunks WHERE document_id = ?", (document_id,))]
+
+    def delete_document(self, document_id):
+        """
+        Deletes a document and its chunks in one transaction (e.g. before re-ingesting a changed PDF).
+        Chunk IDs are never reused (AUTOINCREMENT), so stale vectors cannot be mistaken for the new chunks.
+        """
+        with self.conn:
+            deleted_count = self.conn.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,)).rowcount
+            self.conn.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+        print(f"Deleted document ID {document_id} and its {deleted_count} chunks from the database.")
+
+    def get_document_text(self, document_id):
+        row = self.conn.execute("SELECT processed_text FROM documents WHERE id = ?", (document_id,)).fetchone()
+        return row[0] if row else None
+
+    def has_chunks(self, document_id):
+        row = self.conn.execute("SELECT 1 FROM chunks WHERE document_id = ? LIMIT 1", (document_id,)).fetchone()
+        return row is not None
+
+    def _upsert_chunks(self, document_id, chunks):
+        """
+        chunks are strings, or {'text', 'page_number', 'section', 'page_end', 'token_count'} dicts.
+        """
+        current_time = datetime.datetime.now().isoformat()
+        rows = []
+        for i, chunk in enumerate(chunks):
+            if not isinstance(chunk, dict):
+                chunk = {'text': chunk}
+            rows.append((document_id, i, chunk['text'], len(chunk['text']), current_time, chunk.get('page_number'), chunk.get('section'),
+                         chunk.get('page_end', chunk.get('page_number')), chunk.get('token_count')))
+        self.conn.executemany('''
+            INSERT INTO chunks (document_id, chunk_index, chunk_content, chunk_length, created_at, page_number, section, page_end, token_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(document_id, chunk_index) DO UPDATE SET
+                chunk_content = excluded.chunk_content,
+                chunk_length = excluded.chunk_length,
+                created_at = excluded.created_at,
+                page_number = excluded.page_number,
+                section = excluded.section,
+                page_end = excluded.page_end,
+                token_count = excluded.token_count
+        ''', rows)
+
+    def save_document(self, original_filename, source_type, processed_text, processed_date, chunks, metadata=None, content_hash=None):
+        """
+        Insert a processed file and all of its chunks in one transaction.
+        metadata optionally holds the document's 'title', 'vendor', 'model' and 'page_count'; content_hash is the file's SHA-256.
+        Returns the document ID; an already stored file is left untouched.
+        """
+        existing_id = self.get_document_id(original_filename)
+        if existing_id is not None:
+            print(f"Document '{original_filename}' already exists in DB (ID: {existing_id}). Skipping insertion.")
+            return existing_id
+        with self.conn:
+            metadata = metadata or {}
+            cursor = self.conn.execute('''
+                INSERT INTO documents (original_filename, source_type, processed_text, processed_date, title, vendor, model, page_count, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (original_filename, source_type, processed_text, processed_date,
+                  metadata.get('title'), metadata.get('vendor'), metadata.get('model'), metadata.get('page_count'), content_hash))
+            doc_id = cursor.lastrowid
+            self._upsert_chunks(doc_id, chunks)
+        print(f"Document '{original_filename}' saved to database with ID: {doc_id} and {len(chunks)} chunks.")
+        return doc_id
+
+    def save_chunks(self, document_id, chunks):
+        """
+        Insert the chunks of an already stored document in one transaction.
+        Skips documents that already have chunks.
+        """
+        if self.has_chunks(document_id):
+            print(f"Chunks for document ID {document_id} already exist. Skipping chunk insertion.")
+            return
+        with self.conn:
+            self._upsert_chunks(document_id, chunks)
+        print(f"Saved {len(chunks)} chunks into the database for file ID {document_id}.")
+
+    def has_metadata(self, document_id):
+        row = self.conn.execute("SELECT title FROM documents WHERE id = ?", (document_id,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def update_document_metadata(self, document_id, metadata):
+        """
+        Sets the given metadata fields ('title', 'vendor', 'model', 'page_count') of a stored document.
+        Returns True if any of them changed.
+        """
+        fields = [field for field in ("title", "vendor", "model", "page_count") if field in metadata]
+        if not fields:
+            return False
+        with self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE documents SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?"
+                f" AND NOT ({' AND '.join(f'{field} IS ?' for field in fields)})",
+                [metadata[field] for field in fields] + [document_id] + [metadata[field] for field in fields]
+            )
+        return cursor.rowcount > 0
+
+    def get_kb_version(self):
+        row = self.conn.execute("SELECT value FROM kb_meta WHERE key = 'kb_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_kb_version(self):
+        """
+        Marks the knowledge base as changed. Returns the new version.
+        """
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO kb_meta (key, value) VALUES ('kb_version', '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            ''')
+        version = self.get_kb_version()
+        print(f"Knowledge base version is now {version}.")
+        return version
+
+    def get_chunks_for_embedding(self):
+        """
+        Reads all split text chunks, including their IDs.
+        """
+        try:
+            rows = self.conn.execute(
+                "SELECT id, document_id, chunk_index, chunk_content, page_number, section, page_end, token_count FROM chunks ORDER BY document_id, chunk_index"
+            ).fetchall()
+            return [{'id': row[0], 'source_document_id': row[1], 'chunk_index': row[2], 'text': row[3],
+                     'page_number': row[4], 'section': row[5], 'page_end': row[6], 'token_count': row[7]} for row in rows]
+        except sqlite3.Error as e:
+            print(f"Error reading chunks from SQLite database: {e}")
+            return []
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_document_hashes(db_path):
+    """
+    Returns {content hash: filename} of the stored documents, read-only ({} if the database cannot be read).
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return {}
+    try:
+        return {row[0]: row[1] for row in conn.execute("SELECT content_hash, original_filename FROM documents WHERE content_hash IS NOT NULL")}
+    except sqlite3.Error:
+        return {}
+    finally:
+        conn.close()
+
+
+def read_kb_version(db_path):
+    """
+    Reads the knowledge-base version without creating or modifying the database.
+    Returns 0 if the database or the version record does not exist yet.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return 0
+    try:
+        row = conn.execute("SELECT value FROM kb_meta WHERE key = 'kb_version'").fetchone()
+        return int(row[0]) if row else 0
+    except sqlite3.Error:
+        return 0
+    finally:
+        conn.close()
+
+
+def read_chunks(db_path, chunk_ids):
+    """
+    Reads the given chunks read-only, for serving. Returns {chunk id: chunk dict} with the same fields as
+    get_chunks_for_embedding; missing IDs are left out.
+    """
+    if not chunk_ids:
+        return {}
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return {}
+    try:
+        placeholders = ",".join("?" * len(chunk_ids))
+        rows = conn.execute(
+            f"SELECT id, document_id, chunk_index, chunk_content, page_number, section, page_end, token_count FROM chunks WHERE id IN ({placeholders})", list(chunk_ids)
+        ).fetchall()
+        return {row[0]: {'id': row[0], 'source_document_id': row[1], 'chunk_index': row[2], 'text': row[3],
+                         'page_number': row[4], 'section': row[5], 'page_end': row[6], 'token_count': row[7]} for row in rows}
+    except sqlite3.Error as e:
+        print(f"Error reading chunks from SQLite database: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def read_documents(db_path):
+    """
+    Lists the stored documents with their metadata (for the scope selector), read-only.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return []
+    try:
+        rows = conn.execute(
+            "SELECT id, original_filename, title, vendor, model, page_count FROM documents ORDER BY vendor, model, title"
+        ).fetchall()
+        return [{'id': row[0], 'filename': row[1], 'title': row[2] or row[1], 'vendor': row[3], 'model': row[4], 'page_count': row[5]}
+                for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error reading documents from SQLite database: {e}")
+        return []
+    finally:
+        conn.close()
+
+
+def read_scope_chunk_ids(db_path, scope):
+    """
+    Returns the IDs of the chunks inside a scope, read-only. scope may hold 'vendor', 'model' (case-insensitive),
+    'document_id' and 'section' (a case-insensitive substring of the chunk's section).
+    Returns None if the database cannot be read.
+    """
+    conditions, parameters = [], []
+    for field, column in (("vendor", "d.vendor"), ("model", "d.model")):
+        if scope.get(field):
+            conditions.append(f"{column} = ? COLLATE NOCASE")
+            parameters.append(scope[field])
+    if scope.get("document_id") is not None:
+        conditions.append("d.id = ?")
+        parameters.append(scope["document_id"])
+    if scope.get("section"):
+        # 章節名稱常含有 _，跳脫 LIKE 的萬用字元，只做字面上的子字串比對
+        section = scope["section"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append("c.section LIKE ? ESCAPE '\\'")
+        parameters.append(f"%{section}%")
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return None
+    try:
+        rows = conn.execute(
+            "SELECT c.id FROM chunks c JOIN documents d ON d.id = c.document_id"
+            + (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+        ).fetchall()
+        return [row[0] for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error reading the chunks of scope {scope} from SQLite database: {e}")
+        return None
+    finally:
+        conn.close()
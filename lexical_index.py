@@ -0,0 +1,141 @@
+#lexical_index.py 以 chunks 表建立 BM25 倒排索引，用於精確匹配零件編號、錯誤代碼等詞彙。
+# 索引以 NumPy 陣列存檔，查詢時以記憶體映射（mmap）載入，不需要整份讀進記憶體。
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from index_files import new_generation_dir, publish_generation, current_generation_dir
+
+# 保留 "G1311-60001"、"E-101"、"0.5mL" 這類完整的代碼，同時也索引拆開後的各部分
+_TOKEN = re.compile(r'[a-z0-9]+(?:[-_./][a-z0-9]+)*')
+_PART = re.compile(r'[a-z0-9]+')
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "for", "from", "how", "i", "if", "in", "is", "it",
+    "my", "of", "on", "or", "the", "this", "to", "what", "when", "why", "with", "can", "does", "should",
+}
+
+
+def tokenize(text):
+    terms = []
+    for token in _TOKEN.findall(text.lower()):
+        parts = _PART.findall(token)
+        if len(parts) > 1:
+            terms.append(token)
+        terms.extend(part for part in parts if part not in _STOPWORDS)
+    return terms
+
+
+class LexicalIndex:
+    """
+    BM25 index over the chunks table, stored as flat arrays:
+    postings of term i are postings_docs/postings_tf[term_offsets[i]:term_offsets[i + 1]].
+    """
+
+    files = ("term_offsets.npy", "postings_docs.npy", "postings_tf.npy", "doc_lengths.npy", "chunk_ids.npy")
+
+    def __init__(self, terms, term_offsets, postings_docs, postings_tf, doc_lengths, chunk_ids, k1=1.2, b=0.75):
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.term_offsets = term_offsets
+        self.postings_docs = postings_docs
+        self.postings_tf = postings_tf
+        self.doc_lengths = doc_lengths
+        self.chunk_ids = chunk_ids
+        self.k1 = k1
+        self.b = b
+        self.doc_count = len(doc_lengths)
+        self.avg_doc_length = float(doc_lengths.mean()) if self.doc_count else 0.0
+
+    @classmethod
+    def build(cls, chunks, k1=1.2, b=0.75):
+        """
+        Builds the index from an iterable of {'id': chunk id, 'text': chunk content}.
+        """
+        postings = defaultdict(list)  # term -> [(doc position, tf)]
+        doc_lengths = []
+        chunk_ids = []
+        for position, chunk in enumerate(chunks):
+            terms = tokenize(chunk['text'])
+            for term, tf in Counter(terms).items():
+                postings[term].append((position, tf))
+            doc_lengths.append(len(terms))
+            chunk_ids.append(chunk['id'])
+
+        terms = sorted(postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            term_offsets[i + 1] = term_offsets[i] + len(postings[term])
+        postings_docs = np.empty(int(term_offsets[-1]), dtype=np.int32)
+        postings_tf = np.empty(int(term_offsets[-1]), dtype=np.uint16)
+        for i, term in enumerate(terms):
+            start, end = term_offsets[i], term_offsets[i + 1]
+            entries = postings[term]
+            postings_docs[start:end] = [position for position, _ in entries]
+            postings_tf[start:end] = [min(tf, 65535) for _, tf in entries]
+        return cls(terms, term_offsets, postings_docs, postings_tf,
+                   np.asarray(doc_lengths, dtype=np.int32), np.asarray(chunk_ids, dtype=np.int64), k1, b)
+
+    def save(self, index_dir):
+        """
+        Writes the index into a new generation directory and publishes it, so readers never see a half-written index.
+        """
+        generation_dir = new_generation_dir(index_dir)
+        terms = sorted(self.term_ids, key=self.term_ids.get)
+        arrays = (self.term_offsets, self.postings_docs, self.postings_tf, self.doc_lengths, self.chunk_ids)
+        for name, array in zip(self.files, arrays):
+            np.save(os.path.join(generation_dir, name), array)
+        with open(os.path.join(generation_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"terms": terms, "k1": self.k1, "b": self.b}, f)
+        publish_generation(index_dir, generation_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = current_generation_dir(index_dir)
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(index_dir, name), mmap_mode="r") for name in cls.files]
+        return cls(meta["terms"], *arrays, k1=meta["k1"], b=meta["b"])
+
+    def search(self, query, k=10, allowed_chunk_ids=None):
+        """
+        Returns up to k (chunk id, BM25 score) pairs, best first.
+        allowed_chunk_ids optionally restricts the result to a set of chunk IDs.
+        """
+        if not self.doc_count:
+            return []
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        matched = False
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end].astype(np.float32)
+            idf = math.log(1 + (self.doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length)
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)  # 同一個詞的 postings 中文件不重複
+            matched = True
+        if not matched:
+            return []
+        if allowed_chunk_ids is not None:
+            scores[~np.isin(self.chunk_ids, np.fromiter(allowed_chunk_ids, dtype=np.int64))] = 0
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(self.chunk_ids[i]), float(scores[i])) for i in ranked]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several ranked lists of keys with reciprocal rank fusion. Returns keys, best first.
+    """
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            fused[key] += 1.0 / (k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
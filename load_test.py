@@ -0,0 +1,515 @@
+#load_test.py 負載測試：以目標速率重播多輪 /chat 對話，報告吞吐量、延遲百分位、錯誤率和每個 worker 的記憶體。
+# 對話以 Poisson 過程開始（--rate 每秒新對話數），每個對話依序送出各輪問題，輪與輪之間有思考時間。
+# --rate 可給多個值（例如 0.5,1,2,4），逐步加壓；仍滿足 --max-p95-ms 和 --max-error-rate 的最高速率就是這個容器的容量。
+# 用法:
+#   對運行中的服務:            python load_test.py --url http://localhost:7860 --rate 1,2,4 --duration 60 --server-pid <gunicorn master pid>
+#   自行啟動 mock API 和服務:  python load_test.py --launch --rate 1,2,4,8 --duration 60 --json load_report.json
+# --launch 以 Dockerfile 的指令（gunicorn -c gunicorn.conf.py app:app）啟動服務，LLM 和嵌入呼叫改送到 mock_together.py，
+# 知識庫沿用現有的 database/ 和向量庫；查詢嵌入快取和 SESSION_DB 改用臨時檔案，不會混入 mock 的向量。
+import os
+import sys
+import json
+import math
+import time
+import shlex
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+import urllib.error
+import urllib.request
+
+# 與 utils.error_answer 的開頭相同：生成失敗時服務仍回 200，答案是這段錯誤說明
+error_answer_prefix = "An error occurred while generating the answer"
+default_server_cmd = "gunicorn -c gunicorn.conf.py app:app"
+
+# 內建的對話：有後續追問，會用到伺服器端的對話歷史
+sample_sessions = [
+    {"turns": ["The pump pressure on my 1260 keeps fluctuating. What should I check first?",
+               "I already purged it. What next?",
+               "How do I replace the outlet check valve?"]},
+    {"turns": ["What does a drifting baseline on the detector usually mean?",
+               "Could the lamp be the cause?",
+               "How many hours does the lamp last?"]},
+    {"turns": ["How do I replace the PEEK ferrule on a column fitting?",
+               "What torque should I use?"]},
+    {"turns": ["The degasser shows an error after startup. What can I do?",
+               "And if the vacuum still does not build up?",
+               "Should I call service at that point?"]},
+    {"turns": ["How often should the piston seals be replaced?"]},
+    {"turns": ["There is a leak at the pump head. How do I find where it comes from?",
+               "It is at the seal wash. Is that serious?"]},
+]
+
+
+def load_sessions(path):
+    """
+    Reads sessions from JSONL: {"turns": ["question", "follow-up", ...], "scope": {...}} per line,
+    or a plain text file where a blank line separates sessions and each line is one turn.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if content.lstrip().startswith("{"):
+        sessions = [json.loads(line) for line in content.splitlines() if line.strip()]
+    else:
+        sessions = [{"turns": [line.strip() for line in block.splitlines() if line.strip()]} for block in content.split("\n\n")]
+    return [session for session in sessions if session.get("turns")]
+
+
+# --- Requests ---
+def post_json(url, payload, timeout):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def chat_turn(base_url, message, session_id, scope, timeout, stream):
+    """
+    Sends one turn. Returns (session ID, answer, time to first token in seconds or None).
+    """
+    payload = {"message": message}
+    if session_id:
+        payload["session_id"] = session_id
+    if scope:
+        payload["scope"] = scope
+    if not stream:
+        with post_json(base_url + "/chat", payload, timeout) as response:
+            body = json.loads(response.read())
+        return body.get("session_id"), body.get("response") or "", None
+
+    started = time.perf_counter()
+    first_token = None
+    event = None
+    done = None
+    with post_json(base_url + "/chat/stream", payload, timeout) as response:
+        for raw_line in response:
+            line = raw_line.decode("utf-8").rstrip("\r\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "token" and first_token is None:
+                    first_token = time.perf_counter() - started
+                elif event == "done":
+                    done = json.loads(line[len("data: "):])
+    if done is None:
+        raise ConnectionError("stream ended without a 'done' event")
+    return done.get("session_id"), done.get("answer") or "", first_token
+
+
+def classify_error(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return f"http_{error.code}"
+    if isinstance(error, (socket.timeout, TimeoutError)) or "timed out" in str(error):
+        return "timeout"
+    return "connection"
+
+
+# --- Memory ---
+def read_memory_mb(pid):
+    """
+    (RSS, PSS) of a process in MB; PSS splits the pages shared with the preloading master, so it is the fairer
+    per-worker number. None for a value that cannot be read (process gone, or not Linux).
+    """
+    rss = pss = None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+                    break
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1]) / 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    return rss, pss
+
+
+def child_pids(parent_pid):
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # 第二欄（行程名稱）可能含空格，所以從最後一個 ')' 之後開始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[1]) == parent_pid:
+                children.append(int(name))
+        except (OSError, ValueError, IndexError):
+            continue
+    return children
+
+
+class MemorySampler:
+    """
+    Samples the memory of a server process and its worker processes (its children) in a background thread.
+    Workers that gunicorn restarts show up under their new PID.
+    """
+
+    def __init__(self, server_pid, interval=1.0):
+        self.server_pid = server_pid
+        self.interval = interval
+        self.samples = {}  # pid -> {'role', 'first', 'peak', 'last'}（RSS / PSS，MB）
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        pids = [(self.server_pid, "master")] + [(pid, "worker") for pid in child_pids(self.server_pid)]
+        for pid, role in pids:
+            rss, pss = read_memory_mb(pid)
+            if rss is None:
+                continue
+            entry = self.samples.setdefault(pid, {"role": role, "rss_first_mb": rss, "rss_peak_mb": rss, "pss_peak_mb": pss})
+            entry["rss_peak_mb"] = max(entry["rss_peak_mb"], rss)
+            if pss is not None:
+                entry["pss_peak_mb"] = max(entry["pss_peak_mb"] or 0.0, pss)
+            entry["rss_last_mb"], entry["pss_last_mb"] = rss, pss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sample()
+
+    def report(self):
+        return {str(pid): {key: round(value, 1) if isinstance(value, float) else value for key, value in entry.items()}
+                for pid, entry in sorted(self.samples.items())}
+
+
+# --- Load ---
+class LoadStep:
+    """
+    One load level: starts sessions at rate per second for duration seconds and records every turn.
+    When the time is up no new turns are sent; turns in flight still finish and count.
+    """
+
+    def __init__(self, base_url, sessions, rate, duration, think_time, timeout, stream, max_sessions, unique, rng):
+        self.base_url = base_url
+        self.sessions = sessions
+        self.rate = rate
+        self.duration = duration
+        self.think_time = think_time
+        self.timeout = timeout
+        self.stream = stream
+        self.max_sessions = max_sessions
+        self.unique = unique
+        self.rng = rng
+        self.turns = []  # {'started', 'latency', 'ttft', 'error'}
+        self.sessions_started = 0
+        self.sessions_dropped = 0
+        self.active = 0
+        self.active_samples = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _think(self):
+        # 思考時間服從指數分佈，平均 think_time 秒
+        return self.rng.expovariate(1 / self.think_time) if self.think_time > 0 else 0.0
+
+    def _run_session(self, number, session):
+        session_id = None
+        try:
+            for turn_index, message in enumerate(session["turns"]):
+                if turn_index and self._stop.wait(self._think()):
+                    return
+                if self._stop.is_set():
+                    return
+                if self.unique and turn_index == 0:
+                    message = f"{message} (load test session {number})"  # 避開語義答案快取
+                started = time.perf_counter()
+                record = {"started": started, "latency": None, "ttft": None, "error": None}
+                try:
+                    session_id, answer, record["ttft"] = chat_turn(self.base_url, message, session_id, session.get("scope"),
+                                                                   self.timeout, self.stream)
+                    if answer.startswith(error_answer_prefix):
+                        record["error"] = "error_answer"
+                except Exception as e:
+                    record["error"] = classify_error(e)
+                record["latency"] = time.perf_counter() - started
+                with self._lock:
+                    self.turns.append(record)
+                if record["error"] is not None and session_id is None:
+                    return  # 沒有 session 可以接續
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def run(self):
+        threads = []
+        started = time.perf_counter()
+        next_arrival = started
+        number = 0
+        while True:
+            now = time.perf_counter()
+            if now - started >= self.duration:
+                break
+            if now < next_arrival:
+                time.sleep(min(next_arrival - now, 0.1))
+                with self._lock:
+                    self.active_samples.append(self.active)
+                continue
+            next_arrival += self.rng.expovariate(self.rate)
+            number += 1
+            with self._lock:
+                if self.active >= self.max_sessions:
+                    self.sessions_dropped += 1
+                    continue
+                self.active += 1
+                self.sessions_started += 1
+            thread = threading.Thread(target=self._run_session, args=(number, self.rng.choice(self.sessions)), daemon=True)
+            thread.start()
+            threads.append(thread)
+        self._stop.set()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - started
+        return self.summary(started)
+
+    def summary(self, started):
+        end_of_window = started + self.duration
+        latencies = sorted(turn["latency"] for turn in self.turns if turn["error"] is None)
+        ttfts = sorted(turn["ttft"] for turn in self.turns if turn["error"] is None and turn["ttft"] is not None)
+        errors = {}
+        for turn in self.turns:
+            if turn["error"] is not None:
+                errors[turn["error"]] = errors.get(turn["error"], 0) + 1
+        completed_in_window = sum(1 for turn in self.turns if turn["error"] is None and turn["started"] + turn["latency"] <= end_of_window)
+        report = {
+            "target_sessions_per_second": self.rate,
+            "sessions_started": self.sessions_started,
+            "sessions_dropped": self.sessions_dropped,
+            "mean_active_sessions": round(statistics.mean(self.active_samples), 1) if self.active_samples else 0.0,
+            "peak_active_sessions": max(self.active_samples, default=0),
+            "turns": len(self.turns),
+            "errors": sum(errors.values()),
+            "error_rate": round(sum(errors.values()) / len(self.turns), 4) if self.turns else 0.0,
+            "errors_by_kind": errors,
+            "turns_per_second": round(completed_in_window / self.duration, 3),
+            "wall_seconds": round(self.wall_seconds, 1),
+        }
+        report.update(latency_percentiles(latencies, "latency"))
+        if ttfts:
+            report.update(latency_percentiles(ttfts, "ttft"))
+        return report
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # 最近排名法：第 ceil(fraction * n) 個值（round 的銀行家捨入會讓某些 n 偏低一個名次）
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_percentiles(sorted_seconds, name):
+    summary = {}
+    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99)):
+        value = percentile(sorted_seconds, fraction)
+        summary[f"{name}_{label}_ms"] = round(value * 1000, 1) if value is not None else None
+    summary[f"{name}_max_ms"] = round(sorted_seconds[-1] * 1000, 1) if sorted_seconds else None
+    return summary
+
+
+def passes(step_report, max_p95_ms, max_error_rate):
+    p95 = step_report.get("latency_p95_ms")
+    return (step_report["turns"] > 0 and p95 is not None and p95 <= max_p95_ms
+            and step_report["error_rate"] <= max_error_rate and step_report["sessions_dropped"] == 0)
+
+
+# --- Launch ---
+def wait_until_ready(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"The server exited during startup (exit code {process.returncode}).")
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return
+        except Exception:
+            time.sleep(0.5)
+    raise SystemExit(f"'{url}' did not answer within {timeout:g}s.")
+
+
+def launch(args, work_dir):
+    """
+    Starts mock_together.py and the app. Returns (base URL, app process, mock process, mock URL).
+    """
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_together.py")
+    mock = subprocess.Popen([sys.executable, mock_script, "--port", str(args.mock_port)] + shlex.split(args.mock_args))
+    wait_until_ready(mock_url + "/mock/stats", mock, 30)
+
+    env = dict(os.environ)
+    env.update({
+        "TOGETHER_API_BASE": mock_url + "/v1",
+        "TOGETHER_API_KEY": "mock",
+        "EMBEDDINGS_BACKEND": "together",
+        "LLM_BACKEND": "together",
+        "PORT": str(args.port),
+        "QUERY_EMBEDDING_CACHE_DB": os.path.join(work_dir, "query_embedding_cache.db"),
+    })
+    if env.get("SESSION_DB"):
+        env["SESSION_DB"] = os.path.join(work_dir, "sessions.db")
+    server = subprocess.Popen(shlex.split(args.server_cmd), env=env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_ready(base_url + "/stats", server, args.startup_timeout)
+    except SystemExit:
+        stop_process(server)
+        stop_process(mock)
+        raise
+    return base_url, server, mock, mock_url
+
+
+def stop_process(process):
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def fetch_json(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return json.loads(response.read())
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def print_step(report):
+    ttft = f", TTFT p95 {report['ttft_p95_ms']} ms" if report.get("ttft_p95_ms") is not None else ""
+    print(f"rate {report['target_sessions_per_second']:g}/s: {report['turns']} turns, {report['turns_per_second']:g} turns/s, "
+          f"{report['mean_active_sessions']:g} active sessions, p50 {report['latency_p50_ms']} ms, p95 {report['latency_p95_ms']} ms, "
+          f"p99 {report['latency_p99_ms']} ms{ttft}, errors {report['error_rate']:.2%} {report['errors_by_kind'] or ''}"
+          f"{', dropped ' + str(report['sessions_dropped']) + ' sessions' if report['sessions_dropped'] else ''} -> "
+          f"{'PASS' if report['pass'] else 'FAIL'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay multi-turn /chat sessions at a target rate and report the capacity of the app.")
+    parser.add_argument("--url", help="base URL of a running app (e.g. http://localhost:7860)")
+    parser.add_argument("--launch", action="store_true", help="start mock_together.py and the app (--server-cmd) for the test")
+    parser.add_argument("--server-cmd", default=default_server_cmd, help=f"command that starts the app with --launch (default: '{default_server_cmd}')")
+    parser.add_argument("--port", type=int, default=7861, help="port of the launched app (passed as PORT)")
+    parser.add_argument("--mock-port", type=int, default=8090)
+    parser.add_argument("--mock-args", default="", help="extra arguments for mock_together.py, e.g. '--ttft-ms 500 --tokens-per-second 30'")
+    parser.add_argument("--startup-timeout", type=float, default=180.0)
+    parser.add_argument("--server-pid", type=int, help="PID of the running app's master process, to report worker memory")
+    parser.add_argument("--sessions", help="JSONL file of sessions ({\"turns\": [...], \"scope\": {...}}); default: built-in sample sessions")
+    parser.add_argument("--rate", default="1", help="new sessions per second; several comma-separated values run as increasing steps")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per step")
+    parser.add_argument("--think-time", type=float, default=5.0, help="mean seconds between the turns of a session")
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream and also report the time to first token")
+    parser.add_argument("--unique", action="store_true", help="make every first question unique, so the semantic answer cache does not answer it")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds before a turn counts as timed out")
+    parser.add_argument("--max-sessions", type=int, default=1000, help="client-side limit of concurrent sessions")
+    parser.add_argument("--max-p95-ms", type=float, default=10000.0, help="a step passes if its p95 latency is at most this")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="and its error rate at most this")
+    parser.add_argument("--cooldown", type=float, default=5.0, help="seconds between steps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args()
+
+    if not args.url and not args.launch:
+        parser.error("give --url of a running app, or --launch")
+    rates = [float(rate) for rate in args.rate.split(",") if rate.strip()]
+    sessions = load_sessions(args.sessions) if args.sessions else sample_sessions
+    rng = random.Random(args.seed)
+
+    work_dir = tempfile.TemporaryDirectory(prefix="rag_load_test_")
+    server = mock = mock_url = None
+    base_url = args.url.rstrip("/") if args.url else None
+    server_pid = args.server_pid
+    try:
+        if args.launch:
+            base_url, server, mock, mock_url = launch(args, work_dir.name)
+            server_pid = server.pid
+        sampler = MemorySampler(server_pid) if server_pid else None
+        if sampler is not None:
+            sampler.start()
+
+        report = {"config": {
+            "url": base_url,
+            "server_cmd": args.server_cmd if args.launch else None,
+            "mock_args": args.mock_args if args.launch else None,
+            "web_concurrency": os.getenv("WEB_CONCURRENCY", "2") if args.launch else None,
+            "gunicorn_threads": os.getenv("GUNICORN_THREADS", "8") if args.launch else None,
+            "sessions": len(sessions),
+            "turns_per_session": round(statistics.mean(len(session["turns"]) for session in sessions), 2),
+            "duration": args.duration,
+            "think_time": args.think_time,
+            "stream": args.stream,
+            "unique": args.unique,
+            "max_p95_ms": args.max_p95_ms,
+            "max_error_rate": args.max_error_rate,
+        }, "steps": []}
+        print(f"--- Load test against {base_url}: {len(rates)} step(s) of {args.duration:g}s, "
+              f"{len(sessions)} session scripts, {'/chat/stream' if args.stream else '/chat'} ---")
+        for step_number, rate in enumerate(rates):
+            if step_number:
+                time.sleep(args.cooldown)
+            step = LoadStep(base_url, sessions, rate, args.duration, args.think_time, args.timeout, args.stream,
+                            args.max_sessions, args.unique, rng)
+            step_report = step.run()
+            step_report["pass"] = passes(step_report, args.max_p95_ms, args.max_error_rate)
+            report["steps"].append(step_report)
+            print_step(step_report)
+
+        if sampler is not None:
+            sampler.stop()
+            report["memory_mb"] = sampler.report()
+        report["server_stats"] = fetch_json(base_url + "/stats")
+        if mock_url:
+            report["mock_stats"] = fetch_json(mock_url + "/mock/stats")
+    finally:
+        stop_process(server)
+        stop_process(mock)
+        work_dir.cleanup()
+
+    passing = [step for step in report["steps"] if step["pass"]]
+    capacity = max(passing, key=lambda step: step["target_sessions_per_second"]) if passing else None
+    report["capacity"] = {
+        "sessions_per_second": capacity["target_sessions_per_second"],
+        "turns_per_second": capacity["turns_per_second"],
+        "concurrent_sessions": capacity["mean_active_sessions"],
+    } if capacity else None
+
+    if report.get("memory_mb"):
+        print("\nMemory (MB):")
+        for pid, entry in report["memory_mb"].items():
+            pss = f", PSS peak {entry['pss_peak_mb']}" if entry.get("pss_peak_mb") is not None else ""
+            print(f"  {entry['role']:<7}{pid:>8}: RSS {entry['rss_first_mb']} -> {entry['rss_last_mb']} (peak {entry['rss_peak_mb']}){pss}")
+    if capacity:
+        print(f"\nCapacity: {capacity['target_sessions_per_second']:g} new sessions/s, {capacity['turns_per_second']:g} turns/s, "
+              f"about {capacity['mean_active_sessions']:g} concurrent sessions "
+              f"(p95 <= {args.max_p95_ms:g} ms, errors <= {args.max_error_rate:.1%}).")
+    else:
+        print(f"\nNo step met p95 <= {args.max_p95_ms:g} ms and errors <= {args.max_error_rate:.1%}.")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_path}")
+    # 沒有任何一步達標時以非零狀態結束，方便在 CI 中當作回歸檢查
+    sys.exit(0 if capacity else 1)
+
+
+if __name__ == "__main__":
+    main()
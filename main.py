@@ -1,17 +1,16 @@
 #main.py 負責構建 RAG 鏈。
+# 導入本模組不做任何耗時的工作：langchain、chromadb、LLM 客戶端都在第一次需要時（或 preload 時）才載入和建立。
 
 import os
-import chromadb
+import time
+import threading
+from contextlib import contextmanager
+from operator import itemgetter
 from dotenv import load_dotenv
 
-from langchain_together import TogetherEmbeddings, ChatTogether
-from langchain.vectorstores import Chroma
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.documents import Document
+from kb_store import read_kb_version, read_chunks, read_documents, read_scope_chunk_ids
+from context_assembler import TokenCounter, ContextAssembler
+from metrics import stage_timer, retrieved_chunks, rerank_fallbacks, registry, get_llm_callback
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,54 +19,64 @@ load_dotenv()
 db_directory = "database"
 db_path = os.path.join(db_directory, "processed_documents.db")
 vector_db_dir = "vector_db_chroma"
+# VECTOR_BACKEND=numpy：改用 vector_db_numpy/<集合名稱> 下的 NumPy 索引（見 vector_index.py），不開啟 ChromaDB
+vector_backend = os.getenv("VECTOR_BACKEND", "chroma").lower()
+vector_index_dir = "vector_db_numpy"
+vector_index_nprobe = int(os.getenv("VECTOR_INDEX_NPROBE", "8")) # IVF 索引每次查詢搜尋的桶數
 collection_name = "my_instrument_manual_chunks"
+lexical_index_dir = os.path.join(db_directory, "lexical_index")
+retrieval_k = int(os.getenv("RETRIEVAL_K", "5")) # 最終送進 context 的 chunk 數
+hybrid_candidates = int(os.getenv("HYBRID_CANDIDATES", "10")) # 混合檢索時，向量與 BM25 各取的候選數
+rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "30")) # 啟用重排序（RERANKER）時，交給 cross-encoder 的候選數
+# 初始化失敗後，至少隔這麼多秒才重試（避免服務中斷期間每個請求都重新初始化）
+init_retry_seconds = float(os.getenv("RAG_INIT_RETRY_SECONDS", "10"))
 
-# Ensure TOGETHER_API_KEY is set
-together_api_key = os.getenv("TOGETHER_API_KEY")
-if not together_api_key:
-    # 更好的錯誤處理：直接拋出異常，應用啟動就會失敗，避免後續問題
-    raise ValueError("TOGETHER_API_KEY environment variable not set. Please set it in your .env file.")
+# --- Startup Timing ---
+# 每個載入/初始化階段的耗時（毫秒），供 bench_startup.py 和除錯使用
+startup_timings = {}
 
-# --- LLM Setup ---
-try:
-    llm = ChatTogether(
-        model="meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo", # 或您選擇的其他 Together AI 模型
-        temperature=0.3,
-        api_key=together_api_key
-    )
-    print("LLM (Together AI) Instantiation succeeded.")
-except Exception as e:
-    llm = None
-    print(f"Error instantiating LLM: {e}")
-    print("Please check your TOGETHER_API_KEY and model name.")
-
-# --- Retriever Setup ---
-embeddings_model_name = "togethercomputer/m2-bert-80M-32k-retrieval" # 必須與 setup_knowledge_base.py 中使用的模型一致
-
-try:
-    retriever_embeddings = TogetherEmbeddings(
-        model=embeddings_model_name,
-        api_key=together_api_key
-    )
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[stage] = round((time.perf_counter() - started) * 1000, 1)
 
-    # Instantiate ChromaDB client and load the collection
-    client = chromadb.PersistentClient(path=vector_db_dir)
-    vectorstore = Chroma(
-        client=client,
-        collection_name=collection_name,
-        embedding_function=retriever_embeddings # 用於將查詢嵌入
-    )
-    # Check if the collection is empty, if so, warn the user to run setup_knowledge_base.py
-    if vectorstore._collection.count() == 0:
-        print(f"Warning: ChromaDB collection '{collection_name}' is empty. Please run 'python setup_knowledge_base.py' to populate the knowledge base.")
-    
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
-    print(f"Retriever (ChromaDB) Instantiation succeeded, retrieving {retriever.search_kwargs['k']} chunks.")
+# 延遲導入的重量級模組；preload_modules() 可在 gunicorn fork 之前先導入它們
+heavy_modules = (
+    "langchain_core.runnables",
+    "langchain_core.prompts",
+    "langchain_core.output_parsers",
+    "langchain_core.documents",
+    "langchain_community.vectorstores.chroma",
+    "chromadb",
+    "numpy",
+    "backends",
+    "embedding_cache",
+    "answer_cache",
+    "lexical_index",
+    "vector_index",
+    "reranker",
+)
 
-except Exception as e:
-    retriever = None
-    print(f"Error setting up ChromaDB retriever: {e}")
-    print("Please ensure you have run 'python setup_knowledge_base.py' to create and populate the vector database.")
+def preload_modules():
+    """
+    Imports the heavy dependencies without opening any client or connection,
+    so it is safe to call in a gunicorn master before the workers are forked.
+    """
+    import importlib
+    for module_name in heavy_modules:
+        with timed(f"import {module_name}"):
+            importlib.import_module(module_name)
+    from backends import backend_modules
+    from reranker import reranker_modules
+    for module_name in dict.fromkeys(backend_modules() + reranker_modules()):
+        with timed(f"import {module_name}"):
+            importlib.import_module(module_name)
+    # tokenizer 只是記憶體中的資料，fork 之後各 worker 共用
+    with timed("load tokenizer"):
+        token_counter.count("warm up")
 
 # --- Prompt Template Setup ---
 answer_prompt = """
@@ -77,49 +86,598 @@ If there is no direct answer in the knowledge, please provide the most reasonabl
 Please ensure that your answers are logically clear, easy to understand, and directly address the user's questions.
 """
 
-# --- RAG Chain Construction ---
-rag_chain = None # 預設為 None
-if llm and retriever: # Only build the chain if both LLM and retriever were successfully initialized
-    try:
-        # format_docs 函數用於將檢索到的 LangChain Document 對象轉換為字符串
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs if hasattr(doc, 'page_content'))
-
-        # 新的 RAG 鏈結構:
-        # 1. 接收一個問題 (str)
-        # 2. 將問題傳遞給檢索器 (retriever)，獲取相關文檔
-        # 3. 將文檔格式化 (format_docs)
-        # 4. 將格式化後的文檔作為 context，原始問題作為 question，填充到 ChatPromptTemplate
-        # 5. 將填充後的 prompt 傳遞給 LLM
-        # 6. 使用 StrOutputParser() 將 LLM 輸出解析為字符串
-
-        # 修改 Prompt Template
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", answer_prompt),
-            ("user", "Context: {context}\n\nQuestion: {question}"),
-        ])
-        print("Prompt Template build success.")
-
-        rag_chain = (
-            {
-                "context": retriever | format_docs,
-                "question": RunnablePassthrough() # 這裡將接收到的輸入直接作為 'question' 傳遞
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
+# --- Token Budgets ---
+# 以模型的 tokenizer 計算 prompt 各部分的 token 數，取代固定的字符上限
+token_counter = TokenCounter()
+llm_context_tokens = int(os.getenv("LLM_CONTEXT_TOKENS", "8192"))
+answer_reserve_tokens = int(os.getenv("ANSWER_RESERVE_TOKENS", "1024"))
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+context_assembler = ContextAssembler(token_counter, token_budget=context_token_budget)
+
+def get_max_question_tokens():
+    """
+    Tokens left for the user's message once the system prompt, context, history and answer are accounted for.
+    """
+    return llm_context_tokens - answer_reserve_tokens - context_token_budget - history_token_budget - token_counter.count(answer_prompt)
+
+# --- Component State ---
+# 已成功建立的元件保存在這裡；失敗的元件留空，之後的請求會重試
+_state = {
+    "llm": None,
+    "retriever": None,
+    "retriever_embeddings": None,
+    "vector_index": None,
+    "dense_k": retrieval_k,
+    "lexical_index": None,
+    "kb_version": None,  # 目前載入的向量庫和 BM25 索引對應的知識庫版本
+    "reranker": None,
+    "answer_cache": None,
+    "generation_chain": None,
+    "rag_chain": None,
+}
+_init_lock = threading.Lock()
+_last_init_failure = {"at": None, "error": None}
+
+# --- LLM Setup ---
+def build_llm():
+    # LLM_BACKEND / EMBEDDINGS_BACKEND 選擇遠端 Together AI 或本地後端（見 backends.py）
+    from backends import create_llm, get_llm_model_name, llm_backend
+    llm = create_llm(temperature=0.3)
+    print(f"LLM ({llm_backend}: {get_llm_model_name()}) Instantiation succeeded.")
+    return llm
+
+# --- Retriever Setup ---
+def build_query_embeddings():
+    from backends import create_embeddings, get_embeddings_model_name
+    from embedding_cache import CachedEmbeddings
+
+    embeddings_model_name = get_embeddings_model_name() # 必須與 setup_knowledge_base.py 中使用的模型一致
+
+    # 查詢嵌入快取：相同（正規化後）的問題不再重新呼叫遠端嵌入模型
+    # QUERY_EMBEDDING_CACHE_DB 設為空字串即只使用記憶體快取
+    query_embedding_cache_db = os.getenv("QUERY_EMBEDDING_CACHE_DB", os.path.join(db_directory, "query_embedding_cache.db"))
+    if query_embedding_cache_db:
+        os.makedirs(os.path.dirname(query_embedding_cache_db) or ".", exist_ok=True)
+    with timed("init embeddings"):
+        retriever_embeddings = CachedEmbeddings(
+            create_embeddings(),
+            model_name=embeddings_model_name,
+            max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024")),
+            ttl_seconds=int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(24 * 3600))),
+            disk_cache_path=query_embedding_cache_db or None
+        )
+    return retriever_embeddings
+
+def build_retriever(retriever_embeddings):
+    """
+    Returns the retriever for the ChromaDB collection of the configured embedding model.
+    """
+    import chromadb
+    from langchain_community.vectorstores import Chroma
+    from backends import get_collection_name
+
+    model_collection_name = get_collection_name(collection_name)
+
+    # Instantiate ChromaDB client and load the collection
+    with timed("open chromadb"):
+        client = chromadb.PersistentClient(path=vector_db_dir)
+        vectorstore = Chroma(
+            client=client,
+            collection_name=model_collection_name,
+            embedding_function=retriever_embeddings # 用於將查詢嵌入
         )
-        print("RAG LangChain assemble success.")
+        # Check if the collection is empty, if so, warn the user to run setup_knowledge_base.py
+        if vectorstore._collection.count() == 0:
+            print(f"Warning: ChromaDB collection '{model_collection_name}' is empty. Please run 'python setup_knowledge_base.py' to populate the knowledge base.")
+
+    retriever = vectorstore.as_retriever(search_kwargs={"k": retrieval_k})
+    print(f"Retriever (ChromaDB) Instantiation succeeded, retrieving {retriever.search_kwargs['k']} chunks.")
+    return retriever
+
+def load_vector_index():
+    from backends import get_collection_name, get_embeddings_model_name
+    from vector_index import VectorIndex
+
+    index_dir = os.path.join(vector_index_dir, get_collection_name(collection_name))
+    with timed("open vector index"):
+        try:
+            vector_index = VectorIndex.load(index_dir, nprobe=vector_index_nprobe)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Vector index not found in '{index_dir}'. Please run 'VECTOR_BACKEND=numpy python setup_knowledge_base.py' to build it.")
+    if vector_index.model_name != get_embeddings_model_name():
+        raise ValueError(f"Vector index in '{index_dir}' was built with '{vector_index.model_name}', not '{get_embeddings_model_name()}'.")
+    search = f"IVF, {vector_index.nlist} lists, nprobe {vector_index.nprobe}" if vector_index.nlist else "exact search"
+    print(f"Vector index (NumPy) loaded: {vector_index.count} vectors, {vector_index.quantization}, {search}.")
+    return vector_index
+
+def build_vector_store(retriever_embeddings):
+    """
+    Returns (retriever, vector_index) for VECTOR_BACKEND: the ChromaDB retriever or the NumPy vector index (the other one is None).
+    """
+    if vector_backend == "numpy":
+        return None, load_vector_index()
+    return build_retriever(retriever_embeddings), None
+
+def build_dense_retrieval():
+    """
+    Returns (retriever_embeddings, retriever, vector_index), see build_vector_store.
+    """
+    retriever_embeddings = build_query_embeddings()
+    return (retriever_embeddings, *build_vector_store(retriever_embeddings))
+
+# --- Lexical (BM25) Index Setup ---
+# 零件編號、錯誤代碼這類精確詞彙，嵌入檢索常常匹配不好；BM25 索引在本進程內查詢，不增加遠端呼叫
+def load_lexical_index():
+    if os.getenv("HYBRID_RETRIEVAL", "1") != "1":
+        return None
+    from lexical_index import LexicalIndex
+    try:
+        lexical_index = LexicalIndex.load(lexical_index_dir)
+        print(f"Lexical (BM25) index loaded ({lexical_index.doc_count} chunks); hybrid retrieval fuses {hybrid_candidates} dense and {hybrid_candidates} lexical candidates.")
+        return lexical_index
+    except FileNotFoundError:
+        print(f"Lexical index not found in '{lexical_index_dir}', using dense retrieval only. Run 'python setup_knowledge_base.py' to build it.")
+    except Exception as e:
+        print(f"Error loading lexical index, using dense retrieval only: {e}")
+    return None
+
+def chunk_key(doc):
+    return (doc.metadata.get('source_document_id'), doc.metadata.get('chunk_index'))
+
+def chunk_document(chunk):
+    from langchain_core.documents import Document
+    metadata = {"source_document_id": chunk['source_document_id'], "chunk_index": chunk['chunk_index']}
+    for field in ("page_number", "page_end", "section", "token_count"):
+        if chunk.get(field) is not None:
+            metadata[field] = chunk[field]  # 與 ChromaDB 中保存的中繼資料一致
+    return Document(page_content=chunk['text'], metadata=metadata)
+
+def dense_search(query_vectors, allowed_chunk_ids=None):
+    """
+    Returns the dense_k nearest chunks for each query vector, as document lists aligned with query_vectors.
+    allowed_chunk_ids optionally restricts the search to those chunks (see resolve_scope).
+    """
+    from langchain_core.documents import Document
+
+    k = _state["dense_k"]
+    vector_index = _state["vector_index"]
+    if vector_index is not None:
+        hits = vector_index.search(query_vectors, k=k, allowed_chunk_ids=allowed_chunk_ids)
+        # 索引只存向量；chunk 內容從 SQLite 讀取（索引建立後被刪除的 chunk 會被略過）
+        chunks = read_chunks(db_path, list({chunk_id for query_hits in hits for chunk_id, _ in query_hits}))
+        return [[chunk_document(chunks[chunk_id]) for chunk_id, _ in query_hits if chunk_id in chunks] for query_hits in hits]
+    collection = _state["retriever"].vectorstore._collection
+
+    def query(ids=None):
+        return collection.query(query_embeddings=query_vectors, ids=ids, n_results=k, include=["documents", "metadatas"])
+
+    if allowed_chunk_ids is None:
+        results = query()
+    else:
+        ids = [str(chunk_id) for chunk_id in allowed_chunk_ids]
+        try:
+            results = query(ids)
+        except Exception as e:
+            # 範圍內有 chunk 沒有向量（導入進行中、嵌入批次失敗，或手冊被替換而範圍快取仍是舊的 ID）時
+            # Chroma 會報錯：只保留集合中實際存在的 ID 再查一次，仍然失敗就退回不限範圍的檢索
+            try:
+                ids = collection.get(ids=ids, include=[])["ids"]
+                if not ids:
+                    return [[] for _ in query_vectors]
+                results = query(ids)
+            except Exception:
+                print(f"Warning: Scoped vector search failed ({e}), searching all manuals.")
+                results = query()
+    # 導入服務替換手冊後、本進程重新載入前，舊的 HNSW 索引仍可能返回已刪除的 chunk（內容為 None），略過它們
+    return [[Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas) if text is not None]
+            for texts, metadatas in zip(results["documents"], results["metadatas"])]
+
+def fuse_with_lexical(query, dense_docs, allowed_chunk_ids=None, limit=None):
+    """
+    Returns the first `limit` (default retrieval_k) chunks for the query: the dense results fused with the BM25 results
+    by reciprocal rank fusion, or the dense results alone if there is no lexical index.
+    """
+    limit = limit or retrieval_k
+    from lexical_index import reciprocal_rank_fusion
+
+    lexical_index = _state["lexical_index"]
+    if lexical_index is None:
+        return dense_docs[:limit]
+    with stage_timer("lexical_search"):
+        lexical_hits = lexical_index.search(query, k=hybrid_candidates, allowed_chunk_ids=allowed_chunk_ids)
+    retrieved_chunks.observe(len(lexical_hits), source="lexical")
+    if not lexical_hits:
+        return dense_docs[:limit]
+
+    docs_by_key = {chunk_key(doc): doc for doc in dense_docs}
+    with stage_timer("read_chunks"):
+        lexical_chunks = read_chunks(db_path, [chunk_id for chunk_id, _ in lexical_hits])
+    lexical_keys = []
+    for chunk_id, _ in lexical_hits:
+        chunk = lexical_chunks.get(chunk_id)
+        if chunk is None:
+            continue  # 索引建立後被刪除的 chunk
+        key = (chunk['source_document_id'], chunk['chunk_index'])
+        lexical_keys.append(key)
+        docs_by_key.setdefault(key, chunk_document(chunk))
+    fused_keys = reciprocal_rank_fusion([[chunk_key(doc) for doc in dense_docs], lexical_keys])
+    return [docs_by_key[key] for key in fused_keys[:limit]]
+
+# --- Reranking ---
+# 檢索取較寬的候選集，由 cross-encoder 挑出最相關的 retrieval_k 個：context 更短更準，LLM 生成也更快（見 reranker.py）
+def build_reranker():
+    from reranker import create_reranker
+    reranker = create_reranker()
+    if reranker is not None:
+        reranker.warm_up()  # 載入模型，不讓第一個請求超出延遲預算
+        print(f"Reranker ({reranker.model_name}) Instantiation succeeded, reranking {rerank_candidates} candidates "
+              f"within {reranker.budget_seconds * 1000:g} ms.")
+    return reranker
+
+def candidate_count():
+    return max(retrieval_k, rerank_candidates) if _state["reranker"] is not None else retrieval_k
+
+def get_dense_k(lexical_index):
+    """
+    How many chunks vector search returns: enough for fusion with the BM25 hits and for the reranker.
+    """
+    dense_k = max(retrieval_k, hybrid_candidates) if lexical_index is not None else retrieval_k
+    return max(dense_k, candidate_count())
+
+def rerank_documents(query, candidates):
+    """
+    Picks the retrieval_k chunks for the prompt from the candidates with the reranker,
+    or keeps the first retrieval_k if reranking is off or over its latency budget.
+    """
+    reranker = _state["reranker"]
+    if reranker is None:
+        return candidates[:retrieval_k]
+    with stage_timer("rerank"):
+        docs, fallback = reranker.rerank(query, candidates, retrieval_k, chunk_key)
+    if fallback:
+        rerank_fallbacks.inc(reason=fallback)
+    return docs
+
+# --- Retrieval Scope ---
+# 檢索範圍（廠商、型號、手冊、章節）先在 SQLite 中解析成 chunk ID，向量和 BM25 檢索都只在這些 chunk 中進行
+scope_fields = ("vendor", "model", "document_id", "section")
+_scope_cache = {}  # (kb_version, scope) -> chunk IDs
+scope_cache_size = 256
+
+def resolve_scope(scope):
+    """
+    Returns the IDs of the chunks inside the scope, or None to search everything
+    (no scope given, or the database cannot be read).
+    """
+    if not scope:
+        return None
+    key = (get_kb_version(), tuple(sorted(scope.items())))
+    chunk_ids = _scope_cache.get(key)
+    if chunk_ids is None:
+        with stage_timer("resolve_scope"):
+            chunk_ids = read_scope_chunk_ids(db_path, scope)
+        if chunk_ids is None:
+            print(f"Warning: Could not resolve retrieval scope {scope}, searching all manuals.")
+            return None
+        if len(_scope_cache) >= scope_cache_size:
+            _scope_cache.clear()
+        _scope_cache[key] = chunk_ids
+    return chunk_ids
+
+def get_scopes():
+    """
+    The stored manuals with their vendor, model and title, for the scope selector.
+    """
+    return read_documents(db_path)
+
+def retrieve_documents(query, scope=None):
+    """
+    Returns the retrieval_k chunks for the query (vector search fused with BM25, see fuse_with_lexical,
+    then reranked if RERANKER is set), searching only the chunks inside scope if one is given.
+    """
+    maybe_reload_retrieval()
+    allowed_chunk_ids = resolve_scope(scope)
+    if allowed_chunk_ids is not None and not allowed_chunk_ids:
+        return []  # 範圍內沒有任何 chunk
+    # 分開計時：查詢嵌入（可能是遠端呼叫或快取命中）與向量搜尋
+    with stage_timer("embed_query"):
+        query_vector = _state["retriever_embeddings"].embed_query(query)
+    with stage_timer("vector_search"):
+        dense_docs = dense_search([query_vector], allowed_chunk_ids)[0]
+    retrieved_chunks.observe(len(dense_docs), source="dense")
+    return rerank_documents(query, fuse_with_lexical(query, dense_docs, allowed_chunk_ids, limit=candidate_count()))
+
+def retrieve_documents_batch(queries, scope=None):
+    """
+    Batch version of retrieve_documents: embeds all queries in one request and runs
+    vector search for all of them. Returns a list of document lists, aligned with queries.
+    """
+    maybe_reload_retrieval()
+    allowed_chunk_ids = resolve_scope(scope)
+    if not queries or (allowed_chunk_ids is not None and not allowed_chunk_ids):
+        return [[] for _ in queries]
+    with stage_timer("embed_query_batch"):
+        query_vectors = _state["retriever_embeddings"].embed_queries(queries)
+    with stage_timer("vector_search_batch"):
+        dense_results = dense_search(query_vectors, allowed_chunk_ids)
+    retrieved = []
+    for query, dense_docs in zip(queries, dense_results):
+        retrieved_chunks.observe(len(dense_docs), source="dense")
+        retrieved.append(rerank_documents(query, fuse_with_lexical(query, dense_docs, allowed_chunk_ids, limit=candidate_count())))
+    return retrieved
+
+# format_docs 函數用於將檢索到的 LangChain Document 對象轉換為字符串
+# 相鄰 chunk 合併、重疊內容去重，並按 token 預算截取
+def format_docs(docs):
+    with stage_timer("assemble_context"):
+        return context_assembler.assemble(docs)
+
+# --- Answer Cache Setup ---
+# 語義答案快取：與已回答問題足夠相似的新問題直接返回快取答案
+_kb_version = {"value": 0, "checked_at": 0.0}
+kb_version_check_interval = float(os.getenv("KB_VERSION_CHECK_INTERVAL", "5"))
+
+def get_kb_version():
+    """
+    Returns the knowledge-base version written by setup_knowledge_base.py,
+    re-reading it from SQLite at most every kb_version_check_interval seconds.
+    """
+    now = time.time()
+    if now - _kb_version["checked_at"] >= kb_version_check_interval:
+        _kb_version["value"] = read_kb_version(db_path)
+        _kb_version["checked_at"] = now
+    return _kb_version["value"]
+
+# --- Knowledge Base Hot Reload ---
+# 導入（ingest_service.py 或 setup_knowledge_base.py）完成後知識庫版本會加一。worker 在下一次檢索時發現版本變了，
+# 就在背景執行緒重新載入向量庫和 BM25 索引，載入完成前的請求繼續使用舊的元件，不會被阻塞
+_reload_lock = threading.Lock()
+_last_reload_failure = {"at": None}
+
+def maybe_reload_retrieval():
+    """
+    Starts a background reload of the retrieval components if the knowledge base has a newer version than the loaded one.
+    Never blocks: if a reload is already running, or failed less than init_retry_seconds ago, it does nothing.
+    """
+    loaded_version = _state["kb_version"]
+    if loaded_version is None:
+        return  # 尚未初始化（或元件由呼叫者自行設定，例如 benchmark_retrieval.py）
+    version = get_kb_version()
+    if version == loaded_version:
+        return
+    failed_at = _last_reload_failure["at"]
+    if failed_at is not None and time.time() - failed_at < init_retry_seconds:
+        return
+    if not _reload_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            reload_retrieval(version)
+        finally:
+            _reload_lock.release()
+
+    threading.Thread(target=run, name="kb-reload", daemon=True).start()
+
+def reload_retrieval(version=None):
+    """
+    Reloads the vector store and the lexical index for knowledge base version `version` and swaps them in.
+    The old components keep serving if loading fails. Returns True on success.
+    """
+    version = read_kb_version(db_path) if version is None else version
+    try:
+        with timed("reload retrieval"):
+            if vector_backend != "numpy":
+                # 同一進程的 ChromaDB 客戶端共用一個快取的系統實例，看不到其他進程之後寫入的向量；
+                # 清掉快取才會從磁碟重新打開（仍在使用的舊客戶端不受影響）
+                from chromadb.api.client import SharedSystemClient
+                SharedSystemClient.clear_system_cache()
+            retriever, vector_index = build_vector_store(_state["retriever_embeddings"])
+            lexical_index = load_lexical_index()
     except Exception as e:
-        rag_chain = None
-        print(f"Error assembling RAG LangChain: {e}")
-        print("Please check previous setup steps for LLM and Retriever.")
-else:
-    print("RAG LangChain could not be assembled due to LLM or Retriever initialization failure.")
+        _last_reload_failure["at"] = time.time()
+        print(f"Error reloading the knowledge base (version {version}), keeping version {_state['kb_version']}: {e}")
+        return False
+    _last_reload_failure["at"] = None
+    dense_k = get_dense_k(lexical_index)
+    _state.update(retriever=retriever, vector_index=vector_index, lexical_index=lexical_index, dense_k=dense_k, kb_version=version)
+    if _state["answer_cache"] is not None:
+        _state["answer_cache"].advance_version(version)
+    print(f"Knowledge base version {version} loaded.")
+    return True
+
+def get_loaded_kb_version():
+    """
+    The knowledge base version the answers of this process are based on (the one whose indexes are loaded).
+    Answers are cached under it, so answers from the old indexes are never cached as answers for a newer version.
+    """
+    maybe_reload_retrieval()
+    loaded_version = _state["kb_version"]
+    return get_kb_version() if loaded_version is None else loaded_version
+
+def build_answer_cache(retriever_embeddings):
+    if os.getenv("ANSWER_CACHE_ENABLED", "1") != "1":
+        return None
+    from answer_cache import SemanticAnswerCache
+    answer_cache = SemanticAnswerCache(
+        retriever_embeddings.embed_query,
+        similarity_threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97")),
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+        ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+    )
+    print(f"Semantic answer cache enabled (similarity threshold {answer_cache.similarity_threshold}).")
+    return answer_cache
+
+def get_cache_stats():
+    """
+    Returns the hit/miss counters of the caches in front of the RAG chain.
+    """
+    stats = {}
+    if _state["retriever_embeddings"] is not None:
+        stats["query_embeddings"] = _state["retriever_embeddings"].stats()
+    if _state["answer_cache"] is not None:
+        stats["answers"] = _state["answer_cache"].stats()
+    if _state["reranker"] is not None:
+        stats["rerank_scores"] = _state["reranker"].stats()
+    return stats
+
+def cache_samples(field):
+    return lambda: [({"cache": name}, cache_stats[field]) for name, cache_stats in get_cache_stats().items()]
+
+# 快取的計數器本來就在各快取物件內，/metrics 抓取時才讀取
+registry.callback("rag_cache_hits_total", "Cache hits, by cache.", cache_samples("hits"), kind="counter")
+registry.callback("rag_cache_misses_total", "Cache misses, by cache.", cache_samples("misses"), kind="counter")
+registry.callback("rag_cache_hit_ratio", "Cache hit ratio since start, by cache.", cache_samples("hit_rate"))
+registry.callback("rag_cache_entries", "Entries currently held, by cache.", cache_samples("entries"))
+
+# --- RAG Chain Construction ---
+def build_rag_chain(llm):
+    """
+    Returns (rag_chain, generation_chain). generation_chain takes {"question", "context", "history"}
+    with the context already retrieved; rag_chain retrieves first and then runs it.
+    """
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.runnables import RunnableLambda
+
+    # 新的 RAG 鏈結構:
+    # 1. 接收一個問題 (str)，或 {"question": ..., "query": ..., "history": ...}
+    # 2. 將 query（和可選的 scope）傳遞給檢索器 (retrieve_documents：向量 + BM25 混合檢索)，獲取相關文檔
+    # 3. 將文檔格式化 (format_docs)
+    # 4. 將格式化後的文檔作為 context，問題作為 question，歷史作為 history，填充到 ChatPromptTemplate
+    # 5. 將填充後的 prompt 傳遞給 LLM
+    # 6. 使用 StrOutputParser() 將 LLM 輸出解析為字符串
+
+    # 鏈的輸入可以是問題字符串，或 {"question": 新訊息, "query": 給檢索器的獨立問題, "history": 對話歷史, "scope": 檢索範圍}
+    # 只有 query 和 scope 會送給檢索器，歷史只給 LLM
+    def to_chain_input(value):
+        if isinstance(value, dict):
+            history = value.get("history") or ""
+            return {
+                "question": value["question"],
+                "query": value.get("query") or value["question"],
+                "history": f"Conversation so far:\n{history}\n\n" if history else "",
+                "scope": value.get("scope")
+            }
+        return {"question": value, "query": value, "history": "", "scope": None}
+
+    def retrieve_for_input(values):
+        return retrieve_documents(values["query"], values["scope"])
+
+    # 修改 Prompt Template
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", answer_prompt),
+        ("user", "{history}Context: {context}\n\nQuestion: {question}"),
+    ])
+    print("Prompt Template build success.")
+
+    def build_prompt(values):
+        with stage_timer("build_prompt"):
+            return prompt.invoke(values)
+
+    generation_chain = (
+        RunnableLambda(build_prompt)
+        | llm.with_config(callbacks=[get_llm_callback()]) # LLM 耗時、首個 token 延遲、token 用量
+        | StrOutputParser()
+    )
+    rag_chain = (
+        RunnableLambda(to_chain_input)
+        | {
+            "context": RunnableLambda(retrieve_for_input) | format_docs,
+            "question": itemgetter("question"),
+            "history": itemgetter("history")
+        }
+        | generation_chain
+    )
+    print("RAG LangChain assemble success.")
+    return rag_chain, generation_chain
+
+def _initialize_components():
+    if _state["llm"] is None:
+        with timed("init llm"):
+            _state["llm"] = build_llm()
+    if _state["retriever_embeddings"] is None:
+        # 先讀版本再載入：載入期間若有新的導入完成，下次檢索時會再重新載入
+        kb_version = read_kb_version(db_path)
+        with timed("init retriever"):
+            retriever_embeddings, retriever, vector_index = build_dense_retrieval()
+        with timed("load lexical index"):
+            lexical_index = load_lexical_index()
+        if _state["reranker"] is None:
+            with timed("init reranker"):
+                _state["reranker"] = build_reranker()
+        dense_k = get_dense_k(lexical_index)
+        with timed("init answer cache"):
+            answer_cache = build_answer_cache(retriever_embeddings)
+        _state.update(retriever=retriever, retriever_embeddings=retriever_embeddings, vector_index=vector_index,
+                      dense_k=dense_k, lexical_index=lexical_index, kb_version=kb_version, answer_cache=answer_cache)
+    with timed("assemble chain"):
+        rag_chain, generation_chain = build_rag_chain(_state["llm"])
+    # rag_chain 最後設定：其他執行緒以它判斷初始化是否完成
+    _state["generation_chain"] = generation_chain
+    _state["rag_chain"] = rag_chain
+
+def initialize(force=False):
+    """
+    Builds the LLM, retriever, caches and RAG chain once per process; safe to call from many threads.
+    Components that fail are retried on a later call (at most every init_retry_seconds unless force=True),
+    the ones that succeeded are kept. Returns True if the chain is ready.
+    """
+    if _state["rag_chain"] is not None:
+        return True
+    with _init_lock:
+        if _state["rag_chain"] is not None:
+            return True
+        failed_at = _last_init_failure["at"]
+        if not force and failed_at is not None and time.time() - failed_at < init_retry_seconds:
+            return False
+        try:
+            with timed("initialize"):
+                _initialize_components()
+            _last_init_failure.update(at=None, error=None)
+            return True
+        except Exception as e:
+            _last_init_failure.update(at=time.time(), error=str(e))
+            print(f"Error initializing RAG chain (will retry in {init_retry_seconds:g}s): {e}")
+            print("Please check your TOGETHER_API_KEY / LLM_BACKEND and model name, and ensure 'python setup_knowledge_base.py' ran successfully.")
+            return False
+
+def is_initialized():
+    return _state["rag_chain"] is not None
+
+def get_init_error():
+    return _last_init_failure["error"]
+
+def get_rag_chain():
+    """
+    Returns the RAG chain, building it on first use. Returns None if it cannot be built right now.
+    """
+    initialize()
+    return _state["rag_chain"]
+
+def get_generation_chain():
+    """
+    Returns the generation part of the RAG chain (prompt, LLM, parser), for callers that retrieve themselves.
+    """
+    initialize()
+    return _state["generation_chain"]
+
+def get_answer_cache():
+    initialize()
+    return _state["answer_cache"]
+
+def preload():
+    """
+    Imports the heavy modules and builds the chain now instead of on the first request.
+    """
+    preload_modules()
+    return initialize()
 
 # --- Main execution for testing (optional, for direct script run) ---
 if __name__ == "__main__":
     print("--- Running main.py for direct test ---")
+    rag_chain = get_rag_chain()
     if rag_chain:
         # Example queries for testing
         question_1 = "What are the steps for instrument calibration?"
@@ -140,4 +698,4 @@ if __name__ == "__main__":
         print("\nLLM's Answer:")
         print(response_3)
     else:
-        print("RAG chain is not available for testing. Please ensure 'setup_knowledge_base.py' has been run successfully and check API key/model setup in main.py.")
\ No newline at end of file
+        print("RAG chain is not available for testing. Please ensure 'setup_knowledge_base.py' has been run successfully and check API key/model setup in main.py.")
@@ -0,0 +1,137 @@
+#manual_metadata.py 從 PDF 手冊擷取檢索範圍用的中繼資料：廠商、型號、標題（PDF 資訊、檔名、前兩頁文字），以及目錄（outline）中的章節。
+# 猜不準的手冊可以在 input/manuals.json 中手動指定：{"檔名.pdf": {"vendor": "...", "model": "...", "title": "..."}}
+import os
+import re
+import json
+import bisect
+
+# 廠商標準名稱 -> 文件中可能出現的寫法
+vendor_aliases = {
+    "Agilent": ("agilent", "hewlett-packard", "hewlett packard"),
+    "Waters": ("waters",),
+    "Shimadzu": ("shimadzu",),
+    "Thermo Fisher": ("thermo fisher", "thermo scientific", "thermofisher", "dionex"),
+    "PerkinElmer": ("perkinelmer", "perkin elmer"),
+    "Hitachi": ("hitachi",),
+    "Jasco": ("jasco",),
+    "Knauer": ("knauer",),
+    "Gilson": ("gilson",),
+}
+# 各廠商的 HPLC 產品線型號
+model_patterns = {
+    "Agilent": re.compile(r'\b(1[12]\d0(?:\s+Infinity(?:Lab)?(?:\s+I{2,3})?)?)\b', re.IGNORECASE),
+    "Waters": re.compile(r'\b(ACQUITY\s+(?:UPLC|Arc|Premier)(?:\s+[HI]-Class)?|Alliance(?:\s+e?\d{4})?|Breeze\s*2?)\b', re.IGNORECASE),
+    "Shimadzu": re.compile(r'\b(Nexera(?:\s+(?:X2|X3|XR|XS))?|Prominence(?:-i)?|LC-\d{2,4}[A-Z]*|i-Series)\b', re.IGNORECASE),
+    "Thermo Fisher": re.compile(r'\b(Vanquish(?:\s+(?:Core|Flex|Horizon|Neo|Duo))?|UltiMate\s+3000)\b', re.IGNORECASE),
+    "Hitachi": re.compile(r'\b(Chromaster|LaChrom(?:\s+Elite|\s+Ultra)?|Primaide)\b', re.IGNORECASE),
+}
+numeric_model_vendors = {"Agilent"}
+_ALIAS = {alias: vendor for vendor, aliases in vendor_aliases.items() for alias in aliases}
+_VENDOR = re.compile(r'\b(' + "|".join(re.escape(alias) for alias in sorted(_ALIAS, key=len, reverse=True)) + r')\b', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+overrides_filename = "manuals.json"
+
+
+def clean(value):
+    return _WHITESPACE.sub(' ', str(value)).strip() if value else ""
+
+
+def detect_vendor_model(texts):
+    """
+    Returns (vendor, model) from the first text that names them, searching texts in order
+    (most trusted first). A model found without a vendor implies its vendor.
+    """
+    vendor = model = None
+    for text in texts:
+        if not text:
+            continue
+        if vendor is None:
+            match = _VENDOR.search(text)
+            if match:
+                vendor = _ALIAS[match.group(1).lower()]
+        if vendor is not None:
+            patterns = [(vendor, model_patterns[vendor])] if vendor in model_patterns else []
+        else:
+            # 純數字的型號（Agilent 1260）太容易誤判，只在已知廠商時使用
+            patterns = [(name, pattern) for name, pattern in model_patterns.items() if name not in numeric_model_vendors]
+        for candidate_vendor, pattern in patterns:
+            match = pattern.search(text)
+            if match:
+                vendor, model = candidate_vendor, clean(match.group(1))
+                break
+        if vendor and model:
+            break
+    return vendor, model
+
+
+def document_title(reader, filename):
+    try:
+        title = clean((reader.metadata or {}).get("/Title"))
+    except Exception:
+        title = ""
+    # 有些 PDF 的標題只是產生它的檔案名稱
+    if len(title) < 4 or re.search(r'\.(docx?|indd|pdf|fm)$', title, re.IGNORECASE):
+        title = clean(re.sub(r'[_-]+', ' ', os.path.splitext(filename)[0]))
+    return title
+
+
+def extract_document_metadata(reader, filename, first_pages_text=""):
+    """
+    Returns {'title', 'vendor', 'model', 'page_count'} for a PDF (vendor/model are None if not found).
+    """
+    title = document_title(reader, filename)
+    try:
+        subject = clean((reader.metadata or {}).get("/Subject"))
+    except Exception:
+        subject = ""
+    vendor, model = detect_vendor_model([title, subject, filename, first_pages_text])
+    return {"title": title, "vendor": vendor, "model": model, "page_count": len(reader.pages)}
+
+
+def outline_sections(reader):
+    """
+    Flattens the PDF outline into [(first page number, "Chapter > Section")], sorted by page (1-based).
+    Returns [] for PDFs without an outline.
+    """
+    sections = []
+
+    def walk(items, parents):
+        previous = None
+        for item in items:
+            if isinstance(item, list):
+                if previous is not None:
+                    walk(item, parents + [previous])
+                continue
+            try:
+                page_number = reader.get_destination_page_number(item) + 1
+            except Exception:
+                continue
+            previous = clean(item.title)
+            sections.append((page_number, " > ".join(parents + [previous])))
+
+    try:
+        walk(reader.outline, [])
+    except Exception as e:
+        print(f"Warning: Could not read the PDF outline: {e}")
+    sections.sort(key=lambda section: section[0])  # 穩定排序：同一頁的章節保持目錄順序
+    return sections
+
+
+def section_for_page(sections, page_number):
+    """
+    The last outline section that starts on or before the page, or None.
+    """
+    position = bisect.bisect_right([page for page, _ in sections], page_number)
+    return sections[position - 1][1] if position else None
+
+
+def load_overrides(input_dir):
+    path = os.path.join(input_dir, overrides_filename)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read '{path}', ignoring manual metadata overrides. Error: {e}")
+        return {}
@@ -0,0 +1,318 @@
+#metrics.py RAG 流程的延遲、token 數、快取命中率與錯誤計數，以 Prometheus 文字格式輸出（/metrics）。
+# 指標保存在各自的進程內：多個 gunicorn worker 時，每次抓取看到的是處理該請求的 worker。
+# TRACE_LOG=1 時，每個請求結束後印出一行 JSON，包含 trace id 與各階段耗時。
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+trace_log_enabled = os.getenv("TRACE_LOG", "0") == "1"
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.kind = "counter"
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.kind = "histogram"
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        lines = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    A gauge or counter whose samples are read from a function at scrape time,
+    e.g. the hit counters the caches already keep. fn returns [(labels dict, value)].
+    """
+
+    def __init__(self, name, documentation, fn, kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.fn = fn
+
+    def collect(self):
+        try:
+            samples = self.fn()
+        except Exception as e:
+            print(f"Warning: Could not collect metric '{self.name}': {e}")
+            return []
+        return [f"{self.name}{_format_labels(_label_key(labels))} {_format_value(value)}" for labels, value in samples]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=default_buckets):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def callback(self, name, documentation, fn, kind="gauge"):
+        with self._lock:
+            self._metrics[name] = CallbackMetric(name, documentation, fn, kind)  # 重新註冊時以新的函數為準
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+request_duration = registry.histogram("rag_request_duration_seconds", "Time to answer a chat request, by endpoint.")
+request_errors = registry.counter("rag_request_errors_total", "Chat requests that ended in an error, by endpoint.")
+stage_duration = registry.histogram("rag_stage_duration_seconds", "Time spent in each stage of the RAG chain.")
+stage_errors = registry.counter("rag_stage_errors_total", "Exceptions raised in each stage of the RAG chain.")
+llm_first_token = registry.histogram("rag_llm_time_to_first_token_seconds", "Time from LLM call to first streamed token.")
+llm_tokens = registry.counter("rag_llm_tokens_total", "Prompt and completion tokens reported by the LLM.")
+retrieved_chunks = registry.histogram("rag_retrieved_chunks", "Chunks returned by retrieval, by source.", buckets=(0, 1, 2, 5, 10, 20, 50))
+rerank_fallbacks = registry.counter("rag_rerank_fallbacks_total", "Reranks that kept the retrieval order, by reason (budget, error).")
+
+
+def render_metrics():
+    return registry.render()
+
+
+# --- Request Traces ---
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def start_trace(endpoint, trace_id=None):
+    """
+    Starts timing a request. Stage timings recorded while it is current are attached to it;
+    langchain copies the context into the threads it runs branches on, so they see the same trace.
+    """
+    trace = {"trace_id": trace_id or new_trace_id(), "endpoint": endpoint, "started": time.perf_counter(),
+             "stages": {}, "tokens": {}, "fields": {}, "error": False}
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def mark_error():
+    """
+    Marks the current request as failed (the chat endpoints still answer 200 with an error message).
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["error"] = True
+
+
+def annotate_trace(**fields):
+    """
+    Adds fields (for example answer_cache="hit") to the current request's trace line.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["fields"].update(fields)
+
+
+def finish_trace(trace, **fields):
+    """
+    Records the request duration and, with TRACE_LOG=1, prints the trace as one JSON line.
+    """
+    duration = time.perf_counter() - trace["started"]
+    error = trace["error"]
+    request_duration.observe(duration, endpoint=trace["endpoint"])
+    if error:
+        request_errors.inc(endpoint=trace["endpoint"])
+    if trace_log_enabled:
+        record = {
+            "trace_id": trace["trace_id"],
+            "endpoint": trace["endpoint"],
+            "total_ms": round(duration * 1000, 1),
+            "stages_ms": trace["stages"],
+            "tokens": trace["tokens"],
+            "error": error,
+        }
+        record.update(trace["fields"])
+        record.update(fields)
+        print(json.dumps(record))
+
+
+def record_stage(stage, seconds):
+    stage_duration.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["stages"][stage] = round(trace["stages"].get(stage, 0) + seconds * 1000, 1)
+
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+_llm_callback = None
+
+
+def get_llm_callback():
+    """
+    Returns the shared LangChain callback handler that times LLM calls and counts tokens.
+    (Defined on first use so importing this module does not import langchain.)
+    """
+    global _llm_callback
+    if _llm_callback is not None:
+        return _llm_callback
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class LLMMetricsCallback(BaseCallbackHandler):
+        """
+        Times LLM calls (total and time to first streamed token) and counts the tokens the model reports.
+        """
+
+        run_inline = True
+
+        def __init__(self):
+            self._runs = {}  # run_id -> [started, first token seen, trace]
+            self._lock = threading.Lock()
+
+        def _start(self, run_id):
+            with self._lock:
+                self._runs[run_id] = [time.perf_counter(), False, _current_trace.get()]
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._start(run_id)
+
+        def on_llm_new_token(self, token, *, run_id, **kwargs):
+            with self._lock:
+                run = self._runs.get(run_id)
+                if run is None or run[1]:
+                    return
+                run[1] = True
+            llm_first_token.observe(time.perf_counter() - run[0])
+
+        def _finish(self, run_id):
+            with self._lock:
+                run = self._runs.pop(run_id, None)
+            if run is None:
+                return None
+            seconds = time.perf_counter() - run[0]
+            stage_duration.observe(seconds, stage="llm_generate")
+            trace = run[2]
+            if trace is not None:
+                trace["stages"]["llm_generate"] = round(seconds * 1000, 1)
+            return trace
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            trace = self._finish(run_id)
+            usage = {}
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    metadata = getattr(message, "usage_metadata", None) or {}
+                    usage["prompt"] = usage.get("prompt", 0) + (metadata.get("input_tokens") or 0)
+                    usage["completion"] = usage.get("completion", 0) + (metadata.get("output_tokens") or 0)
+            if not any(usage.values()):
+                # 非聊天模型（或不回傳 usage_metadata 的版本）把用量放在 llm_output
+                token_usage = (response.llm_output or {}).get("token_usage") or {}
+                usage = {"prompt": token_usage.get("prompt_tokens", 0), "completion": token_usage.get("completion_tokens", 0)}
+            for kind, count in usage.items():
+                if count:
+                    llm_tokens.inc(count, type=kind)
+                    if trace is not None:
+                        trace["tokens"][kind] = trace["tokens"].get(kind, 0) + count
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._finish(run_id)
+            stage_errors.inc(stage="llm_generate")
+
+    _llm_callback = LLMMetricsCallback()
+    return _llm_callback
@@ -0,0 +1,204 @@
+#mock_together.py 負載測試用的 Together API 替身：相容 OpenAI 的 /v1/chat/completions（含 SSE 串流）和 /v1/embeddings，
+# 延遲、生成速度和錯誤率可調，不需要網路也不產生費用。langchain_together 的客戶端讀取 TOGETHER_API_BASE，指向這裡即可：
+#   python mock_together.py --port 8090 --ttft-ms 300 --tokens-per-second 40
+#   TOGETHER_API_BASE=http://127.0.0.1:8090/v1 TOGETHER_API_KEY=mock EMBEDDINGS_MODEL=mock-m2-bert gunicorn -c gunicorn.conf.py app:app
+# 嵌入是確定性的雜湊詞袋向量（與 backends.StubEmbeddings 相同），共享詞彙的文字向量相近，檢索結果仍有意義。
+import os
+import json
+import time
+import uuid
+import array
+import base64
+import random
+import asyncio
+import argparse
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from backends import StubEmbeddings
+
+canned_words = ("Check the inline filter and the purge valve, then flush the pump with fresh solvent. "
+                "If the pressure still fluctuates, replace the piston seals and the outlet check valve cartridge, "
+                "and verify that the degasser is switched on before restarting the method.").split()
+
+
+class MockSettings:
+    def __init__(self, ttft_ms=300.0, tokens_per_second=40.0, completion_tokens=150, embedding_latency_ms=40.0,
+                 embedding_dimensions=768, error_rate=0.0, jitter=0.2, seed=None):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.embedding_latency_ms = embedding_latency_ms
+        self.embedding_dimensions = embedding_dimensions
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+
+class MockStats:
+    """
+    Request counters of the mock, served at GET /mock/stats so a load test can check what reached the 'API'.
+    """
+
+    def __init__(self):
+        self.counts = {"chat": 0, "chat_stream": 0, "embeddings": 0, "embedded_texts": 0, "errors": 0,
+                       "prompt_tokens": 0, "completion_tokens": 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def enter(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def snapshot(self):
+        return dict(self.counts, in_flight=self.in_flight, peak_in_flight=self.peak_in_flight)
+
+
+def count_tokens(text):
+    # 粗略估算（約 4 個字元一個 token），只用於 usage 欄位
+    return max(1, (len(text) + 3) // 4)
+
+
+def completion_text(tokens):
+    return " ".join(canned_words[i % len(canned_words)] for i in range(tokens))
+
+
+def create_app(settings):
+    stats = MockStats()
+    embedder = StubEmbeddings(dimensions=settings.embedding_dimensions)
+
+    def delay(milliseconds):
+        # 每次呼叫的延遲在 ±jitter 之間隨機變化，讓結果接近真實 API 的分佈
+        return max(0.0, milliseconds / 1000 * (1 + settings.random.uniform(-settings.jitter, settings.jitter)))
+
+    def failure():
+        if settings.error_rate and settings.random.random() < settings.error_rate:
+            stats.counts["errors"] += 1
+            return JSONResponse({"error": {"message": "Mock upstream error", "type": "server_error"}}, status_code=503)
+        return None
+
+    async def chat_completions(request):
+        body = await request.json()
+        error = failure()
+        if error is not None:
+            return error
+        model = body.get("model", "mock")
+        prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in body.get("messages", []))
+        tokens = int(body.get("max_tokens") or settings.completion_tokens)
+        tokens = min(tokens, settings.completion_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": prompt_tokens + tokens}
+        stats.counts["prompt_tokens"] += prompt_tokens
+        stats.counts["completion_tokens"] += tokens
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        token_seconds = 1 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+
+        if not body.get("stream"):
+            stats.counts["chat"] += 1
+            stats.enter()
+            try:
+                await asyncio.sleep(delay(settings.ttft_ms) + tokens * token_seconds)
+            finally:
+                stats.leave()
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": completion_text(tokens)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        stats.counts["chat_stream"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta, finish_reason=None, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            payload.update(extra)
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            stats.enter()
+            try:
+                await asyncio.sleep(delay(settings.ttft_ms))
+                yield chunk({"role": "assistant", "content": ""})
+                for i in range(tokens):
+                    yield chunk({"content": (" " if i else "") + canned_words[i % len(canned_words)]})
+                    if token_seconds:
+                        await asyncio.sleep(token_seconds)
+                yield chunk({}, "stop")
+                if include_usage:
+                    yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model, 'choices': [], 'usage': usage})}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                stats.leave()
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def embeddings(request):
+        body = await request.json()
+        error = failure()
+        if error is not None:
+            return error
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        stats.counts["embeddings"] += 1
+        stats.counts["embedded_texts"] += len(texts)
+        stats.enter()
+        try:
+            await asyncio.sleep(delay(settings.embedding_latency_ms))
+        finally:
+            stats.leave()
+        vectors = embedder.embed_documents([str(text) for text in texts])
+        # openai 客戶端預設要求 base64（little-endian float32）
+        if body.get("encoding_format") == "base64":
+            vectors = [base64.b64encode(array.array("f", vector).tobytes()).decode("ascii") for vector in vectors]
+        prompt_tokens = sum(count_tokens(str(text)) for text in texts)
+        return JSONResponse({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)],
+            "model": body.get("model", "mock"),
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    async def models(request):
+        return JSONResponse({"object": "list", "data": [{"id": "mock", "object": "model"}]})
+
+    async def mock_stats(request):
+        return JSONResponse(stats.snapshot())
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/embeddings", embeddings, methods=["POST"]),
+        Route("/v1/models", models, methods=["GET"]),
+        Route("/mock/stats", mock_stats, methods=["GET"]),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Together chat and embedding APIs (OpenAI-compatible).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_TOGETHER_PORT", "8090")))
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="time to the first token of a completion")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="generation speed after the first token (0: no delay)")
+    parser.add_argument("--completion-tokens", type=int, default=150, help="tokens per answer (capped by the request's max_tokens)")
+    parser.add_argument("--embedding-latency-ms", type=float, default=40.0, help="latency of one embeddings request")
+    parser.add_argument("--embedding-dimensions", type=int, default=768, help="768 like togethercomputer/m2-bert-80M-32k-retrieval")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative random variation of the latencies")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+    settings = MockSettings(args.ttft_ms, args.tokens_per_second, args.completion_tokens, args.embedding_latency_ms,
+                            args.embedding_dimensions, args.error_rate, args.jitter, args.seed)
+    print(f"Mock Together API on http://{args.host}:{args.port}/v1 (TTFT {args.ttft_ms:g} ms, {args.tokens_per_second:g} tokens/s, "
+          f"{args.completion_tokens} tokens per answer, embeddings {args.embedding_latency_ms:g} ms, error rate {args.error_rate:g})")
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
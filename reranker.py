@@ -0,0 +1,232 @@
+#reranker.py 交叉編碼器（cross-encoder）重排序：檢索先取較寬的候選集（RERANK_CANDIDATES，預設 30），
+# 再由本地 cross-encoder 為每個 (問題, chunk) 打分，只把分數最高的 RETRIEVAL_K 個送進 prompt。
+# 分數按 (模型, 正規化後的問題, chunk) 快取；超過延遲預算（RERANK_BUDGET_MS）時退回檢索原本的順序。
+# RERANKER = none | local（Hugging Face cross-encoder，在 CPU 上執行）| stub（離線測試用的詞彙重疊分數）
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from embedding_cache import normalize_query
+
+reranker_backend = os.getenv("RERANKER", "none").lower()
+default_reranker_models = {
+    "local": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "stub": "stub-word-overlap",
+}
+
+
+def get_reranker_model_name(backend=None):
+    backend = backend or reranker_backend
+    return os.getenv("RERANKER_MODEL") or default_reranker_models.get(backend)
+
+
+def reranker_modules(backend=None):
+    """
+    The modules the reranker imports when it loads its model (for preloading).
+    """
+    return ["torch", "transformers"] if (backend or reranker_backend) == "local" else []
+
+
+class LocalCrossEncoder:
+    """
+    Scores (query, passage) pairs with a Hugging Face sequence-classification cross-encoder on the local CPU.
+    """
+
+    def __init__(self, model_name=default_reranker_models["local"], max_length=512, torch_threads=None):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.torch_threads = torch_threads
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is not None:
+                return
+            import torch
+            from transformers import AutoTokenizer, AutoModelForSequenceClassification
+            if self.torch_threads:
+                torch.set_num_threads(self.torch_threads)
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self._model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+            self._model.eval()
+            print(f"Cross-encoder reranker '{self.model_name}' loaded.")
+
+    def score(self, query, texts):
+        import torch
+        self._load()
+        encoded = self._tokenizer([query] * len(texts), texts, padding=True, truncation=True,
+                                  max_length=self.max_length, return_tensors="pt")
+        with torch.inference_mode():
+            logits = self._model(**encoded).logits
+        # ms-marco 這類模型只有一個輸出（相關性）；兩類輸出的模型取「相關」那一類的 log 機率
+        if logits.shape[-1] == 1:
+            return logits[:, 0].tolist()
+        return torch.log_softmax(logits, dim=-1)[:, -1].tolist()
+
+
+class StubCrossEncoder:
+    """
+    Deterministic offline scorer: the share of the query's words that occur in the passage.
+    latency_seconds simulates the model's time per batch.
+    """
+
+    _WORD = re.compile(r'\w+')
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+
+    def score(self, query, texts):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        query_words = set(self._WORD.findall(query.lower()))
+        scores = []
+        for text in texts:
+            words = set(self._WORD.findall(text.lower()))
+            scores.append(len(query_words & words) / len(query_words) if query_words else 0.0)
+        return scores
+
+
+class Reranker:
+    """
+    Reorders retrieved chunks by cross-encoder score.
+    Uncached pairs are scored in batches on a shared thread pool (PyTorch releases the GIL inside its kernels).
+    If scoring does not finish within budget_seconds, the candidates keep their retrieval order:
+    batches already running finish in the background and fill the cache, batches still queued are cancelled.
+    At most max_pending batches wait or run at once; past that, requests keep the retrieval order without queueing.
+    """
+
+    def __init__(self, scorer, model_name, batch_size=8, max_workers=2, budget_seconds=0.5, max_entries=8192,
+                 max_pending=None):
+        self.scorer = scorer
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget_seconds = budget_seconds
+        self.max_entries = max_entries
+        self.max_pending = max_pending or 4 * max(1, max_workers)
+        self._pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="rerank")
+        self._scores = OrderedDict()  # (model, query, chunk key) -> score
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def warm_up(self):
+        self.scorer.score("warm up", ["warm up"])
+
+    def _batch_done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _score_batch(self, query, keyed_texts):
+        scores = self.scorer.score(query, [text for _, text in keyed_texts])
+        with self._lock:
+            for (key, _), score in zip(keyed_texts, scores):
+                self._scores[key] = float(score)
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+        return scores
+
+    def rerank(self, query, candidates, top_k, key_fn):
+        """
+        Returns (the top_k candidates by score, reason): reason is None when they were reranked,
+        or 'budget' / 'overload' / 'error' when the candidates kept their retrieval order.
+        candidates are LangChain Documents; key_fn(doc) identifies a chunk.
+        """
+        if len(candidates) <= 1:
+            return candidates[:top_k], None
+        started = time.perf_counter()
+        query_key = normalize_query(query)
+        keys = [(self.model_name, query_key, key_fn(doc)) for doc in candidates]
+        scores = {}
+        missing = []
+        with self._lock:
+            for key, doc in zip(keys, candidates):
+                score = self._scores.get(key)
+                if score is None:
+                    missing.append((key, doc.page_content))
+                else:
+                    self._scores.move_to_end(key)
+                    scores[key] = score
+            self.hits += len(candidates) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            batches = [missing[start:start + self.batch_size] for start in range(0, len(missing), self.batch_size)]
+            # 執行緒池的佇列有上限：已經排滿時直接保留檢索順序，不讓積壓越來越長
+            with self._lock:
+                overloaded = self._pending > 0 and self._pending + len(batches) > self.max_pending
+                if overloaded:
+                    self.fallbacks += 1
+                else:
+                    self._pending += len(batches)
+            if overloaded:
+                return candidates[:top_k], "overload"
+            futures = [self._executor.submit(self._score_batch, query, batch) for batch in batches]
+            for future in futures:
+                future.add_done_callback(self._batch_done)
+            _, not_done = wait(futures, timeout=max(0.0, self.budget_seconds - (time.perf_counter() - started)))
+            reason = "budget" if not_done else None
+            # 超過預算時取消還在排隊的批次（已經開始的批次跑完後仍會寫入快取）
+            for future in not_done:
+                future.cancel()
+            for batch, future in zip(batches, futures):
+                if reason is not None:
+                    break
+                if future.exception() is not None:
+                    print(f"Error reranking, keeping the retrieval order: {future.exception()}")
+                    reason = "error"
+                    break
+                scores.update((key, score) for (key, _), score in zip(batch, future.result()))
+            if reason is not None:
+                with self._lock:
+                    self.fallbacks += 1
+                return candidates[:top_k], reason
+
+        order = sorted(range(len(candidates)), key=lambda i: scores[keys[i]], reverse=True)
+        return [candidates[i] for i in order[:top_k]], None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._scores),
+                "fallbacks": self.fallbacks,
+            }
+
+
+def create_reranker(backend=None):
+    """
+    Returns the Reranker for RERANKER, or None if reranking is off.
+    """
+    backend = backend or reranker_backend
+    if backend in ("", "none", "off"):
+        return None
+    model_name = get_reranker_model_name(backend)
+    max_workers = int(os.getenv("RERANK_WORKERS", "2"))
+    if backend == "local":
+        # 每個執行緒各自用一部分 CPU 核心，避免執行緒間的 intra-op 並行互相爭搶
+        scorer = LocalCrossEncoder(model_name, max_length=int(os.getenv("RERANK_MAX_LENGTH", "512")),
+                                   torch_threads=max(1, (os.cpu_count() or 1) // max(1, max_workers)))
+    elif backend == "stub":
+        scorer = StubCrossEncoder(latency_seconds=float(os.getenv("STUB_RERANK_LATENCY", "0")))
+    else:
+        raise ValueError(f"Unknown RERANKER '{backend}'. Use 'none', 'local' or 'stub'.")
+    return Reranker(
+        scorer,
+        model_name,
+        batch_size=int(os.getenv("RERANK_BATCH_SIZE", "8")),
+        max_workers=max_workers,
+        budget_seconds=float(os.getenv("RERANK_BUDGET_MS", "500")) / 1000,
+        max_entries=int(os.getenv("RERANK_CACHE_SIZE", "8192")),
+        max_pending=int(os.getenv("RERANK_MAX_PENDING", "0")) or None
+    )
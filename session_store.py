@@ -0,0 +1,197 @@
+#session_store.py 伺服器端對話 session：瀏覽器只需送 session_id 和新訊息，歷史保存在伺服器上。
+# 舊的對話輪次會被摺疊成簡短摘要，只保留最近幾輪原文，讓每輪的輸入大小保持固定。
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+
+_SENTENCE_END = re.compile(r'(?<=[.?!])\s')
+_WHITESPACE = re.compile(r'\s+')
+# 這些詞通常表示問題依賴上一輪（"what about the other one?"、"how do I fix it?"）
+_FOLLOW_UP_WORDS = {"it", "its", "this", "that", "these", "those", "they", "them", "there", "same", "also", "else", "other", "again", "instead"}
+
+
+def first_sentence(text, max_chars=200):
+    text = _WHITESPACE.sub(' ', text).strip()
+    sentence = _SENTENCE_END.split(text, maxsplit=1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars].rstrip() + "..."
+
+
+class ConversationSession:
+    """
+    One conversation: a rolling summary of older exchanges plus the most recent turns verbatim.
+    """
+
+    def __init__(self, session_id, summary="", turns=None, updated_at=None):
+        self.session_id = session_id
+        self.summary = summary
+        self.turns = turns or []  # [{'role': 'user'|'assistant', 'content': '...'}]
+        self.updated_at = updated_at or time.time()
+
+    def is_empty(self):
+        return not self.turns and not self.summary
+
+    def condensed_history(self):
+        """
+        Returns the history passed to the LLM: the summary of older exchanges and the recent turns.
+        """
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of earlier conversation:\n{self.summary}")
+        for message in self.turns:
+            if message['role'] == 'user':
+                parts.append(f"User: {message['content']}")
+            elif message['role'] == 'assistant':
+                parts.append(f"Assistant: {message['content']}")
+        return "\n".join(parts)
+
+    def standalone_query(self, message):
+        """
+        Returns the query sent to the retriever: the new message alone, or, for a short
+        follow-up that refers back to the conversation, the new message with the previous question.
+        """
+        message = message.strip()
+        previous_questions = [turn['content'] for turn in self.turns if turn['role'] == 'user']
+        if not previous_questions:
+            return message
+        words = re.findall(r"[a-z']+", message.lower())
+        if len(words) <= 6 or _FOLLOW_UP_WORDS.intersection(words):
+            return f"{first_sentence(previous_questions[-1])} {message}"
+        return message
+
+
+class SessionStore:
+    """
+    Keeps conversation sessions in memory, or in SQLite when db_path is given.
+    With SQLite every request reads the session from the database, so gunicorn workers
+    share sessions and they survive restarts; memory-only sessions need a single worker.
+    """
+
+    def __init__(self, db_path=None, window_turns=6, history_max_chars=4000, summary_max_chars=1500,
+                 ttl_seconds=24 * 3600, max_sessions=10000):
+        self.db_path = db_path
+        self.window_turns = window_turns
+        self.history_max_chars = history_max_chars
+        self.summary_max_chars = summary_max_chars
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _db(self):
+        # 連接在第一次使用時才建立；SQLite 連接不能跨 fork 共用（gunicorn preload_app），fork 後的進程各自重新連接
+        if self._conn is None or self._conn_pid != os.getpid():
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            self._conn_pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute('''
+                    CREATE TABLE IF NOT EXISTS chat_sessions (
+                        id TEXT PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        turns TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                ''')
+        return self._conn
+
+    def _load(self, session_id):
+        if self.db_path:
+            row = self._db().execute(
+                "SELECT summary, turns, updated_at FROM chat_sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            session = ConversationSession(session_id, row[0], json.loads(row[1]), row[2])
+        else:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            self._sessions.move_to_end(session_id)
+        if time.time() - session.updated_at > self.ttl_seconds:
+            return None
+        return session
+
+    def _save(self, session):
+        session.updated_at = time.time()
+        if self.db_path:
+            conn = self._db()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chat_sessions (id, summary, turns, updated_at) VALUES (?, ?, ?, ?)",
+                    (session.session_id, session.summary, json.dumps(session.turns), session.updated_at)
+                )
+        else:
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        if self.db_path:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (cutoff,))
+        else:
+            for session_id in [sid for sid, session in self._sessions.items() if session.updated_at < cutoff]:
+                del self._sessions[session_id]
+
+    def get_or_create(self, session_id=None, chat_history=None):
+        """
+        Returns the session with this ID, or a new session (with a new ID) if it is unknown or expired.
+        A new session can be seeded from a client-side chat_history, for older clients.
+        """
+        with self._lock:
+            if session_id:
+                session = self._load(session_id)
+                if session is not None:
+                    return session
+            self._purge_expired()
+            session = ConversationSession(uuid.uuid4().hex)
+            if chat_history:
+                for message in chat_history:
+                    if message.get('role') in ('user', 'assistant'):
+                        session.turns.append({'role': message['role'], 'content': message.get('content', '')})
+                self._compact(session)
+            self._save(session)
+            return session
+
+    def append_exchange(self, session, user_message, assistant_message):
+        """
+        Records one question/answer exchange and folds turns that fall out of the window into the summary.
+        """
+        with self._lock:
+            session.turns.append({'role': 'user', 'content': user_message})
+            session.turns.append({'role': 'assistant', 'content': assistant_message})
+            self._compact(session)
+            self._save(session)
+
+    def _compact(self, session):
+        # 保留最近 window_turns 輪，且原文總長不超過 history_max_chars；更早的輪次摺疊進摘要
+        while session.turns and (
+            len(session.turns) > self.window_turns * 2
+            or sum(len(turn['content']) for turn in session.turns) > self.history_max_chars
+        ):
+            if len(session.turns) <= 2:
+                break
+            folded = session.turns[:2]
+            session.turns = session.turns[2:]
+            line = " / ".join(
+                f"{'User' if turn['role'] == 'user' else 'Assistant'}: {first_sentence(turn['content'])}" for turn in folded
+            )
+            session.summary = f"{session.summary}\n{line}".strip()
+        # 摘要本身也有上限，丟掉最舊的行
+        while len(session.summary) > self.summary_max_chars and "\n" in session.summary:
+            session.summary = session.summary.split("\n", 1)[1]
+        if len(session.summary) > self.summary_max_chars:
+            session.summary = session.summary[-self.summary_max_chars:]
@@ -1,9 +1,12 @@
 #這個文件將負責所有的數據準備工作。在運行 app.py 之前，你需要先執行這個文件一次。
 import re
 import os
-import sqlite3
+import sys
+import fcntl
 import datetime
+import contextlib
 import chromadb
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 # Load environment variables from .env file
@@ -11,24 +14,35 @@ load_dotenv()
 
 from pypdf import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from together import Together
-from langchain_together import TogetherEmbeddings
-from chromadb.utils import embedding_functions
-from langchain_core.documents import Document
 
+from backends import create_embeddings, get_embeddings_model_name, get_collection_name, embeddings_backend, vector_backend
+from embedding_pipeline import embed_in_batches
+from text_normalizer import normalize_text, normalize_numbered_pages
+from context_assembler import TokenCounter, default_tokenizer_name
+from structured_chunker import iter_structured_chunks
+from kb_store import KnowledgeBaseStore, file_sha256
+from lexical_index import LexicalIndex
+from vector_index import VectorIndex
+from index_files import index_exists
+from manual_metadata import extract_document_metadata, outline_sections, section_for_page, load_overrides
 
-def extract_text_from_pdf(pdf_path):
+
+def iter_pdf_pages(pdf_path, reader=None):
     """
-    Extract all text content from PDF files.
+    Yields the text of a PDF one page at a time, so a large manual never has to be held in memory at once.
     """
-    text = ""
     try:
-        reader = PdfReader(pdf_path)
+        reader = reader or PdfReader(pdf_path)
         for page in reader.pages:
-            text += page.extract_text() + "\n"  # 提取每頁文字並換行
+            yield (page.extract_text() or "") + "\n"  # 提取每頁文字並換行
     except Exception as e:
         print(f"Error reading PDF {pdf_path}: {e}")
-    return text
+
+def extract_text_from_pdf(pdf_path):
+    """
+    Extract all text content from PDF files.
+    """
+    return "".join(iter_pdf_pages(pdf_path))
 
 def clean_text_content(text):
     """
@@ -54,102 +68,6 @@ def standardize_text_format(text):
     text = re.sub(r'\n{2,}', '\n\n', text)
     return text
 
-def create_database_table(db_path):
-    """
-    Create a SQLite database and define the table structure.
-    """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            original_filename TEXT NOT NULL UNIQUE, -- Add UNIQUE constraint
-            source_type TEXT,
-            processed_text TEXT NOT NULL,
-            processed_date TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    print(f"SQLite table 'documents' ensured in {db_path}")
-
-def create_chunks_table(db_path):
-    """
-    Create a table to store the segmented text blocks.
-    """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chunks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            chunk_index INTEGER NOT NULL,
-            chunk_content TEXT NOT NULL,
-            chunk_length INTEGER,
-            created_at TEXT,
-            UNIQUE(document_id, chunk_index), -- Ensure chunks are unique per document
-            FOREIGN KEY (document_id) REFERENCES documents(id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    print(f"SQLite table 'chunks' ensured in {db_path}")
-
-def insert_document_data(db_path, original_filename, source_type, processed_text, processed_date):
-    """
-    Insert the processed file data into the database.
-    """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    # 檢查是否已存在相同的原始文件
-    cursor.execute("SELECT id FROM documents WHERE original_filename = ?", (original_filename,))
-    existing_doc = cursor.fetchone()
-    if existing_doc:
-        print(f"Document '{original_filename}' already exists in DB (ID: {existing_doc[0]}). Skipping insertion.")
-        conn.close()
-        return existing_doc[0]
-    else:
-        cursor.execute('''
-            INSERT INTO documents (original_filename, source_type, processed_text, processed_date)
-            VALUES (?, ?, ?, ?)
-        ''', (original_filename, source_type, processed_text, processed_date))
-        conn.commit()
-        doc_id = cursor.lastrowid
-        conn.close()
-        print(f"Document '{original_filename}' saved to database: {db_path} with ID: {doc_id}")
-        return doc_id
-
-def get_document_text_from_db(db_path, document_id=None, limit=None):
-    """
-    Reads the processed text contents of one or more files from a SQLite database.
-    """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        query = "SELECT id, processed_text FROM documents"
-        params = []
-        if document_id:
-            query += " WHERE id = ?"
-            params.append(document_id)
-        if limit:
-            query += " LIMIT ?"
-            params.append(limit)
-        cursor.execute(query, params)
-        if document_id:
-            row = cursor.fetchone()
-            if row:
-                return {'id': row[0], 'processed_text': row[1]}
-            return None
-        else:
-            return [{'id': row[0], 'processed_text': row[1]} for row in cursor.fetchall()]
-    except sqlite3.Error as e:
-        print(f"Error reading from SQLite database: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-
 def chunk_text(text, chunk_size=500, chunk_overlap=100): # Adjusted chunk size and overlap for potentially smaller chunks
     """
     Splits the text using RecursiveCharacterTextSplitter.
@@ -163,213 +81,521 @@ def chunk_text(text, chunk_size=500, chunk_overlap=100): # Adjusted chunk size a
     chunks = text_splitter.create_documents([text])
     return [chunk.page_content for chunk in chunks]
 
-def insert_chunks_to_db(db_path, document_id, chunks):
+def iter_page_chunks(pages, chunk_size=500, chunk_overlap=100):
     """
-    Inserts all text blocks from the specified file into the database.
-    Checks if chunks for this document_id already exist and skips if found.
+    Splits a stream of (page number, text) pairs into (chunk, page number) pairs,
+    where the page number is the page the chunk starts on.
+    Only the unfinished last chunk of each text is carried over into the next one,
+    so chunks still run across page boundaries while memory stays bounded by the page size.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    current_time = datetime.datetime.now().isoformat()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len
+    )
+    carry, carry_page = "", None
+    for page_number, text in pages:
+        pieces = text_splitter.split_text(f"{carry} {text}" if carry else text)
+        if not pieces:
+            continue
+        # 第一塊以上一頁留下的文字開頭，算在上一頁
+        first_page = carry_page if carry else page_number
+        for i, piece in enumerate(pieces[:-1]):
+            yield piece, first_page if i == 0 else page_number
+        carry, carry_page = pieces[-1], first_page if len(pieces) == 1 else page_number
+    if carry:
+        yield carry, carry_page
+
+def iter_chunks(texts, chunk_size=500, chunk_overlap=100):
+    """
+    Splits a stream of texts (e.g. processed pages) into chunks.
+    """
+    for chunk, _ in iter_page_chunks(enumerate(texts, 1), chunk_size=chunk_size, chunk_overlap=chunk_overlap):
+        yield chunk
 
-    # Check if chunks for this document_id already exist
-    cursor.execute("SELECT COUNT(*) FROM chunks WHERE document_id = ?", (document_id,))
-    if cursor.fetchone()[0] > 0:
-        print(f"Chunks for document ID {document_id} already exist. Skipping chunk insertion.")
-        conn.close()
-        return
+def read_document_metadata(pdf_path):
+    """
+    Title, vendor, model and page count of a PDF (see manual_metadata.py), or {} if it cannot be read.
+    """
+    try:
+        reader = PdfReader(pdf_path)
+        first_pages_text = " ".join(normalize_text(page.extract_text() or "") for page in reader.pages[:2])
+        return extract_document_metadata(reader, os.path.basename(pdf_path), first_pages_text)
+    except Exception as e:
+        print(f"Error reading metadata of PDF {pdf_path}: {e}")
+        return {}
 
-    data_to_insert = []
-    for i, chunk in enumerate(chunks):
-        data_to_insert.append((document_id, i, chunk, len(chunk), current_time))
+_token_counter = None
 
-    cursor.executemany('''
-        INSERT INTO chunks (document_id, chunk_index, chunk_content, chunk_length, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', data_to_insert)
-    conn.commit()
-    conn.close()
-    print(f"Saved {len(chunks)} chunks into the database for file ID {document_id}.")
+def get_token_counter():
+    # 每個導入子進程載入一次 tokenizer
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter(chunk_tokenizer_name)
+    return _token_counter
 
-def generate_embeddings(texts, model_name="togethercomputer/m2-bert-80M-32k-retrieval"):
+def iter_structured_pdf_chunks(pages, sections, max_tokens, min_tokens):
+    """
+    Splits (page number, raw page text) pairs with the structure-aware chunker (see structured_chunker.py).
+    The section of a chunk comes from the PDF outline, or from the nearest heading in the text if the PDF has no outline.
     """
-    Generates text embeddings using Together AI's embedding model.
+    token_counter = get_token_counter()
+    heading_titles = [path.split(" > ")[-1] for _, path in sections]
+    for chunk in iter_structured_chunks(pages, token_counter, max_tokens=max_tokens, min_tokens=min_tokens, heading_titles=heading_titles):
+        section = section_for_page(sections, chunk['page_number']) if sections else chunk['heading']
+        yield {'text': chunk['text'], 'page_number': chunk['page_number'], 'page_end': chunk['page_end'],
+               'section': section, 'token_count': chunk['token_count']}
+
+def process_pdf(pdf_path, chunk_size=500, chunk_overlap=100, chunker=None, max_tokens=None, min_tokens=None):
     """
+    Streams one PDF page by page through clean, standardize and chunk.
+    Runs inside the ingest process pool, so it only returns plain data: (processed_text, chunks, metadata).
+    chunks are {'text', 'page_number', 'page_end', 'section', 'token_count'} dicts, the section coming from the PDF outline;
+    metadata holds the document's title, vendor, model and page count.
+    chunker is 'structured' (token-sized chunks along headings, lists, tables and paragraphs; chunk_size and
+    chunk_overlap are ignored) or 'recursive' (chunk_size / chunk_overlap characters); it defaults to CHUNKER.
+    """
+    chunker = chunker or default_chunker
     try:
-        embeddings_model = TogetherEmbeddings(
-            model=model_name,
-            api_key=os.getenv("TOGETHER_API_KEY")
-        )
-        vectors = embeddings_model.embed_documents(texts)
-        print(f"Successfully generated embeddings for {len(texts)} text chunks using {model_name}.")
-        return vectors
+        reader = PdfReader(pdf_path)
     except Exception as e:
-        print(f"Error generating embeddings: {e}")
-        return []
+        print(f"Error reading PDF {pdf_path}: {e}")
+        return "", [], {}
+    sections = outline_sections(reader)
+    processed_pages = []
+
+    if chunker == "structured":
+        raw_pages = []
+
+        def remember_raw(pages):
+            for page_number, page in enumerate(pages, 1):
+                raw_pages.append(page)
+                yield page_number, page
+
+        chunks = list(iter_structured_pdf_chunks(remember_raw(iter_pdf_pages(pdf_path, reader)), sections,
+                                                 max_tokens or chunk_max_tokens, min_tokens or chunk_min_tokens))
+        # documents.processed_text 仍是正規化後的全文，和 recursive 分塊時相同
+        processed_pages = [page for _, page in normalize_numbered_pages(raw_pages)]
+    elif chunker == "recursive":
+        def remember(pages):
+            for page_number, page in pages:
+                processed_pages.append(page)
+                yield page_number, page
+
+        chunks = [
+            {'text': text, 'page_number': page_number, 'page_end': None, 'section': section_for_page(sections, page_number), 'token_count': None}
+            for text, page_number in iter_page_chunks(remember(normalize_numbered_pages(iter_pdf_pages(pdf_path, reader))),
+                                                      chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        ]
+    else:
+        raise ValueError(f"Unknown CHUNKER '{chunker}'. Use 'structured' or 'recursive'.")
+    metadata = extract_document_metadata(reader, os.path.basename(pdf_path), " ".join(processed_pages[:2]))
+    return " ".join(processed_pages), chunks, metadata
 
-def get_chunks_from_db_for_embedding(db_path):
+def generate_embeddings(texts, model_name=None, batch_size=64, max_workers=4,
+                        max_retries=3, checkpoint_path=None, embed_fn=None):
     """
-    Reads all split text chunks from the SQLite database, including their IDs.
+    Generates text embeddings in batches with the configured embedding backend (or embed_fn, if given).
+    Returns a list aligned with texts; chunks of batches that kept failing are None.
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, document_id, chunk_index, chunk_content FROM chunks ORDER BY document_id, chunk_index")
-        rows = cursor.fetchall()
-        return [{'id': row[0], 'source_document_id': row[1], 'chunk_index': row[2], 'text': row[3]} for row in rows]
-    except sqlite3.Error as e:
-        print(f"Error reading chunks from SQLite database: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-
-def load_chunks_to_vector_db(chunks_data, db_path="vector_db_chroma", collection_name="document_chunks", embeddings_model_name="togethercomputer/m2-bert-80M-32k-retrieval"):
-    """
-    Loads text chunks and their embeddings into a ChromaDB vector database.
-    This function will now ADD chunks if they are new (based on their IDs).
+    model_name = model_name or get_embeddings_model_name()
+    if embed_fn is None:
+        embeddings_model = create_embeddings(model_name=model_name)
+        embed_fn = embeddings_model.embed_documents
+    vectors = embed_in_batches(
+        texts,
+        embed_fn,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        max_retries=max_retries,
+        checkpoint_path=checkpoint_path,
+        model_name=model_name
+    )
+    embedded_count = sum(1 for vector in vectors if vector is not None)
+    print(f"Successfully generated embeddings for {embedded_count} of {len(texts)} text chunks using {model_name}.")
+    return vectors
+
+def get_ids_in_collection(collection, candidate_ids, batch_size=500):
+    """
+    Returns the subset of candidate IDs that exist in a ChromaDB collection.
+    Only the candidate IDs are looked up (in batches, without documents, metadata or embeddings),
+    so the cost follows the number of candidates rather than the size of the collection.
+    """
+    existing_ids = set()
+    for start in range(0, len(candidate_ids), batch_size):
+        batch = candidate_ids[start:start + batch_size]
+        existing_ids.update(collection.get(ids=batch, include=[])['ids'])
+    return existing_ids
+
+def get_existing_vector_ids(candidate_ids, db_path="vector_db_chroma", collection_name="document_chunks", batch_size=500, vector_backend="chroma"):
     """
+    Returns the subset of candidate chunk IDs that already exist in the ChromaDB collection
+    (or, with vector_backend="numpy", in the vector index under db_path/collection_name).
+    """
+    if vector_backend == "numpy":
+        try:
+            index = VectorIndex.load(os.path.join(db_path, collection_name))
+        except FileNotFoundError:
+            return set()
+        return {str(chunk_id) for chunk_id in index.chunk_ids.tolist()} & set(candidate_ids)
     try:
         client = chromadb.PersistentClient(path=db_path)
         collection = client.get_or_create_collection(name=collection_name)
+        if collection.count() == 0:
+            return set()
+        return get_ids_in_collection(collection, candidate_ids, batch_size=batch_size)
+    except Exception as e:
+        print(f"Warning: Could not check existing IDs in ChromaDB. All candidate chunks will be embedded. Error: {e}")
+        return set()
 
-        # Check existing IDs in ChromaDB to avoid adding duplicates
-        existing_chroma_ids = set()
-        if collection.count() > 0:
-            # Fetching all existing IDs can be slow for very large collections.
-            # A more efficient approach for very large databases might involve
-            # querying a batch of IDs or checking after insertion.
-            # For now, this is simpler for demonstration.
-            try:
-                all_ids_in_chroma = collection.get(ids=collection.get()['ids'])['ids']
-                existing_chroma_ids = set(all_ids_in_chroma)
-            except Exception as e:
-                print(f"Warning: Could not retrieve all existing IDs from ChromaDB. May attempt to add duplicates. Error: {e}")
-
-
-        ids_to_add = []
-        documents_to_add = []
-        embeddings_to_add = []
-        metadatas_to_add = []
-
-        for item in chunks_data:
-            chunk_id_str = str(item['id'])
-            if chunk_id_str not in existing_chroma_ids:
-                ids_to_add.append(chunk_id_str)
-                documents_to_add.append(item['text'])
-                embeddings_to_add.append(item['embedding'])
-                metadatas_to_add.append({"source_document_id": item.get('source_document_id', 'unknown'),
-                                        "chunk_index": item.get('chunk_index', None)})
-            else:
-                print(f"Chunk ID {chunk_id_str} already exists in ChromaDB. Skipping.")
-
-        if ids_to_add:
-            collection.add(
-                embeddings=embeddings_to_add,
-                documents=documents_to_add,
-                metadatas=metadatas_to_add,
-                ids=ids_to_add
+def filter_unembedded_chunks(chunks_data, db_path="vector_db_chroma", collection_name="document_chunks", vector_backend="chroma"):
+    """
+    Drops the chunks whose IDs already have an embedding in the vector store, so only the delta is embedded.
+    """
+    candidate_ids = [str(item['id']) for item in chunks_data]
+    existing_ids = get_existing_vector_ids(candidate_ids, db_path=db_path, collection_name=collection_name, vector_backend=vector_backend)
+    return [item for item in chunks_data if str(item['id']) not in existing_ids]
+
+def chunk_metadata(item):
+    metadata = {"source_document_id": item.get('source_document_id', 'unknown'), "chunk_index": item.get('chunk_index', None)}
+    # ChromaDB 不接受 None 值，沒有頁碼或章節的 chunk 就不帶這些欄位
+    for field in ("page_number", "page_end", "section", "token_count"):
+        if item.get(field) is not None:
+            metadata[field] = item[field]
+    return metadata
+
+def load_chunks_to_vector_index(chunks_data, index_dir, embeddings_model_name, overwrite=False):
+    """
+    Adds the chunk embeddings to the NumPy vector index in index_dir (creating it if needed).
+    The index is rebuilt with the new vectors and swapped in; chunks it already has are skipped,
+    or replaced with overwrite (e.g. after re-embedding everything).
+    Returns the number of chunks written.
+    """
+    quantization = os.getenv("VECTOR_INDEX_QUANTIZATION", "int8")
+    nlist = os.getenv("VECTOR_INDEX_NLIST", "auto")
+    nlist = nlist if nlist == "auto" else int(nlist)
+    try:
+        try:
+            index = VectorIndex.load(index_dir)
+        except FileNotFoundError:
+            index = None
+        if index is not None and index.model_name != embeddings_model_name:
+            print(f"Warning: Vector index in '{index_dir}' was built with '{index.model_name}', rebuilding it for '{embeddings_model_name}'.")
+            index = None
+        items = [{**item, 'id': int(item['id'])} for item in chunks_data]
+        if index is None:
+            new_index = VectorIndex.build(items, model_name=embeddings_model_name, quantization=quantization, nlist=nlist)
+            previous_count = 0
+        else:
+            new_index = index.add(items, quantization=quantization, nlist=nlist, overwrite=overwrite)
+            previous_count = index.count
+        # 覆寫時向量數不變，寫入的是全部 items
+        added_count = len(items) if overwrite and new_index is not index else new_index.count - previous_count
+        if added_count:
+            new_index.save(index_dir)
+            ivf = f"IVF with {new_index.nlist} lists" if new_index.nlist else "exact search"
+            print(f"Successfully wrote {added_count} text chunks into the vector index '{index_dir}' "
+                  f"({new_index.count} vectors, {new_index.quantization}, {ivf}, {new_index.memory_bytes() / 1e6:.1f} MB).")
+        else:
+            print(f"No new chunks to add to the vector index '{index_dir}'.")
+        return added_count
+    except Exception as e:
+        print(f"Error loading data into the vector index: {e}")
+        return 0
+
+def load_chunks_to_vector_db(chunks_data, db_path="vector_db_chroma", collection_name="document_chunks", embeddings_model_name="togethercomputer/m2-bert-80M-32k-retrieval", batch_size=500, vector_backend="chroma", overwrite=False):
+    """
+    Loads text chunks and their embeddings into a ChromaDB vector database
+    (or, with vector_backend="numpy", into the vector index under db_path/collection_name).
+    Chunks are written in batches of batch_size; each batch only checks its own IDs
+    and upserts the ones that are new, so memory stays flat however large the collection grows.
+    With overwrite, every chunk is upserted and replaces the vector stored under its ID.
+    Returns the number of chunks written.
+    """
+    if vector_backend == "numpy":
+        return load_chunks_to_vector_index(chunks_data, os.path.join(db_path, collection_name), embeddings_model_name, overwrite=overwrite)
+    added_count = 0
+    skipped_count = 0
+    try:
+        client = chromadb.PersistentClient(path=db_path)
+        collection = client.get_or_create_collection(name=collection_name)
+        collection_is_empty = collection.count() == 0
+
+        for start in range(0, len(chunks_data), batch_size):
+            batch = chunks_data[start:start + batch_size]
+            batch_ids = [str(item['id']) for item in batch]
+            existing_ids = set() if collection_is_empty or overwrite else get_ids_in_collection(collection, batch_ids)
+            new_items = [item for item in batch if str(item['id']) not in existing_ids]
+            skipped_count += len(batch) - len(new_items)
+            if not new_items:
+                continue
+
+            collection.upsert(
+                ids=[str(item['id']) for item in new_items],
+                embeddings=[item['embedding'] for item in new_items],
+                documents=[item['text'] for item in new_items],
+                metadatas=[chunk_metadata(item) for item in new_items]
             )
-            print(f"Successfully added {len(ids_to_add)} new text chunks into ChromaDB collection '{collection_name}'.")
+            added_count += len(new_items)
+
+        if skipped_count:
+            print(f"Skipped {skipped_count} chunks that already exist in ChromaDB.")
+        if added_count:
+            print(f"Successfully wrote {added_count} text chunks into ChromaDB collection '{collection_name}'.")
         else:
             print(f"No new chunks to add to ChromaDB collection '{collection_name}'.")
 
     except Exception as e:
         print(f"Error loading data into ChromaDB: {e}")
+    return added_count
 
 
-if __name__ == "__main__":
-    # Define the directory containing your PDF files
-    pdf_input_directory = "input" # Ensure this directory exists and contains your PDFs
-    db_directory = "database"
-    db_path = os.path.join(db_directory, "processed_documents.db")
-    vector_db_dir = "vector_db_chroma"
-    collection_name = "my_instrument_manual_chunks"
-    embeddings_model_name = "togethercomputer/m2-bert-80M-32k-retrieval" # 確保與 main.py 中使用的一致
+def delete_vectors(chunk_ids, db_path="vector_db_chroma", collection_name="document_chunks", batch_size=500, vector_backend="chroma"):
+    """
+    Removes the given chunk IDs from the ChromaDB collection (or the NumPy vector index), e.g. the chunks of a replaced manual.
+    """
+    if not chunk_ids:
+        return
+    if vector_backend == "numpy":
+        index_dir = os.path.join(db_path, collection_name)
+        try:
+            index = VectorIndex.load(index_dir)
+        except FileNotFoundError:
+            return
+        new_index = index.remove(chunk_ids)
+        if new_index is not index:
+            new_index.save(index_dir)
+            print(f"Removed {index.count - new_index.count} vectors from the vector index '{index_dir}'.")
+        return
+    client = chromadb.PersistentClient(path=db_path)
+    collection = client.get_or_create_collection(name=collection_name)
+    for start in range(0, len(chunk_ids), batch_size):
+        collection.delete(ids=[str(chunk_id) for chunk_id in chunk_ids[start:start + batch_size]])
+    print(f"Removed {len(chunk_ids)} chunks from ChromaDB collection '{collection_name}'.")
+
+
+db_directory = "database"
+db_path = os.path.join(db_directory, "processed_documents.db")
+# VECTOR_BACKEND=numpy 時向量寫入 vector_db_numpy/<集合名稱> 下的 NumPy 索引，而非 ChromaDB
+vector_db_dir = "vector_db_numpy" if vector_backend == "numpy" else "vector_db_chroma"
+collection_name = get_collection_name("my_instrument_manual_chunks")
+# 已完成的嵌入批次會寫到這裡，中斷後重新執行可以從斷點繼續
+embedding_checkpoint_path = os.path.join(db_directory, "embedding_checkpoint.jsonl")
+lexical_index_dir = os.path.join(db_directory, "lexical_index")
+# 同一時間只允許一個導入（命令列和 ingest_service.py 共用）
+ingest_lock_path = os.path.join(db_directory, "ingest.lock")
+# CHUNKER=structured：按標題、清單、表格和段落切分，大小以 token 計算（CHUNK_MAX_TOKENS，太小的章節併入下一個，至少 CHUNK_MIN_TOKENS）
+# CHUNKER=recursive：舊的 500/100 字元切分。只影響之後導入的文件；要重新切分已有的手冊，請刪除資料庫後重新導入
+default_chunker = os.getenv("CHUNKER", "structured").lower()
+chunk_max_tokens = int(os.getenv("CHUNK_MAX_TOKENS", "300"))
+chunk_min_tokens = int(os.getenv("CHUNK_MIN_TOKENS", "50"))
+# 預設與 context_assembler 相同的 tokenizer，chunk 的 token_count 與 prompt 預算一致
+chunk_tokenizer_name = os.getenv("CHUNK_TOKENIZER", default_tokenizer_name)
+
+
+@contextlib.contextmanager
+def ingest_lock():
+    os.makedirs(db_directory, exist_ok=True)
+    with open(ingest_lock_path, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Another ingest is running, waiting for it to finish...")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ingest_knowledge_base(pdf_input_directory="input", incremental=True, pdf_filenames=None):
+    """
+    Brings the knowledge base up to date with the PDFs in pdf_input_directory (or only pdf_filenames, if given).
+    Manuals are identified by content hash: unchanged files are skipped, a file whose content is already stored under
+    another name is skipped, and a changed file replaces its old chunks and vectors.
+    Bumps the knowledge base version once at the end if anything changed, so serving workers reload.
+    Returns a summary dict.
+    """
+    with ingest_lock():
+        return _ingest(pdf_input_directory, incremental, pdf_filenames)
+
+
+def _ingest(pdf_input_directory, incremental_ingest, pdf_filenames):
+    embeddings_model_name = get_embeddings_model_name() # 確保與 main.py 中使用的一致（EMBEDDINGS_BACKEND / EMBEDDINGS_MODEL）
+    ingest_workers = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+    embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+    # 本地嵌入模型自己會用多個執行緒分批推理，外層不再並行
+    embedding_workers = int(os.getenv("EMBEDDING_WORKERS", "1" if embeddings_backend == "local" else "4"))
+    summary = {"new_documents": 0, "replaced_documents": 0, "unchanged_documents": 0, "duplicate_documents": 0,
+               "embedded_chunks": 0, "kb_version": None}
 
     # Create necessary directories
     os.makedirs(db_directory, exist_ok=True)
     os.makedirs(vector_db_dir, exist_ok=True)
 
     print("--- Starting knowledge base setup ---")
+    print(f"Embedding backend: {embeddings_backend} ({embeddings_model_name}), vector store: {vector_backend} ('{collection_name}')")
 
-    # 1. 確保 SQLite 表格存在
-    create_database_table(db_path)
-    create_chunks_table(db_path)
+    # 1. 確保 SQLite 表格存在（整個流程共用一個連接）
+    store = KnowledgeBaseStore(db_path)
+    store.ensure_schema()
 
     # 2. 遍歷指定目錄下的所有 PDF 文件
-    pdf_files = [f for f in os.listdir(pdf_input_directory) if f.lower().endswith('.pdf')]
-    if not pdf_files:
-        print(f"No PDF files found in '{pdf_input_directory}'. Please place your PDF documents there.")
-    
+    if pdf_filenames is None:
+        pdf_files = sorted(f for f in os.listdir(pdf_input_directory) if f.lower().endswith('.pdf'))
+        if not pdf_files:
+            print(f"No PDF files found in '{pdf_input_directory}'. Please place your PDF documents there.")
+    else:
+        pdf_files = list(pdf_filenames)
+
+    # 手動指定的廠商/型號/標題（input/manuals.json），優先於自動擷取的結果
+    manual_overrides = load_overrides(pdf_input_directory)
+    kb_changed = chunks_changed = False
+    pending_pdf_files = {}  # 檔名 -> 內容雜湊
+    replaced_pdf_files = set()
     for pdf_filename in pdf_files:
         pdf_full_path = os.path.join(pdf_input_directory, pdf_filename)
-        print(f"\n--- Processing PDF: {pdf_full_path} ---")
-
+        try:
+            content_hash = file_sha256(pdf_full_path)
+        except OSError as e:
+            print(f"Error reading PDF {pdf_full_path}: {e}")
+            continue
         # 檢查文件是否已在 documents 表中處理過
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM documents WHERE original_filename = ?", (pdf_filename,))
-        existing_doc_id = cursor.fetchone()
-        conn.close()
-
-        if existing_doc_id:
-            doc_id = existing_doc_id[0]
-            print(f"Document '{pdf_filename}' already in 'documents' table with ID: {doc_id}. Skipping PDF extraction and text processing.")
-            # Still process chunks if they aren't in 'chunks' table or ChromaDB
+        doc_id = store.get_document_id(pdf_filename)
+        if doc_id is None:
+            same_content = store.find_document_by_hash(content_hash)
+            if same_content is not None:
+                print(f"Document '{pdf_filename}' has the same content as '{same_content}'. Skipping it.")
+                summary["duplicate_documents"] += 1
+            else:
+                pending_pdf_files[pdf_filename] = content_hash
+            continue
+
+        stored_hash = store.get_document_hash(doc_id)
+        if stored_hash is None:
+            # 較早版本導入的文件沒有記錄雜湊，記下目前的內容
+            store.set_document_hash(doc_id, content_hash)
+        elif stored_hash != content_hash:
+            # 手冊的內容改變了：先移除舊的向量，再移除舊的文件和 chunks，然後重新導入
+            print(f"Document '{pdf_filename}' (ID: {doc_id}) has changed. Replacing its chunks.")
+            delete_vectors(store.get_chunk_ids(doc_id), db_path=vector_db_dir, collection_name=collection_name, vector_backend=vector_backend)
+            store.delete_document(doc_id)
+            pending_pdf_files[pdf_filename] = content_hash
+            replaced_pdf_files.add(pdf_filename)
+            summary["replaced_documents"] += 1
+            kb_changed = chunks_changed = True
+            continue
+
+        summary["unchanged_documents"] += 1
+        print(f"Document '{pdf_filename}' already in 'documents' table with ID: {doc_id}. Skipping PDF extraction and text processing.")
+        # 較早導入的文件沒有中繼資料，從 PDF 補上（chunk 的頁碼和章節要重新導入才會有）
+        if not store.has_metadata(doc_id):
+            kb_changed |= store.update_document_metadata(doc_id, read_document_metadata(pdf_full_path))
+        if pdf_filename in manual_overrides:
+            kb_changed |= store.update_document_metadata(doc_id, manual_overrides[pdf_filename])
+        # Still process chunks if they aren't in 'chunks' table or ChromaDB
+        if store.has_chunks(doc_id):
+            continue
+        processed_text = store.get_document_text(doc_id)
+        chunks = chunk_text(processed_text, chunk_size=500, chunk_overlap=100) if processed_text else [] # Re-evaluate chunk_size
+        if chunks:
+            store.save_chunks(doc_id, chunks)
+            chunks_changed = True
         else:
-            pdf_content = extract_text_from_pdf(pdf_full_path)
-            if pdf_content:
-                cleaned_text = clean_text_content(pdf_content)
-                final_processed_text = standardize_text_format(cleaned_text)
+            print(f"Document ID {doc_id} unable to split any chunks.")
+
+    # 新的 PDF 分發到進程池，每個 PDF 在子進程中逐頁串流處理（清理 -> 標準化 -> 分塊）
+    # 分塊結果直接寫入，文件和它的 chunks 在同一個事務中提交，不再從 documents 表讀回全文
+    if pending_pdf_files:
+        with ProcessPoolExecutor(max_workers=min(ingest_workers, len(pending_pdf_files))) as executor:
+            futures = {
+                executor.submit(process_pdf, os.path.join(pdf_input_directory, pdf_filename), 500, 100): pdf_filename
+                for pdf_filename in pending_pdf_files
+            }
+            for future in as_completed(futures):
+                pdf_filename = futures[future]
+                pdf_full_path = os.path.join(pdf_input_directory, pdf_filename)
+                print(f"\n--- Processed PDF: {pdf_full_path} ---")
+                try:
+                    final_processed_text, chunks, document_metadata = future.result()
+                except Exception as e:
+                    print(f"Error processing PDF {pdf_full_path}: {e}")
+                    continue
+                if not final_processed_text:
+                    print(f"No content extracted from {pdf_full_path}. Skipping document insertion for this PDF.")
+                    continue
+                if not chunks:
+                    print(f"'{pdf_filename}' unable to split any chunks.")
+
                 current_date = datetime.date.today().isoformat()
-                doc_id = insert_document_data(db_path, pdf_filename, "PDF", final_processed_text, current_date)
-            else:
-                print(f"No content extracted from {pdf_full_path}. Skipping document insertion for this PDF.")
-                continue # Move to the next PDF if no content
-
-        # 如果 doc_id 存在（無論是新插入還是已存在的），則進行分塊和嵌入處理
-        if doc_id is not None:
-            # 從 SQLite documents 表讀取並分塊，存儲到 SQLite chunks 表
-            document_from_db = get_document_text_from_db(db_path, document_id=doc_id)
-            if document_from_db:
-                full_text = document_from_db['processed_text']
-                print(f"--- Chunking document ID {doc_id} ('{pdf_filename}') ---")
-                chunks = chunk_text(full_text, chunk_size=500, chunk_overlap=100) # Re-evaluate chunk_size
-                if chunks:
-                    insert_chunks_to_db(db_path, doc_id, chunks)
-                else:
-                    print(f"Document ID {doc_id} unable to split any chunks.")
-            else:
-                print(f"Could not retrieve processed text for document ID {doc_id}.")
+                document_metadata.update(manual_overrides.get(pdf_filename, {}))
+                print(f"Manual metadata: vendor={document_metadata.get('vendor')}, model={document_metadata.get('model')}, title='{document_metadata.get('title')}'")
+                store.save_document(pdf_filename, "PDF", final_processed_text, current_date, chunks, document_metadata,
+                                    content_hash=pending_pdf_files[pdf_filename])
+                if pdf_filename not in replaced_pdf_files:
+                    summary["new_documents"] += 1
+                kb_changed = chunks_changed = True
 
     # 3. 從 SQLite chunks 表讀取所有塊並生成嵌入，載入到 ChromaDB
     # 我們需要重新從 DB 獲取所有 chunks，因為可能有多個 PDF 的 chunks
-    chunks_from_db_for_embedding = get_chunks_from_db_for_embedding(db_path)
+    chunks_from_db_for_embedding = store.get_chunks_for_embedding()
+
+    # BM25 倒排索引涵蓋全部 chunks，chunks 有變動時重建（相比嵌入，建索引只需要幾秒）
+    if chunks_from_db_for_embedding and (chunks_changed or not incremental_ingest or not index_exists(lexical_index_dir)):
+        lexical_index = LexicalIndex.build(chunks_from_db_for_embedding)
+        lexical_index.save(lexical_index_dir)
+        print(f"Lexical (BM25) index built over {lexical_index.doc_count} chunks, {len(lexical_index.term_ids)} terms, saved to {lexical_index_dir}")
+
+    if chunks_from_db_for_embedding and incremental_ingest:
+        # Only send chunks that ChromaDB does not have yet to the embedding model
+        total_chunks = len(chunks_from_db_for_embedding)
+        chunks_from_db_for_embedding = filter_unembedded_chunks(chunks_from_db_for_embedding, db_path=vector_db_dir, collection_name=collection_name, vector_backend=vector_backend)
+        print(f"\n--- Incremental ingest: {len(chunks_from_db_for_embedding)} of {total_chunks} chunks need embeddings ---")
 
     if chunks_from_db_for_embedding:
-        # Filter out chunks that already have an embedding in ChromaDB if checking was efficient
-        # For simplicity, we'll try to generate embeddings for all chunks retrieved from SQLite
-        # and let load_chunks_to_vector_db handle duplicates in ChromaDB.
         texts_to_embed = [item['text'] for item in chunks_from_db_for_embedding]
-        print(f"\n--- Generating embeddings for {len(texts_to_embed)} total chunks ---")
-        text_embeddings = generate_embeddings(texts_to_embed, model_name=embeddings_model_name)
+        print(f"\n--- Generating embeddings for {len(texts_to_embed)} chunks ---")
+        text_embeddings = generate_embeddings(
+            texts_to_embed,
+            model_name=embeddings_model_name,
+            batch_size=embedding_batch_size,
+            max_workers=embedding_workers,
+            checkpoint_path=embedding_checkpoint_path
+        )
 
-        if text_embeddings:
+        if any(vector is not None for vector in text_embeddings):
             data_for_vector_db = []
             for i, chunk_data in enumerate(chunks_from_db_for_embedding):
-                if i < len(text_embeddings):
+                if i < len(text_embeddings) and text_embeddings[i] is not None:
                     chunk_data['embedding'] = text_embeddings[i]
                     data_for_vector_db.append(chunk_data)
                 else:
-                    print(f"Warning: Missing embedding for chunk {chunk_data['id']}. Skipping this chunk for ChromaDB.")
-
-            print(f"--- Loading/Updating {len(data_for_vector_db)} chunks into ChromaDB ---")
-            load_chunks_to_vector_db(data_for_vector_db, db_path=vector_db_dir, collection_name=collection_name, embeddings_model_name=embeddings_model_name)
+                    print(f"Warning: Missing embedding for chunk {chunk_data['id']}. Skipping this chunk for the vector store.")
+
+            print(f"--- Loading/Updating {len(data_for_vector_db)} chunks into the vector store ({vector_backend}) ---")
+            # --full：重新嵌入的向量覆寫向量庫中已有的向量，否則重新嵌入的費用白花
+            loaded_count = load_chunks_to_vector_db(data_for_vector_db, db_path=vector_db_dir, collection_name=collection_name,
+                                                    embeddings_model_name=embeddings_model_name, vector_backend=vector_backend,
+                                                    overwrite=not incremental_ingest)
+            summary["embedded_chunks"] = loaded_count
+            kb_changed |= loaded_count > 0
+            if loaded_count == len(data_for_vector_db) == len(chunks_from_db_for_embedding) and os.path.exists(embedding_checkpoint_path):
+                # 全部批次都已寫入 ChromaDB，不再需要斷點文件
+                os.remove(embedding_checkpoint_path)
         else:
-            print("No embeddings generated. Skipping ChromaDB loading.")
+            print("No embeddings generated. Skipping vector store loading.")
     else:
-        print("No text chunks read from the database for embedding and loading into ChromaDB.")
+        print("No new text chunks to embed and load into the vector store.")
+
+    if kb_changed:
+        # 通知服務端知識庫已更新：worker 重新載入檢索元件，答案快取和檢索範圍隨版本失效
+        summary["kb_version"] = store.bump_kb_version()
+    store.close()
+
+    print("\n--- Knowledge base setup complete ---")
+    return summary
 
-    print("\n--- Knowledge base setup complete ---")
\ No newline at end of file
+
+if __name__ == "__main__":
+    # 增量模式：只嵌入 ChromaDB 中還沒有的 chunks。使用 --full 重新嵌入全部，並覆寫已有的向量（例如換了嵌入模型的版本）
+    ingest_knowledge_base("input", incremental="--full" not in sys.argv) # Ensure this directory exists and contains your PDFs
@@ -0,0 +1,237 @@
+#structured_chunker.py 依文件結構分塊（CHUNKER=structured）：從 PDF 每頁的原始行辨識章節標題、步驟/項目清單、表格列和段落，
+# 以 token 計算大小，在結構邊界切分。能放進一個 chunk 的清單、表格和段落不會被切開，必須切開時只切在項目、表格列或句子之間；
+# 新的章節標題開始新的 chunk，延續的 chunk 開頭重複標題（表格重複表頭）。邊界本身就是結構，不再需要字元重疊。
+import re
+from collections import Counter
+
+from text_normalizer import page_lines
+
+_LIST_ITEM = re.compile(r'^(?:\(?\d{1,2}[.)]|\(?[a-zA-Z][.)]|[•●▪◦‣∙·■□✓\-–—*])\s+\S')
+_SECTION_HEADING = re.compile(r'^(?:chapter|section|appendix|part)\s+[\dA-Z]+\b', re.IGNORECASE)
+# 「2.1 Pump」「3 Troubleshooting」是章節標題；「1. Turn off the pump」是步驟（清單）
+_NUMBERED_HEADING = re.compile(r'^\d{1,2}(?:\.\d{1,2})*\s+[A-Z]')
+_NUMBERING = re.compile(r'^[\d.]+\s+')
+_CELL_GAP = re.compile(r'\S(?: {2,}|\t+)(?=\S)')
+_SENTENCE_END = re.compile(r'[.!?:;]["\')\]]?$')
+_SENTENCE = re.compile(r'(?<=[.!?])\s+(?=["(\[]?[A-Z0-9])')
+_WHITESPACE = re.compile(r'\s+')
+_DIGITS = re.compile(r'\d+')
+_HYPHENATED = re.compile(r'[A-Za-z]-$')
+admonitions = {"note", "notes", "caution", "warning", "danger", "important", "tip", "notice"}
+heading_max_words = 10
+
+
+def normalize_title(text):
+    return _WHITESPACE.sub(' ', text).strip().casefold()
+
+
+def classify_line(line, heading_titles=()):
+    """
+    Returns 'heading', 'list', 'table' or 'text' for one line of extracted PDF text.
+    heading_titles are normalized titles from the PDF outline, which always count as headings.
+    """
+    if len(_CELL_GAP.findall(line)) >= 2:
+        return "table"
+    collapsed = _WHITESPACE.sub(' ', line)
+    if normalize_title(collapsed) in heading_titles or normalize_title(_NUMBERING.sub('', collapsed)) in heading_titles:
+        return "heading"
+    short = (len(collapsed) <= 80 and len(collapsed.split(' ')) <= heading_max_words
+             and not _SENTENCE_END.search(collapsed) and not collapsed.endswith(','))
+    if short and (_SECTION_HEADING.match(collapsed) or _NUMBERED_HEADING.match(collapsed)):
+        return "heading"
+    if _LIST_ITEM.match(collapsed):
+        return "list"
+    if short and collapsed.isupper() and sum(char.isalpha() for char in collapsed) >= 3 and collapsed.rstrip(':').casefold() not in admonitions:
+        return "heading"
+    return "text"
+
+
+def join_lines(first, second):
+    # 行尾斷字的單字接回去，其他的換行變成空格
+    if _HYPHENATED.search(first) and second[:1].islower():
+        return first[:-1] + second
+    return f"{first} {second}"
+
+
+class _Unit:
+    """
+    A heading, paragraph, list or table, with the pieces it may be split into (sentences, items or rows).
+    """
+
+    def __init__(self, kind, page_number):
+        self.kind = kind
+        self.parts = []  # [[text, first page, last page]]
+        self.first_page = self.last_page = page_number
+
+    def add_line(self, line, page_number, new_part):
+        if new_part or not self.parts:
+            self.parts.append([line, page_number, page_number])
+        else:
+            self.parts[-1][0] = join_lines(self.parts[-1][0], line)
+            self.parts[-1][2] = page_number
+        self.last_page = page_number
+
+    def text(self):
+        return "\n".join(part[0] for part in self.parts)
+
+
+class RunningLineFilter:
+    """
+    Drops running headers and footers: a page's first or last lines that, ignoring digits,
+    already appeared at the top or bottom of min_pages earlier pages.
+    """
+
+    def __init__(self, edge_lines=2, min_pages=2):
+        self.edge_lines = edge_lines
+        self.min_pages = min_pages
+        self.seen = Counter()
+
+    def filter(self, lines):
+        content = [i for i, line in enumerate(lines) if line]
+        edges = set(content[:self.edge_lines] + content[-self.edge_lines:])
+        signatures = {i: _DIGITS.sub('#', _WHITESPACE.sub(' ', lines[i]).casefold()) for i in edges}
+        kept = [line for i, line in enumerate(lines) if i not in edges or self.seen[signatures[i]] < self.min_pages]
+        self.seen.update(set(signatures.values()))
+        return kept
+
+
+def iter_units(pages, heading_titles=()):
+    """
+    Groups the lines of (page number, raw page text) pairs into headings, paragraphs, lists and tables.
+    Paragraph lines are joined until a line ends a sentence; wrapped lines of a list item stay with the item.
+    """
+    running_lines = RunningLineFilter()
+    unit = None
+    for page_number, page_text in pages:
+        for line in running_lines.filter(page_lines(page_text)):
+            if not line:
+                if unit is not None:
+                    yield unit
+                    unit = None
+                continue
+            kind = classify_line(line, heading_titles)
+            if kind == "table":
+                line = _CELL_GAP.sub(lambda match: match.group(0)[0] + " | ", line)
+            line = _WHITESPACE.sub(' ', line)
+            if kind == "text" and unit is not None and unit.kind == "list" and not _SENTENCE_END.search(unit.parts[-1][0]):
+                unit.add_line(line, page_number, new_part=False)  # 清單項目換行的部分
+                continue
+            if kind == "text" and unit is not None and unit.kind == "text":
+                unit.add_line(line, page_number, new_part=bool(_SENTENCE_END.search(unit.parts[-1][0])))
+                continue
+            if kind in ("list", "table") and unit is not None and unit.kind == kind:
+                unit.add_line(line, page_number, new_part=True)
+                continue
+            if unit is not None:
+                yield unit
+            unit = _Unit(kind, page_number)
+            unit.add_line(line, page_number, new_part=True)
+            if kind == "heading":
+                yield unit
+                unit = None
+    if unit is not None:
+        yield unit
+
+
+class _Chunk:
+    def __init__(self, carry=None, carry_tokens=0):
+        self.lines = [carry] if carry else []
+        self.carried = bool(carry)
+        self.tokens = carry_tokens
+        self.body_tokens = 0
+        self.first_page = self.last_page = None
+        self.heading = None
+
+    def add(self, text, tokens, first_page, last_page, body=True):
+        self.lines.append(text)
+        self.tokens += tokens + (1 if len(self.lines) > 1 else 0)
+        if body:
+            self.body_tokens += tokens
+        self.first_page = first_page if self.first_page is None else self.first_page
+        self.last_page = last_page
+
+
+def split_sentences(text, max_tokens, token_counter):
+    """
+    Splits text into pieces of at most max_tokens, at sentence boundaries where possible.
+    """
+    pieces = []
+    for sentence in _SENTENCE.split(text):
+        while token_counter.count(sentence) > max_tokens:
+            head = token_counter.truncate(sentence, max_tokens) or sentence[:max_tokens]
+            pieces.append(head)
+            sentence = sentence[len(head):].strip()
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def iter_structured_chunks(pages, token_counter, max_tokens=300, min_tokens=50, heading_titles=()):
+    """
+    Splits (page number, raw page text) pairs into chunks of at most about max_tokens tokens along the document structure.
+    Yields {'text', 'page_number' (first page), 'page_end' (last page), 'token_count', 'heading'}.
+    A heading closes the current chunk once it holds min_tokens; smaller sections are merged with the next one.
+    """
+    heading_titles = {normalize_title(title) for title in heading_titles}
+    heading = None
+    chunk = _Chunk()
+
+    def finish(chunk):
+        text = "\n".join(chunk.lines)
+        return {'text': text, 'page_number': chunk.first_page, 'page_end': chunk.last_page,
+                'token_count': token_counter.count(text), 'heading': chunk.heading}
+
+    def next_chunk(carry=None):
+        # 延續同一章節的 chunk 以章節標題（或表頭）開頭，檢索時才知道它屬於哪裡
+        carry_text = "\n".join(line for line in (heading, carry) if line)
+        carry_tokens = token_counter.count(carry_text) if carry_text else 0
+        if carry_tokens > max_tokens // 3:
+            return _Chunk()
+        new_chunk = _Chunk(carry_text, carry_tokens)
+        new_chunk.heading = heading
+        return new_chunk
+
+    for unit in iter_units(pages, heading_titles):
+        if unit.kind == "heading":
+            text = unit.text()
+            if chunk.body_tokens >= min_tokens:
+                yield finish(chunk)
+                chunk = _Chunk()
+            elif chunk.body_tokens == 0 and chunk.carried and len(chunk.lines) == 1:
+                chunk = _Chunk()  # 只有延續來的舊標題，換成新的標題
+            heading = text
+            chunk.heading = chunk.heading or heading
+            chunk.add(text, token_counter.count(text), unit.first_page, unit.last_page, body=False)
+            continue
+
+        unit_text = unit.text()
+        unit_tokens = token_counter.count(unit_text)
+        if chunk.tokens + unit_tokens + 1 <= max_tokens:
+            chunk.heading = chunk.heading or heading
+            chunk.add(unit_text, unit_tokens, unit.first_page, unit.last_page)
+            continue
+        if chunk.body_tokens >= min_tokens:
+            fresh_chunk = next_chunk()
+            if fresh_chunk.tokens + unit_tokens + 1 <= max_tokens:
+                # 整段放得進一個新的 chunk：不切開它
+                yield finish(chunk)
+                chunk = fresh_chunk
+                chunk.add(unit_text, unit_tokens, unit.first_page, unit.last_page)
+                continue
+
+        # 段落、清單或表格比一個 chunk 還大（或目前的 chunk 太小不該結束）：在句子、項目或表格列之間切開
+        header = unit.parts[0][0] if unit.kind == "table" and len(unit.parts) > 1 else None
+        for position, (part_text, first_page, last_page) in enumerate(unit.parts):
+            pieces = [part_text] if unit.kind != "text" else []
+            if unit.kind == "text" or token_counter.count(part_text) > max_tokens // 2:
+                pieces = split_sentences(part_text, max_tokens // 2, token_counter)
+            for piece in pieces:
+                piece_tokens = token_counter.count(piece)
+                if chunk.tokens + piece_tokens + 1 > max_tokens and chunk.body_tokens:
+                    yield finish(chunk)
+                    chunk = next_chunk(header if position > 0 else None)
+                chunk.heading = chunk.heading or heading
+                chunk.add(piece, piece_tokens, first_page, last_page)
+
+    if chunk.body_tokens:
+        yield finish(chunk)
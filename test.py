@@ -1,13 +1,12 @@
-from langchain_together import TogetherEmbeddings
+from backends import create_embeddings, get_embeddings_model_name, embeddings_backend
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-emb = TogetherEmbeddings(
-    model="togethercomputer/m2-bert-80M-32k-retrieval",
-    api_key=os.getenv("TOGETHER_API_KEY")
-)
+# EMBEDDINGS_BACKEND=local 時完全在本機執行，不需要 API key
+emb = create_embeddings()
+print(f"Backend: {embeddings_backend} ({get_embeddings_model_name()})")
 print(emb.embed_documents(["Hello world"]))
 
 
@@ -0,0 +1,69 @@
+#test_normalizer.py text_normalizer 的黃金輸出測試：每個輸入的結果都必須與舊的正則鏈（setup_knowledge_base.py）完全一致。
+# 執行: python test_normalizer.py   或: python -m pytest test_normalizer.py
+# 速度比較見 bench_normalizer.py，它也使用這裡的輸入。
+import random
+
+from setup_knowledge_base import clean_text_content, standardize_text_format
+from text_normalizer import normalize_text
+
+# Golden inputs covering every rule of the old chain
+GOLDEN_CASES = [
+    "",
+    "   \n\n  ",
+    "Pump pressure fluctuates.check the degasser.Then purge the line",
+    "Replace the PEEK ferrule?Yes! Tighten it by hand",
+    "Baseline drift\n\n\n   \n12\nis usually caused by temperature changes. 34\n",
+    "7\nColumn oven\n  8  \n9",
+    "See step 3\nNext, flush the column 42   \nwith 100% methanol",
+    "Copyright © 2021 Agilent Technologies, Inc. All Rights Reserved. Manual starts here.",
+    "Header\nConfidential and Proprietary Information of Waters Corp.\nBody text.",
+    "Disclaimer: the information in this document is subject to change. Keep reading.",
+    "Disclaimer: starts here Copyright © 2020 Acme. All Rights Reserved. and ends here.",
+    "hyphen-\nated word and a tab\tseparated value",
+    "Error E-101.Leak detected!Check fitting A-12",
+    "Ends with a page number\n\n\n101\n",
+]
+
+
+def legacy_normalize(text):
+    return standardize_text_format(clean_text_content(text))
+
+
+def random_page(rng):
+    words = ["pump", "Seal", "leak", "Column", "pressure", "12", "7", "E-101", "PEEK", "ferrule", "Check", "flow"]
+    separators = [" ", " ", " ", "\n", "\n\n", ". ", "? ", "!", "  \n  ", "\t"]
+    parts = []
+    for _ in range(rng.randint(200, 400)):
+        parts.append(rng.choice(words))
+        parts.append(rng.choice(separators))
+    if rng.random() < 0.3:
+        parts.append("\nCopyright © 2020 Acme Instruments. All Rights Reserved.\n")
+    if rng.random() < 0.3:
+        parts.append("Confidential and Proprietary Information of Acme\n")
+    if rng.random() < 0.3:
+        parts.append("Disclaimer: subject to change without notice.\n")
+    parts.append(f"\n{rng.randint(1, 999)}\n")  # 頁碼
+    return "".join(parts)
+
+
+def assert_matches_legacy(case):
+    expected = legacy_normalize(case)
+    actual = normalize_text(case)
+    assert actual == expected, f"{case[:80]!r}\n  legacy:     {expected[:120]!r}\n  normalizer: {actual[:120]!r}"
+
+
+def test_golden_cases():
+    for case in GOLDEN_CASES:
+        assert_matches_legacy(case)
+
+
+def test_random_pages():
+    rng = random.Random(42)
+    for _ in range(200):
+        assert_matches_legacy(random_page(rng))
+
+
+if __name__ == "__main__":
+    test_golden_cases()
+    test_random_pages()
+    print(f"text_normalizer matches the legacy chain on {len(GOLDEN_CASES)} golden cases and 200 random pages.")
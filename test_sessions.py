@@ -0,0 +1,60 @@
+#test_sessions.py 檢查多個 gunicorn worker 共用對話 session：追問落到另一個 worker 時，歷史仍然在。
+# 每個「worker」是一個獨立進程：先執行 gunicorn.conf.py（與 gunicorn master 相同），再導入 utils 的 session_store。
+# 執行: python test_sessions.py   或: python -m pytest test_sessions.py
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+worker_script = """
+import sys, json, runpy
+runpy.run_path("gunicorn.conf.py")
+from utils import session_store
+step, session_id = sys.argv[1], sys.argv[2] or None
+session = session_store.get_or_create(session_id)
+if step == "first":
+    session_store.append_exchange(session, "Why is the pump pressure unstable?", "Check the check valves for air bubbles.")
+print(json.dumps({"session_id": session.session_id, "turns": session.turns, "db_path": session_store.db_path}))
+"""
+
+
+def run_worker(work_dir, step, session_id="", extra_env=None):
+    env = {key: value for key, value in os.environ.items() if key not in ("SESSION_DB", "WEB_CONCURRENCY")}
+    env.update({"PYTHONPATH": repo_dir, "RAG_PRELOAD": "0"})
+    env.update(extra_env or {})
+    # 在臨時目錄裡執行，預設的 database/sessions.db 不會寫進專案
+    shutil.copy(os.path.join(repo_dir, "gunicorn.conf.py"), work_dir)
+    output = subprocess.run([sys.executable, "-c", worker_script, step, session_id], cwd=work_dir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_follow_up_on_another_worker_keeps_history():
+    with tempfile.TemporaryDirectory() as work_dir:
+        first = run_worker(work_dir, "first")
+        assert first["db_path"] == os.path.join("database", "sessions.db")
+        follow_up = run_worker(work_dir, "follow_up", first["session_id"])
+        assert follow_up["session_id"] == first["session_id"]
+        assert [turn["role"] for turn in follow_up["turns"]] == ["user", "assistant"]
+
+
+def test_explicit_session_db_is_kept():
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, "shared.db")
+        assert run_worker(work_dir, "first", extra_env={"SESSION_DB": db_path})["db_path"] == db_path
+
+
+def test_single_worker_keeps_sessions_in_memory():
+    with tempfile.TemporaryDirectory() as work_dir:
+        assert run_worker(work_dir, "first", extra_env={"WEB_CONCURRENCY": "1"})["db_path"] is None
+
+
+if __name__ == "__main__":
+    test_follow_up_on_another_worker_keeps_history()
+    test_explicit_session_db_is_kept()
+    test_single_worker_keeps_sessions_in_memory()
+    print("Sessions are shared across workers.")
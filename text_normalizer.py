@@ -0,0 +1,69 @@
+#text_normalizer.py 提供預編譯、合併後的文字正規化，取代 clean_text_content + standardize_text_format 的正則鏈。
+import re
+
+# 只保留真正會改變結果的步驟，且全部預先編譯。
+# 原正則鏈中：
+#   - '\n\s*\n' -> '\n\n' 只改變空白的寫法，不影響後面逐行規則的匹配，最後空白又會被統一壓縮；
+#   - standardize_text_format 裡所有 '\n' 規則都在換行已被壓縮成空格之後執行，不會有任何作用；
+#   - '([.?!])\s*([A-Z])' -> '\1  \2' 之後緊接 '\s+' 壓縮，等價於在單一空格的文字上補一個空格。
+_STANDALONE_NUMBER_LINE = re.compile(r'^\s*\d+\s*$', flags=re.MULTILINE)
+_TRAILING_NUMBER = re.compile(r'\s+\d+\s*$', flags=re.MULTILINE)
+_COPYRIGHT = re.compile(r'Copyright © \d{4} [^\n]*\. All Rights Reserved\.', flags=re.IGNORECASE)
+_CONFIDENTIAL = re.compile(r'Confidential and Proprietary Information[^\n]*', flags=re.IGNORECASE)
+_DISCLAIMER = re.compile(r'Disclaimer:[^.]*\.', flags=re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_SENTENCE_BREAK = re.compile(r'([.?!]) ?([A-Z])')
+_PAGE_LABEL_LINE = re.compile(r'^\s*(?:page\s+)?\d+(?:\s*(?:/|of)\s*\d+)?\s*$', flags=re.MULTILINE | re.IGNORECASE)
+
+# 這些規則必須依序執行：前一步刪除的內容可能讓下一步產生新的匹配
+_REMOVALS = (_STANDALONE_NUMBER_LINE, _TRAILING_NUMBER, _COPYRIGHT, _CONFIDENTIAL, _DISCLAIMER)
+
+
+def normalize_text(text):
+    """
+    Produces exactly the same output as standardize_text_format(clean_text_content(text)),
+    with precompiled patterns and without the passes that cannot change the result.
+    """
+    for pattern in _REMOVALS:
+        text = pattern.sub('', text)
+    text = _WHITESPACE.sub(' ', text).strip()
+    return _SENTENCE_BREAK.sub(r'\1 \2', text)
+
+
+def normalize_pages(pages):
+    """
+    Normalizes page texts one at a time, skipping pages left empty.
+    Joining the results with a single space matches normalizing the whole document,
+    except for a 'Disclaimer:' sentence that runs across a page break.
+    """
+    for _, normalized in normalize_numbered_pages(pages):
+        yield normalized
+
+
+def normalize_numbered_pages(pages):
+    """
+    Same as normalize_pages, but yields (page number, text) pairs; pages are numbered from 1, counting the skipped ones.
+    """
+    for page_number, page_text in enumerate(pages, 1):
+        normalized = normalize_text(page_text)
+        if normalized:
+            yield page_number, normalized
+
+
+def page_lines(page_text):
+    """
+    Splits a page into lines with the same boilerplate removed as normalize_text (page numbers such as '12',
+    'Page 12' or '12 of 80', copyright, confidentiality and disclaimer notices), but keeps the line structure
+    and the spacing inside lines that normalize_text flattens. Runs of blank lines become a single '' (a paragraph break).
+    Trailing numbers are kept: in a table row or a step they are content.
+    """
+    for pattern in (_PAGE_LABEL_LINE, _COPYRIGHT, _CONFIDENTIAL, _DISCLAIMER):
+        page_text = pattern.sub('', page_text)
+    lines = []
+    for line in page_text.split('\n'):
+        line = line.strip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines
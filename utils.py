@@ -1,64 +1,453 @@
 #主要從 main導入路徑
-from main import rag_chain  # 確保你有 __init__.py 或 main.py 是可引用的模組
-import gradio as gr
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+# main 只在第一次請求（或 preload）時才建立 RAG 鏈，導入本身很快
+from main import get_rag_chain, get_generation_chain, get_answer_cache, is_initialized, get_loaded_kb_version, token_counter, history_token_budget, get_max_question_tokens  # 確保你有 __init__.py 或 main.py 是可引用的模組
+from main import retrieve_documents_batch, format_docs, scope_fields
+from context_assembler import keep_recent_lines
+from session_store import SessionStore
+from metrics import stage_timer, mark_error, annotate_trace
 
-def format_history(history):
+# 對話歷史保存在伺服器端；設定 SESSION_DB 後存進 SQLite，多個 gunicorn worker 共用且重啟後仍在
+session_store = SessionStore(
+    db_path=os.getenv("SESSION_DB") or None,
+    window_turns=int(os.getenv("SESSION_WINDOW_TURNS", "6")),
+    history_max_chars=int(os.getenv("SESSION_HISTORY_MAX_CHARS", "4000")),
+    ttl_seconds=int(os.getenv("SESSION_TTL", str(24 * 3600)))
+)
+# gunicorn.conf.py 在多個 worker 時會預設 SESSION_DB；其他啟動方式（例如 uvicorn --workers）要自己設定
+if session_store.db_path is None and int(os.getenv("WEB_CONCURRENCY") or "1") > 1:
+    print("Warning: Sessions are kept in memory but WEB_CONCURRENCY is above 1. A follow-up served by another worker "
+          "will not find its session; set SESSION_DB to a SQLite path shared by all workers.")
+
+# 批量問答（/chat/batch 和 batch_questions.py）的上限
+batch_max_questions = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+batch_max_concurrency = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))  # 同時進行的 LLM 呼叫
+batch_retrieval_size = int(os.getenv("BATCH_RETRIEVAL_SIZE", "64"))  # 每次嵌入請求 / ChromaDB 查詢包含的問題數
+
+
+def build_chain_input(prompt_text, session=None, scope=None):
     """
-    Format chat history from Gradio's new messages format
-    [{'role': 'user', 'content': '...'}, {'role': 'assistant', 'content': '...'}]
-    into a plain text block for the LLM.
+    Builds the RAG chain input for a new message: the condensed standalone query and the scope for the retriever,
+    plus the message and the windowed, summarized history for the LLM.
     """
-    formatted_parts = []
-    for message in history:
-        if message['role'] == 'user':
-            formatted_parts.append(f"User: {message['content']}")
-        elif message['role'] == 'assistant':
-            formatted_parts.append(f"Assistant: {message['content']}")
-    return "\n".join(formatted_parts)
+    question = prompt_text.strip()
+    if session is None:
+        return {"question": question, "query": question, "history": "", "scope": scope}
+    chain_input = {
+        "question": question,
+        "query": session.standalone_query(question),
+        "history": keep_recent_lines(session.condensed_history(), history_token_budget, token_counter),
+        "scope": scope
+    }
+    return chain_input
 
 
-def generate_answer(prompt_text, chat_history_list):
+def parse_scope(raw_scope):
     """
-    Combines chat history and user input, then queries the RAG chain.
+    Returns (scope, error message) for the 'scope' of a request: {"vendor", "model", "document_id", "section"},
+    all optional. An empty scope is None (search all manuals).
     """
-    # chat_history_list 現在是 Gradio 提供的新的字典列表格式
-    formatted_chat_history = format_history(chat_history_list)
-    
-    # 組合完整的用戶問題，考慮歷史上下文
-    # 確保只有當有歷史消息時才包含它們
-    if formatted_chat_history:
-        # 將歷史和當前問題組合成一個連貫的輸入，給到 LLM 的 question 部分
-        # 這裡不應該加 "Assistant:"，因為這是用戶在問，不是模型要回答的開始
-        full_question = f"{formatted_chat_history}\nUser: {prompt_text.strip()}"
-    else:
-        full_question = prompt_text.strip() # 沒有歷史消息時只傳遞當前問題
+    if not raw_scope:
+        return None, None
+    if not isinstance(raw_scope, dict):
+        return None, "'scope' must be an object."
+    unknown = set(raw_scope) - set(scope_fields)
+    if unknown:
+        return None, f"Unknown scope fields: {', '.join(sorted(unknown))}. Use {', '.join(scope_fields)}."
+    scope = {}
+    for field in scope_fields:
+        value = raw_scope.get(field)
+        if value is None or value == "":
+            continue
+        if field == "document_id":
+            try:
+                scope[field] = int(value)
+            except (TypeError, ValueError):
+                return None, "'scope.document_id' must be an integer."
+        elif isinstance(value, str):
+            scope[field] = value.strip()
+        else:
+            return None, f"'scope.{field}' must be a string."
+    return scope or None, None
 
-    print(f"[Debug] Full Question:\n{full_question}\n")
 
+def validate_question(prompt_text):
+    """
+    Returns a message for the user if the question cannot be answered, otherwise None.
+    """
     if not prompt_text.strip():
-        return "Please enter a question."
+        return empty_question_message
+
+    # 歷史和 context 各有自己的 token 預算，這裡只檢查訊息本身是否放得進模型剩下的上下文窗口
+    if token_counter.count(prompt_text) > get_max_question_tokens():
+        return question_too_long_message
+    return None
+
+
+# rag_chain 初始化失敗時（之後的請求會自動重試）返回給用戶的訊息
+not_initialized_message = "AI system not initialized. Please ensure 'python setup_knowledge_base.py' ran successfully and check your API key."
+invalid_body_message = "The request body must be a JSON object."
+empty_question_message = "Please enter a question."
+question_too_long_message = "The question is too long for the model's context window. Please shorten it."
+unexpected_response_message = "Unexpected response format from the AI."
+error_answer_prefix = "An error occurred while generating the answer"
+
+
+def should_save_exchange(message, answer, failed=False):
+    """
+    Whether a question/answer exchange belongs in the session. Failed turns (error, not-initialized and
+    validation messages) are not saved, so they are never sent back to the model as assistant turns.
+    failed is the request trace's error flag, set by error_answer (also when a stream fails part-way).
+    """
+    if failed or not message.strip() or not answer:
+        return False
+    return answer not in (not_initialized_message, question_too_long_message, unexpected_response_message) \
+        and not answer.startswith(error_answer_prefix)
+
+
+async def aload_tokenizer():
+    # 第一次載入 tokenizer 可能要下載檔案；放到執行緒裡，不阻塞事件循環（RAG_PRELOAD=1 時啟動就已載入）
+    if not token_counter.loaded:
+        await asyncio.to_thread(token_counter.load)
+
+
+async def aget_rag_chain():
+    # 第一次初始化可能要幾秒，放到執行緒裡避免阻塞事件循環
+    if is_initialized():
+        return get_rag_chain()
+    return await asyncio.to_thread(get_rag_chain)
 
-    # 調整長度限制，以適應 LLM 的上下文窗口，並給檢索結果留空間
-    # 10000 字符可能過大，建議根據 Together AI 模型實際輸入限制調整，
-    # 尤其是當上下文(context)也很大時。可以調低到 4000-6000 字符。
-    if len(full_question) > 6000: 
-        return "The question and chat history are too long. Please shorten them."
+
+def get_usable_answer_cache(session, scope=None):
+    # 答案依賴對話歷史和檢索範圍，所以只有新對話中、不限範圍的第一個問題才使用語義答案快取
+    if scope is None and (session is None or session.is_empty()):
+        return get_answer_cache()
+    return None
+
+
+def error_answer(e):
+    print(f"[Error] Failed to generate answer: {e}")
+    mark_error()
+    # 更詳細的錯誤提示給用戶
+    return f"{error_answer_prefix}: {str(e)}\n\nPlease check your API key, model availability, or the setup of your knowledge base."
+
+
+def generate_answer(prompt_text, session=None, scope=None):
+    """
+    Queries the RAG chain with a new message, using the conversation held in the session.
+    scope optionally restricts retrieval to some manuals (see parse_scope).
+    """
+    error_message = validate_question(prompt_text)
+    if error_message:
+        return error_message
+    rag_chain = get_rag_chain()
+    if rag_chain is None:
+        return not_initialized_message
+    chain_input = build_chain_input(prompt_text, session, scope)
 
     try:
-        # 檢查 rag_chain 是否已成功初始化
-        if rag_chain is None:
-            return "AI system not initialized. Please ensure 'python setup_knowledge_base.py' ran successfully and check your API key."
+        answer_cache = get_usable_answer_cache(session, scope)
+        if answer_cache is not None:
+            kb_version = get_loaded_kb_version()
+            with stage_timer("answer_cache_lookup"):
+                cached_answer = answer_cache.lookup(chain_input["question"], kb_version)
+            if cached_answer is not None:
+                annotate_trace(answer_cache="hit")
+                return cached_answer
 
-        # rag_chain.invoke({"question": full_question}) 傳遞給 LLM
         # 預期 rag_chain 返回的是字符串
-        result = rag_chain.invoke(full_question) # rag_chain 現在直接接受一個 string
+        result = rag_chain.invoke(chain_input)
+
+        if isinstance(result, str):
+            if answer_cache is not None:
+                answer_cache.store(chain_input["question"], result, kb_version)
+            return result
+        else:
+            print(f"Warning: Unexpected return type from rag_chain: {type(result)} - {result}")
+            return unexpected_response_message
+    except Exception as e:
+        return error_answer(e)
+
+
+def stream_answer(prompt_text, session=None, scope=None):
+    """
+    Same as generate_answer, but yields the answer piece by piece as the LLM produces it
+    (via rag_chain.stream), so the first tokens can be shown before generation finishes.
+    """
+    error_message = validate_question(prompt_text)
+    if error_message:
+        yield error_message
+        return
+    rag_chain = get_rag_chain()
+    if rag_chain is None:
+        yield not_initialized_message
+        return
+    chain_input = build_chain_input(prompt_text, session, scope)
+
+    try:
+        answer_cache = get_usable_answer_cache(session, scope)
+        if answer_cache is not None:
+            kb_version = get_loaded_kb_version()
+            with stage_timer("answer_cache_lookup"):
+                cached_answer = answer_cache.lookup(chain_input["question"], kb_version)
+            if cached_answer is not None:
+                annotate_trace(answer_cache="hit")
+                yield cached_answer
+                return
+
+        answer_parts = []
+        for piece in rag_chain.stream(chain_input):
+            if piece:
+                answer_parts.append(piece)
+                yield piece
+
+        if answer_cache is not None and answer_parts:
+            answer_cache.store(chain_input["question"], "".join(answer_parts), kb_version)
+    except Exception as e:
+        yield error_answer(e)
+
+
+async def agenerate_answer(prompt_text, session=None, scope=None):
+    """
+    Async version of generate_answer for the ASGI app: awaits rag_chain.ainvoke,
+    so a worker is not blocked while the LLM is generating.
+    """
+    await aload_tokenizer()
+    error_message = validate_question(prompt_text)
+    if error_message:
+        return error_message
+    rag_chain = await aget_rag_chain()
+    if rag_chain is None:
+        return not_initialized_message
+    chain_input = build_chain_input(prompt_text, session, scope)
+
+    try:
+        answer_cache = get_usable_answer_cache(session, scope)
+        if answer_cache is not None:
+            kb_version = get_loaded_kb_version()
+            # 快取查找需要嵌入問題（可能是遠端呼叫），放到執行緒裡避免阻塞事件循環
+            with stage_timer("answer_cache_lookup"):
+                cached_answer = await asyncio.to_thread(answer_cache.lookup, chain_input["question"], kb_version)
+            if cached_answer is not None:
+                annotate_trace(answer_cache="hit")
+                return cached_answer
+
+        result = await rag_chain.ainvoke(chain_input)
 
         if isinstance(result, str):
+            if answer_cache is not None:
+                await asyncio.to_thread(answer_cache.store, chain_input["question"], result, kb_version)
             return result
         else:
             print(f"Warning: Unexpected return type from rag_chain: {type(result)} - {result}")
-            return "Unexpected response format from the AI."
+            return unexpected_response_message
+    except Exception as e:
+        return error_answer(e)
+
+
+async def astream_answer(prompt_text, session=None, scope=None):
+    """
+    Async version of stream_answer, driven by rag_chain.astream.
+    """
+    await aload_tokenizer()
+    error_message = validate_question(prompt_text)
+    if error_message:
+        yield error_message
+        return
+    rag_chain = await aget_rag_chain()
+    if rag_chain is None:
+        yield not_initialized_message
+        return
+    chain_input = build_chain_input(prompt_text, session, scope)
+
+    try:
+        answer_cache = get_usable_answer_cache(session, scope)
+        if answer_cache is not None:
+            kb_version = get_loaded_kb_version()
+            with stage_timer("answer_cache_lookup"):
+                cached_answer = await asyncio.to_thread(answer_cache.lookup, chain_input["question"], kb_version)
+            if cached_answer is not None:
+                annotate_trace(answer_cache="hit")
+                yield cached_answer
+                return
+
+        answer_parts = []
+        async for piece in rag_chain.astream(chain_input):
+            if piece:
+                answer_parts.append(piece)
+                yield piece
+
+        if answer_cache is not None and answer_parts:
+            await asyncio.to_thread(answer_cache.store, chain_input["question"], "".join(answer_parts), kb_version)
     except Exception as e:
-        print(f"[Error] Failed to generate answer: {e}")
-        # 更詳細的錯誤提示給用戶
-        return f"An error occurred while generating the answer: {str(e)}\n\nPlease check your API key, model availability, or the setup of your knowledge base."
\ No newline at end of file
+        yield error_answer(e)
+
+
+def parse_batch_request(data):
+    """
+    Returns (questions, max_concurrency, scope, error message) for a /chat/batch request body.
+    """
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions:
+        return None, None, None, "'questions' must be a non-empty list."
+    if len(questions) > batch_max_questions:
+        return None, None, None, f"At most {batch_max_questions} questions per batch."
+    try:
+        max_concurrency = int(data.get('max_concurrency') or 0) or None
+    except (TypeError, ValueError):
+        return None, None, None, "'max_concurrency' must be an integer."
+    scope, error_message = parse_scope(data.get('scope'))
+    if error_message:
+        return None, None, None, error_message
+    return questions, max_concurrency, scope, None
+
+
+def prepare_batch(questions, started):
+    """
+    Splits a batch into error results for the invalid questions and [(index, question)] to answer.
+    """
+    errors = []
+    pending = []
+    for index, question in enumerate(questions):
+        error_message = validate_question(question) if isinstance(question, str) else "Each question must be a string."
+        if error_message:
+            errors.append(batch_result(index, question, started, error=error_message))
+        else:
+            pending.append((index, question.strip()))
+    return errors, pending
+
+
+def batch_result(index, question, started, answer=None, error=None):
+    result = {"index": index, "question": question}
+    if error is None:
+        result["answer"] = answer
+    else:
+        result["error"] = error
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def retrieval_groups(pending):
+    """
+    Splits the pending [(index, question)] into groups of batch_retrieval_size, one embedding request
+    and vector search each.
+    """
+    return [pending[start:start + batch_retrieval_size] for start in range(0, len(pending), batch_retrieval_size)]
+
+
+def retrieve_batch_inputs(group, scope=None):
+    """
+    Retrieves the context for one group of pending questions. Returns the generation-chain inputs, aligned with group.
+    """
+    questions = [question for _, question in group]
+    return [{"question": question, "context": format_docs(docs), "history": ""}
+            for question, docs in zip(questions, retrieve_documents_batch(questions, scope))]
+
+
+def iter_batch_inputs(pending, scope=None):
+    """
+    Yields (group, generation-chain inputs or the retrieval exception) for each retrieval group.
+    The next group is retrieved in the background while the caller generates the answers for the current one,
+    so generation starts as soon as the first group is retrieved.
+    """
+    groups = retrieval_groups(pending)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-retrieval") as executor:
+        future = executor.submit(retrieve_batch_inputs, groups[0], scope)
+        for position, group in enumerate(groups):
+            try:
+                inputs = future.result()
+            except Exception as e:
+                inputs = e
+            if position + 1 < len(groups):
+                future = executor.submit(retrieve_batch_inputs, groups[position + 1], scope)
+            yield group, inputs
+
+
+async def aiter_batch_inputs(pending, scope=None):
+    """
+    Async version of iter_batch_inputs; retrieval runs in a worker thread.
+    """
+    groups = retrieval_groups(pending)
+    task = asyncio.ensure_future(asyncio.to_thread(retrieve_batch_inputs, groups[0], scope))
+    try:
+        for position, group in enumerate(groups):
+            try:
+                inputs = await task
+            except Exception as e:
+                inputs = e
+            if position + 1 < len(groups):
+                task = asyncio.ensure_future(asyncio.to_thread(retrieve_batch_inputs, groups[position + 1], scope))
+            yield group, inputs
+    finally:
+        # 客戶端中途斷開時不再等待預取的檢索結果
+        task.cancel()
+
+
+def batch_answers(questions, max_concurrency=None, scope=None):
+    """
+    Answers a list of independent questions (no conversation history). Retrieval is batched per group of
+    batch_retrieval_size questions, and each group's generation starts as soon as the group is retrieved
+    (see iter_batch_inputs), through generation_chain.batch_as_completed with at most max_concurrency LLM calls at a time.
+    scope optionally restricts retrieval for all the questions (see parse_scope).
+    Yields one result per question as soon as it is ready (not in input order):
+    {"index", "question", "answer" or "error", "elapsed_ms"}.
+    """
+    started = time.perf_counter()
+    max_concurrency = max(1, min(max_concurrency or batch_max_concurrency, batch_max_concurrency))
+    errors, pending = prepare_batch(questions, started)
+    yield from errors
+    if not pending:
+        return
+    generation_chain = get_generation_chain()
+    if generation_chain is None:
+        for index, question in pending:
+            yield batch_result(index, question, started, error=not_initialized_message)
+        return
+
+    for group, inputs in iter_batch_inputs(pending, scope):
+        if isinstance(inputs, Exception):
+            message = error_answer(inputs)
+            for index, question in group:
+                yield batch_result(index, question, started, error=message)
+            continue
+        for position, result in generation_chain.batch_as_completed(inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True):
+            index, question = group[position]
+            if isinstance(result, Exception):
+                yield batch_result(index, question, started, error=error_answer(result))
+            else:
+                yield batch_result(index, question, started, answer=result)
+
+
+async def abatch_answers(questions, max_concurrency=None, scope=None):
+    """
+    Async version of batch_answers, driven by generation_chain.abatch_as_completed.
+    """
+    started = time.perf_counter()
+    max_concurrency = max(1, min(max_concurrency or batch_max_concurrency, batch_max_concurrency))
+    await aload_tokenizer()
+    errors, pending = prepare_batch(questions, started)
+    for result in errors:
+        yield result
+    if not pending:
+        return
+    if await aget_rag_chain() is None:
+        for index, question in pending:
+            yield batch_result(index, question, started, error=not_initialized_message)
+        return
+    generation_chain = get_generation_chain()
+
+    async for group, inputs in aiter_batch_inputs(pending, scope):
+        if isinstance(inputs, Exception):
+            message = error_answer(inputs)
+            for index, question in group:
+                yield batch_result(index, question, started, error=message)
+            continue
+        async for position, result in generation_chain.abatch_as_completed(inputs, config={"max_concurrency": max_concurrency}, return_exceptions=True):
+            index, question = group[position]
+            if isinstance(result, Exception):
+                yield batch_result(index, question, started, error=error_answer(result))
+            else:
+                yield batch_result(index, question, started, answer=result)
@@ -0,0 +1,260 @@
+#vector_index.py 以 NumPy 實作的向量索引（VECTOR_BACKEND=numpy），取代 ChromaDB 的 HNSW 存儲。
+# 向量以記憶體映射（mmap）載入，可選 int8 量化（每個向量一個縮放係數），記憶體只有 float32 的四分之一；
+# chunk 原文不存在索引中，查詢時從 SQLite chunks 表讀取。
+# 小型語料做精確搜尋；語料較大時用 IVF（k-means 分桶，只搜尋最接近的幾個桶）。
+import os
+import json
+import math
+
+import numpy as np
+
+from index_files import new_generation_dir, publish_generation, current_generation_dir
+
+quantization_types = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+ivf_min_vectors = 50000  # nlist="auto" 時，少於這個數量的向量直接精確搜尋
+search_block_rows = 32768  # 精確搜尋時每次轉換並計算的行數，限制臨時記憶體
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(vectors, quantization):
+    """
+    Returns (stored vectors, per-row scales). int8 rows are scaled so their largest component is 127.
+    """
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(quantization_types[quantization]), np.ones(len(vectors), dtype=np.float32)
+
+
+def train_centroids(vectors, nlist, iterations=10, seed=0):
+    """
+    Spherical k-means on a sample of the (normalized) vectors. Returns nlist unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), 64 * nlist), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]  # 空桶重新取樣
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign_lists(vectors, centroids, block_rows=search_block_rows):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_rows):
+        assignment[start:start + block_rows] = np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+    return assignment
+
+
+class VectorIndex:
+    """
+    Cosine-similarity index over chunk embeddings, stored as flat arrays.
+    With IVF, rows are sorted by list: list i is rows list_offsets[i]:list_offsets[i + 1].
+    metadata maps a field name (e.g. source_document_id) to an int64 array aligned with the rows, for filtering.
+    """
+
+    files = ("vectors.npy", "scales.npy", "chunk_ids.npy", "centroids.npy", "list_offsets.npy")
+
+    def __init__(self, vectors, scales, chunk_ids, centroids, list_offsets, metadata, model_name=None, nprobe=8):
+        self.vectors = vectors
+        self.scales = scales
+        self.chunk_ids = chunk_ids
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.metadata = metadata
+        self.model_name = model_name
+        self.nprobe = nprobe
+        self.count = len(chunk_ids)
+        self.dimensions = vectors.shape[1] if vectors.ndim == 2 else 0
+        self.quantization = np.dtype(vectors.dtype).name
+        self.nlist = len(centroids)
+
+    @classmethod
+    def build(cls, items, model_name=None, quantization="int8", nlist="auto", nprobe=8, metadata_fields=("source_document_id", "chunk_index")):
+        """
+        Builds the index from an iterable of {'id', 'embedding', and the metadata_fields}.
+        nlist is the number of IVF lists: 0 for exact search, "auto" for exact below ivf_min_vectors
+        and about sqrt(n) lists above.
+        """
+        items = list(items)
+        if not items:
+            raise ValueError("Cannot build a vector index without vectors.")
+        vectors = normalize_rows(np.asarray([item['embedding'] for item in items], dtype=np.float32).reshape(len(items), -1))
+        chunk_ids = np.asarray([item['id'] for item in items], dtype=np.int64)
+        metadata = {field: np.asarray([item.get(field) if item.get(field) is not None else -1 for item in items], dtype=np.int64)
+                    for field in metadata_fields}
+        return cls.from_arrays(vectors, chunk_ids, metadata, model_name, quantization, nlist, nprobe)
+
+    @classmethod
+    def from_arrays(cls, vectors, chunk_ids, metadata, model_name=None, quantization="int8", nlist="auto", nprobe=8):
+        if nlist == "auto":
+            nlist = int(math.sqrt(len(vectors))) if len(vectors) >= ivf_min_vectors else 0
+        nlist = min(int(nlist), len(vectors))
+        if nlist > 0:
+            centroids = train_centroids(vectors, nlist)
+            assignment = assign_lists(vectors, centroids)
+            order = np.argsort(assignment, kind="stable")
+            vectors, chunk_ids = vectors[order], chunk_ids[order]
+            metadata = {field: values[order] for field, values in metadata.items()}
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+        else:
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            list_offsets = np.zeros(1, dtype=np.int64)
+        stored, scales = quantize(vectors, quantization)
+        return cls(stored, scales, chunk_ids, centroids.astype(np.float32), list_offsets, metadata, model_name, nprobe)
+
+    def dequantized(self):
+        """
+        The normalized float32 vectors (int8 rows round-trip exactly through quantize).
+        """
+        return np.asarray(self.vectors, dtype=np.float32) * np.asarray(self.scales)[:, None]
+
+    def add(self, items, quantization=None, nlist="auto", overwrite=False):
+        """
+        Returns a new index with the items whose chunk IDs are not in this one yet (IVF lists are retrained).
+        With overwrite, items whose IDs are already in the index replace the stored vectors instead of being skipped.
+        """
+        if overwrite:
+            base = self.remove([item['id'] for item in items], nlist=0) if items else self
+            new_items = list(items)
+        else:
+            base = self
+            known = set(self.chunk_ids.tolist())
+            new_items = [item for item in items if item['id'] not in known]
+        if not new_items:
+            return self
+        added = VectorIndex.build(new_items, quantization="float32", nlist=0, metadata_fields=tuple(self.metadata))
+        vectors = np.concatenate([base.dequantized(), added.vectors])
+        chunk_ids = np.concatenate([base.chunk_ids, added.chunk_ids])
+        metadata = {field: np.concatenate([values, added.metadata[field]]) for field, values in base.metadata.items()}
+        return VectorIndex.from_arrays(vectors, chunk_ids, metadata, self.model_name,
+                                       quantization or self.quantization, nlist, self.nprobe)
+
+    def remove(self, chunk_ids, nlist="auto"):
+        """
+        Returns a new index without the given chunk IDs (e.g. the chunks of a replaced manual).
+        """
+        keep = ~np.isin(self.chunk_ids, np.fromiter(chunk_ids, dtype=np.int64))
+        if keep.all():
+            return self
+        metadata = {field: np.asarray(values)[keep] for field, values in self.metadata.items()}
+        return VectorIndex.from_arrays(self.dequantized()[keep], np.asarray(self.chunk_ids)[keep], metadata, self.model_name,
+                                       self.quantization, nlist, self.nprobe)
+
+    def save(self, index_dir):
+        """
+        Writes the index into a new generation directory and publishes it, so readers never see a half-written index.
+        """
+        generation_dir = new_generation_dir(index_dir)
+        arrays = [(name, array) for name, array in zip(self.files, (self.vectors, self.scales, self.chunk_ids, self.centroids, self.list_offsets))]
+        arrays += [(f"meta_{field}.npy", values) for field, values in self.metadata.items()]
+        for name, array in arrays:
+            np.save(os.path.join(generation_dir, name), array)
+        with open(os.path.join(generation_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"model_name": self.model_name, "metadata_fields": list(self.metadata), "nprobe": self.nprobe,
+                       "count": self.count, "quantization": self.quantization}, f)
+        publish_generation(index_dir, generation_dir)
+
+    @classmethod
+    def load(cls, index_dir, nprobe=None):
+        index_dir = current_generation_dir(index_dir)
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(index_dir, name), mmap_mode="r") for name in cls.files]
+        metadata = {field: np.load(os.path.join(index_dir, f"meta_{field}.npy"), mmap_mode="r") for field in meta["metadata_fields"]}
+        return cls(*arrays, metadata, model_name=meta["model_name"], nprobe=nprobe or meta["nprobe"])
+
+    def memory_bytes(self):
+        return sum(array.nbytes for array in (self.vectors, self.scales, self.chunk_ids, self.centroids)) \
+            + sum(values.nbytes for values in self.metadata.values())
+
+    def filter_mask(self, where=None, allowed_chunk_ids=None):
+        """
+        Boolean row mask for the filters, or None if there are none.
+        where maps a metadata field to a value or a list of values, e.g. {"source_document_id": [1, 4]}.
+        """
+        mask = None
+        for field, value in (where or {}).items():
+            if field not in self.metadata:
+                raise ValueError(f"Unknown metadata field '{field}'; the index has {sorted(self.metadata)}.")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            field_mask = np.isin(self.metadata[field], np.asarray(list(values), dtype=np.int64))
+            mask = field_mask if mask is None else mask & field_mask
+        if allowed_chunk_ids is not None:
+            id_mask = np.isin(self.chunk_ids, np.fromiter(allowed_chunk_ids, dtype=np.int64))
+            mask = id_mask if mask is None else mask & id_mask
+        return mask
+
+    def _score_rows(self, query_vectors, start, end):
+        block = np.asarray(self.vectors[start:end], dtype=np.float32)
+        return (block @ query_vectors.T) * np.asarray(self.scales[start:end])[:, None]
+
+    def _score_row_ids(self, query_vector, rows):
+        block = np.asarray(self.vectors[rows], dtype=np.float32)
+        return (block @ query_vector) * np.asarray(self.scales[rows])
+
+    def _top_k(self, scores, rows, k):
+        if len(rows) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            scores, rows = scores[best], rows[best]
+        order = np.argsort(-scores, kind="stable")
+        return [(int(self.chunk_ids[row]), float(score)) for row, score in zip(rows[order], scores[order]) if score > -np.inf]
+
+    def _search_exact(self, query_vectors, k, mask):
+        # 分塊計算，每塊保留各查詢的前 k 名，再合併
+        best_scores = [np.empty(0, dtype=np.float32) for _ in query_vectors]
+        best_rows = [np.empty(0, dtype=np.int64) for _ in query_vectors]
+        for start in range(0, self.count, search_block_rows):
+            end = min(start + search_block_rows, self.count)
+            scores = self._score_rows(query_vectors, start, end)
+            if mask is not None:
+                scores[~mask[start:end]] = -np.inf
+            for i in range(len(query_vectors)):
+                column = scores[:, i]
+                rows = np.arange(start, end)
+                if len(rows) > k:
+                    keep = np.argpartition(-column, k - 1)[:k]
+                    column, rows = column[keep], rows[keep]
+                best_scores[i] = np.concatenate([best_scores[i], column])
+                best_rows[i] = np.concatenate([best_rows[i], rows])
+        return [self._top_k(scores, rows, k) for scores, rows in zip(best_scores, best_rows)]
+
+    def _search_ivf(self, query_vector, k, mask, nprobe):
+        probe = np.argsort(-(self.centroids @ query_vector))[:nprobe]
+        rows = np.concatenate([np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probe])
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if not len(rows):
+            return []
+        return self._top_k(self._score_row_ids(query_vector, rows), rows, k)
+
+    def search(self, query_vectors, k=10, where=None, allowed_chunk_ids=None, nprobe=None):
+        """
+        Returns, for each query vector, up to k (chunk id, cosine similarity) pairs, best first.
+        Filters (see filter_mask) are applied before ranking, so they never shrink the result below k.
+        """
+        if not self.count or not len(query_vectors):
+            return [[] for _ in query_vectors]
+        query_vectors = normalize_rows(np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1))
+        mask = self.filter_mask(where, allowed_chunk_ids)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        if mask is not None:
+            selected = np.flatnonzero(mask)
+            if not len(selected):
+                return [[] for _ in query_vectors]
+            # 過濾後剩下的行不多於要探測的桶時，直接對這些行精確搜尋（也避免 IVF 的桶裡湊不滿 k 個）
+            if not self.nlist or len(selected) <= nprobe * self.count / self.nlist:
+                return [self._top_k(self._score_row_ids(query_vector, selected), selected, k) for query_vector in query_vectors]
+        if not self.nlist:
+            return self._search_exact(query_vectors, k, mask)
+        return [self._search_ivf(query_vector, k, mask, nprobe) for query_vector in query_vectors]